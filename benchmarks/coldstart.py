@@ -0,0 +1,69 @@
+'''Cold start benchmark of the lambda entry points.
+
+Each measurement runs in a fresh interpreter, like a new lambda container: it times
+the handler module import and the first lambda_main invocation, with an event carrying
+a non existing command so that no AWS call is performed beside proxy initialization.'''
+import json
+import subprocess
+import sys
+from os import (environ, path)
+from statistics import median
+
+LAMBDA_DIR = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'lambda')
+MODULES = ('checker', 'cron', 'data', 'mailer', 'reporter')
+HEAVY_MODULES = ('boto3', 'botocore', 'asyncio', 'ssl', 'http.client')
+
+PROBE = '''
+import json, sys
+from time import perf_counter
+start = perf_counter()
+import %(module)s
+imported = perf_counter()
+%(module)s.lambda_main({'action': ['__cold_start_benchmark__']}, None)
+invoked = perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_call_ms': (invoked - imported) * 1000,
+    'modules': len(sys.modules),
+    'loaded': [name for name in %(heavy)r if name in sys.modules],
+}))
+'''
+
+
+def measure(module):
+    '''Return cold start measurement of module from a fresh interpreter.'''
+    env = dict(environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    output = subprocess.check_output(
+        [sys.executable, '-c', PROBE % {'module': module, 'heavy': HEAVY_MODULES}],
+        cwd=LAMBDA_DIR, env=env, stderr=subprocess.DEVNULL)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def run(runs=5, modules=MODULES):
+    '''Return dict of median measurements keyed by module.'''
+    results = {}
+    for module in modules:
+        samples = [measure(module) for _ in range(runs)]
+        results[module] = {
+            'import_ms': round(median(s['import_ms'] for s in samples), 1),
+            'first_call_ms': round(median(s['first_call_ms'] for s in samples), 1),
+            'modules': samples[-1]['modules'],
+            'loaded': samples[-1]['loaded'],
+        }
+    return results
+
+
+def print_report(results):
+    '''Print results table to STDOUT.'''
+    print('%-10s %10s %14s %8s  %s' % ('lambda', 'import ms', 'first call ms', 'modules',
+                                       'heavy modules loaded'))
+    for module, result in sorted(results.items()):
+        print('%-10s %10.1f %14.1f %8d  %s' % (module, result['import_ms'],
+                                               result['first_call_ms'], result['modules'],
+                                               ', '.join(result['loaded']) or '-'))
+
+
+if __name__ == '__main__':
+    RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print_report(run(RUNS, sys.argv[2:] or MODULES))
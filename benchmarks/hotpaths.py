@@ -0,0 +1,334 @@
+'''Benchmarks of the data, cron, checker, mailer and reporter hot paths.
+
+AWS services are replaced by moto (DynamoDB, S3) and local stand-ins: a fake
+sslexpired.info HTTP server, a fake SES client and a fake CloudWatch Logs client.
+Lambdas call each other with the local transport. Throughput and latency percentiles
+are compared with the baselines stored in baselines.json, a throughput lower than
+the baseline by more than the tolerance is reported as a regression.'''
+import argparse
+import json
+import sys
+import threading
+from datetime import datetime
+from http.server import (BaseHTTPRequestHandler, HTTPServer)
+from os import (environ, path)
+from socketserver import ThreadingMixIn
+from time import perf_counter
+
+BENCH_DIR = path.dirname(path.abspath(__file__))
+LAMBDA_DIR = path.join(path.dirname(BENCH_DIR), 'lambda')
+BASELINES = path.join(BENCH_DIR, 'baselines.json')
+SIZES = (1000, 10000, 100000)
+# Maximum throughput decrease from the baseline not reported as regression
+TOLERANCE = 0.3
+
+for name, value in (('AWS_DEFAULT_REGION', 'us-east-1'), ('AWS_ACCESS_KEY_ID', 'testing'),
+                    ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                    ('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required'),
+                    ('AWS_RESPONSE_CHECKSUM_VALIDATION', 'when_required')):
+    environ.setdefault(name, value)
+sys.path.insert(0, LAMBDA_DIR)
+
+
+def percentile(samples, pct):
+    '''Return nearest-rank percentile of samples.'''
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1)]
+
+
+def measure(func, runs, items=1):
+    '''Call func runs times, return throughput in items/s and latency percentiles in ms.'''
+    samples = []
+    for _ in range(runs):
+        start = perf_counter()
+        func()
+        samples.append(perf_counter() - start)
+    return {
+        'runs': runs,
+        'items': items,
+        'throughput': round(items * len(samples) / sum(samples), 1),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p90_ms': round(percentile(samples, 90) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+    }
+
+
+def measure_each(func, args_list):
+    '''Call func once for each args tuple, return measure-like result of the calls.'''
+    calls = iter(args_list)
+    return measure(lambda: func(*next(calls)), len(args_list))
+
+
+class FakeSSLExpiredHandler(BaseHTTPRequestHandler):
+    '''sslexpired.info stand-in, domains starting with 'alert' are in alert state.'''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def do_GET(self):
+        '''Return sslexpired.info-like JSON response.'''
+        domain = self.path.lstrip('/').split('?')[0]
+        result = {'response': 'certificate for %s is valid' % domain}
+        if domain.startswith('alert'):
+            result = {'response': 'certificate for %s is expiring' % domain, 'alert': True}
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        '''Keep benchmark output clean.'''
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    '''HTTP server handling each connection in its own thread.'''
+    daemon_threads = True
+
+
+class FakeSES(object):
+    '''SES client stand-in counting sent emails.'''
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_email(self, **kwargs):
+        '''Count email.'''
+        self.sent += 1
+        return {'MessageId': str(self.sent)}
+
+    @staticmethod
+    def get_send_quota():
+        '''Return quota not throttling the benchmarks.'''
+        return {'MaxSendRate': 100000.0, 'Max24HourSend': 1000000.0, 'SentLast24Hours': 0.0}
+
+
+class FakePaginator(object):
+    '''boto3 paginator stand-in returning the given pages.'''
+
+    def __init__(self, pages):
+        self._pages = pages
+
+    def paginate(self, **kwargs):
+        '''Return iterator of pages.'''
+        return iter(self._pages)
+
+
+class FakeLogs(object):
+    '''CloudWatch Logs client stand-in, pages of synthetic events for each group.'''
+
+    def __init__(self, groups, events, page_size=1000):
+        now = int(datetime.utcnow().timestamp() * 1000) - 60000
+        self._groups = groups
+        self._page_size = page_size
+        self._events = [{'timestamp': now + i,
+                         'message': ('START RequestId: %d\n' % i) if i % 3 else
+                                    ('[ERROR] something failed processing record %d\n' % i)}
+                        for i in range(events)]
+
+    def get_paginator(self, name):
+        '''Return describe_log_groups paginator.'''
+        return FakePaginator([{'logGroups': [{'logGroupName': group}
+                                             for group in self._groups]}])
+
+    def filter_log_events(self, **kwargs):
+        '''Return page of events, no server side filtering.'''
+        offset = int(kwargs.get('nextToken', 0))
+        response = {'events': self._events[offset:offset + self._page_size]}
+        if offset + self._page_size < len(self._events):
+            response['nextToken'] = str(offset + self._page_size)
+        return response
+
+
+def load_users(store, start, end):
+    '''Store users start..end, one domain every ten users.'''
+    requests = [('users', {'PutRequest': {'Item': store._to_item({
+        'email': 'user%d@example.com' % i, 'domain': 'domain%d.com' % (i // 10),
+        'days': 30, 'uuid': 'uuid%d' % i}, 'users')}}) for i in range(start, end)]
+    for offset in range(0, len(requests), 25):
+        store._batch_write(requests[offset:offset + 25])
+
+
+def create_tables():
+    '''Create moto DynamoDB tables and S3 buckets.'''
+    from sslnotifyme import (APPNAME, BACKUP_BUCKET, BOUNCES_BUCKET, aws_client)
+    from sslnotifyme.schedule import DUE_DAY_INDEX
+    dyn = aws_client('dynamodb')
+    throughput = {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+    dyn.create_table(TableName='%s_pending' % APPNAME,
+                     AttributeDefinitions=[{'AttributeName': 'email', 'AttributeType': 'S'}],
+                     KeySchema=[{'AttributeName': 'email', 'KeyType': 'HASH'}],
+                     ProvisionedThroughput=throughput)
+    dyn.create_table(TableName='%s_users' % APPNAME,
+                     AttributeDefinitions=[{'AttributeName': 'email', 'AttributeType': 'S'},
+                                           {'AttributeName': 'due_day', 'AttributeType': 'S'}],
+                     KeySchema=[{'AttributeName': 'email', 'KeyType': 'HASH'}],
+                     GlobalSecondaryIndexes=[{
+                         'IndexName': DUE_DAY_INDEX,
+                         'KeySchema': [{'AttributeName': 'due_day', 'KeyType': 'HASH'}],
+                         'Projection': {'ProjectionType': 'ALL'},
+                         'ProvisionedThroughput': throughput}],
+                     ProvisionedThroughput=throughput)
+    for bucket in (BACKUP_BUCKET, BOUNCES_BUCKET):
+        aws_client('s3').create_bucket(Bucket=bucket)
+
+
+def patch(patches, obj, name, value):
+    '''Set obj attribute, recording in patches the previous value to be restored.'''
+    patches.append((obj, name, getattr(obj, name)))
+    setattr(obj, name, value)
+
+
+def run(sizes=SIZES, checks=500, log_events=50000):
+    '''Return dict of results keyed by benchmark name.'''
+    from moto import (mock_dynamodb2, mock_s3)
+    import sslnotifyme
+    mocks = [mock_dynamodb2(), mock_s3()]
+    for mock in mocks:
+        mock.start()
+    sslnotifyme.reset_aws_clients()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSSLExpiredHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    patches = []
+    try:
+        return _run(sizes, checks, log_events, server, patches)
+    finally:
+        for obj, name, value in reversed(patches):
+            setattr(obj, name, value)
+        server.shutdown()
+        server.server_close()
+        for mock in mocks:
+            mock.stop()
+        sslnotifyme.reset_aws_clients()
+
+
+def _run(sizes, checks, log_events, server, patches):
+    import checker
+    import cron
+    import data
+    import mailer
+    import reporter
+    import sslnotifyme
+    from sslnotifyme import metrics
+    from sslnotifyme.ratelimit import TokenBucket
+    results = {}
+    patch(patches, sslnotifyme, 'LAMBDA_TRANSPORT', 'local')
+    patch(patches, metrics, '_COLLECTOR', metrics.MemoryCollector())
+    create_tables()
+    store = data.DataStore()
+    ses = sslnotifyme._CLIENTS['ses'] = FakeSES()
+
+    # dispatch only, checks are measured apart
+    patch(patches, cron, 'lambda_checker', lambda cmd, chunk, **kwargs: None)
+    patch(patches, cron, 'DISPATCH_LIMITER', TokenBucket(0))
+    patch(patches, cron, 'DUE_SCHEDULING', False)
+    patch(patches, cron, 'DIGEST_ALERTS', False)
+    patch(patches, cron, 'CRON_SHARDS', 1)  # moto ignores scan segments
+    shards = []
+    patch(patches, cron, 'lambda_cron', lambda cmd, *args: shards.append(args))
+    runs = iter(range(1000000))
+
+    def cron_run():
+        '''Start a run and process its shards, as the daily cron does.'''
+        cron.Cron().start_run('bench-%d' % next(runs))
+        while shards:
+            cron.Cron().process_shard(*shards.pop(0))
+
+    loaded = 0
+    for size in sorted(sizes):
+        load_users(store, loaded, size)
+        loaded = size
+        results['datastore_scan_%d' % size] = measure(
+            lambda: list(store._iter_records('users')), 3, size)
+        # moto scans the whole table for each page, largest tables are measured once
+        results['cron_dispatch_%d' % size] = measure(
+            cron_run, 3 if size <= 10000 else 1, size)
+
+    items = [store._to_item({'email': 'user%d@example.com' % i, 'domain': 'example.com',
+                             'days': 30, 'uuid': 'uuid%d' % i}, 'users')
+             for i in range(100000)]
+    results['parse_record'] = measure(
+        lambda: [store._parse_record(item, 'users') for item in items], 5, len(items))
+
+    patch(patches, checker, 'SSLEXPIRED_API_URL', 'http://127.0.0.1:%d' % server.server_port)
+    patch(patches, checker, 'CHECKER_MODE', 'sslexpired')
+    patch(patches, checker, '_SESSION', threading.local())
+    patch(patches, checker, 'RATE_LIMITER', TokenBucket(0))
+    # every check measures a sslexpired.info request
+    patch(patches, checker, 'RESULT_CACHE', checker.ResultCache(ttl=0))
+    records = [({'email': 'user%d@example.com' % i, 'uuid': 'uuid%d' % i, 'days': '30',
+                 'domain': '%s%d.com' % ('alert' if i % 2 else 'ok', i)},)
+               for i in range(checks)]
+    results['checker_alert'] = measure_each(checker.Checker.check_and_send_alert, records)
+    results['checker_alert']['emails'] = ses.sent
+
+    digests = dict(('user%d@example.com' % i, [
+        {'domain': 'domain%d.com' % j, 'message': 'expiring', 'uuid': 'uuid'}
+        for j in range(i % 5 + 1)]) for i in range(1000))
+    results['mailer_digests'] = measure(
+        lambda: mailer.Mailer.send_alert_digests(digests), 3, len(digests))
+
+    sslnotifyme._CLIENTS['logs'] = FakeLogs(
+        ['/aws/lambda/%s_%s' % (sslnotifyme.APPNAME, name)
+         for name in ('checker', 'cron', 'db', 'mailer')], log_events // 4)
+    results['reporter_report'] = measure(
+        lambda: reporter.Reporter.get_report(r'^(START |END |REPORT )'), 3, log_events)
+    return results
+
+
+def compare(results, baselines, tolerance=TOLERANCE):
+    '''Return list of regression messages of results against baselines.'''
+    regressions = []
+    for name, result in sorted(results.items()):
+        baseline = baselines.get(name)
+        if baseline and result['throughput'] < baseline['throughput'] * (1 - tolerance):
+            regressions.append('%s: %.1f items/s, baseline %.1f items/s' % (
+                name, result['throughput'], baseline['throughput']))
+    return regressions
+
+
+def print_report(results, baselines):
+    '''Print results table to STDOUT.'''
+    print('%-24s %8s %12s %12s %10s %10s %10s' % ('benchmark', 'items', 'items/s', 'baseline',
+                                                  'p50 ms', 'p90 ms', 'p99 ms'))
+    for name, result in sorted(results.items()):
+        baseline = baselines.get(name, {}).get('throughput')
+        print('%-24s %8d %12.1f %12s %10.3f %10.3f %10.3f' % (
+            name, result['items'], result['throughput'],
+            '%.1f' % baseline if baseline else '-',
+            result['p50_ms'], result['p90_ms'], result['p99_ms']))
+
+
+def main(argv=None):
+    '''Run benchmarks, return exit status.'''
+    import logging
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES),
+                        help='number of users of the scan benchmarks')
+    parser.add_argument('--save', action='store_true', help='store results as baselines')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='throughput decrease not reported as regression')
+    args = parser.parse_args(argv)
+    logging.disable(logging.INFO)
+
+    baselines = {}
+    if path.exists(BASELINES):
+        with open(BASELINES) as baselines_file:
+            baselines = json.load(baselines_file)
+    results = run(args.sizes)
+    print_report(results, baselines)
+    if args.save:
+        with open(BASELINES, 'w') as baselines_file:
+            json.dump(results, baselines_file, indent=2, sort_keys=True)
+            baselines_file.write('\n')
+        print('baselines stored to %s' % BASELINES)
+        return 0
+
+    regressions = compare(results, baselines, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -27,6 +27,80 @@ variable "backup_retention_in_days" {
   default = 2
 }
 
+# incremental backups are based on a full one taken at most this many days before
+variable "full_backup_interval_in_days" {
+  default = 1
+}
+
+variable "dynamodb_scan_segments" {
+  default = 4
+}
+
+# run "python data.py backfill" once before enabling, requires checker_mode = "probe"
+variable "due_scheduling" {
+  default = "false"
+}
+
+variable "backup_mode" {
+  default = "incremental"
+}
+
+variable "cron_shards" {
+  default = 4
+}
+
+variable "checker_batch_size" {
+  default = 100
+}
+
+# send one daily email per user with all the alerting domains
+variable "digest_alerts" {
+  default = "false"
+}
+
+# "sslexpired" to query sslexpired.info APIs, "probe" to fetch certificates directly
+variable "checker_mode" {
+  default = "sslexpired"
+}
+
+# the sslexpired.info requests rate is at most sslexpired_rate * checker_reserved_concurrency
+variable "checker_reserved_concurrency" {
+  default = 5
+}
+
+variable "sslexpired_rate" {
+  default = 20
+}
+
+# "local" if the API is deployed with LAMBDA_TRANSPORT=local, running db and mailer code
+variable "api_lambda_transport" {
+  default = "lambda"
+}
+
+variable "cron_dispatch_rate" {
+  default = 10
+}
+
+# concurrent mailers, each one sending at most its share of the SES maximum send rate
+variable "mailer_reserved_concurrency" {
+  default = 4
+}
+
+# "true" to exchange compressed columnar payloads between cron, checker and db lambdas
+variable "wire_envelope" {
+  default = "false"
+}
+
+# fraction of the routine per record INFO lines logged by checker, cron and mailer
+variable "log_sample_rate" {
+  default = 1
+}
+
+# deliveries of each mail queue message before it's moved to the dead letter queue
+variable "mail_queue_max_receives" {
+  default = 5
+}
+
 provider "aws" {
   region = "${var.aws_region}"
 }
@@ -287,6 +361,54 @@ resource "aws_dynamodb_table" "users_table" {
     name = "email"
     type = "S"
   }
+
+  attribute = {
+    name = "due_day"
+    type = "S"
+  }
+
+  # day bucket of the next check of each subscription, queried by the daily cron
+  global_secondary_index = {
+    name            = "due_day-index"
+    hash_key        = "due_day"
+    read_capacity   = 5
+    write_capacity  = 5
+    projection_type = "ALL"
+  }
+}
+
+resource "aws_dynamodb_table" "certs_table" {
+  name           = "${replace("${var.domain_name}", ".", "")}_certs"
+  read_capacity  = 5
+  write_capacity = 5
+  hash_key       = "domain"
+
+  attribute = {
+    name = "domain"
+    type = "S"
+  }
+
+  # time to live for DynamoDB tables is not supported yet by Terraform
+  provisioner "local-exec" {
+    command = "${path.module}/add_ttl_to_table.sh ${aws_dynamodb_table.certs_table.name}"
+  }
+}
+
+resource "aws_dynamodb_table" "idempotency_table" {
+  name           = "${replace("${var.domain_name}", ".", "")}_idempotency"
+  read_capacity  = 5
+  write_capacity = 5
+  hash_key       = "key"
+
+  attribute = {
+    name = "key"
+    type = "S"
+  }
+
+  # time to live for DynamoDB tables is not supported yet by Terraform
+  provisioner "local-exec" {
+    command = "${path.module}/add_ttl_to_table.sh ${aws_dynamodb_table.idempotency_table.name}"
+  }
 }
 
 resource "aws_s3_bucket" "backend-backup" {
@@ -296,8 +418,9 @@ resource "aws_s3_bucket" "backend-backup" {
     prefix  = ""
     enabled = true
 
+    # full backups must outlive the incremental ones based on them
     expiration {
-      days = "${var.backup_retention_in_days}"
+      days = "${var.backup_retention_in_days + var.full_backup_interval_in_days}"
     }
   }
 }
@@ -328,6 +451,15 @@ data "aws_iam_policy_document" "lambda-api-policy" {
     ]
   }
 
+  statement {
+    actions = [
+      "sqs:GetQueueUrl",
+      "sqs:SendMessage",
+    ]
+
+    resources = ["${aws_sqs_queue.mail-queue.arn}"]
+  }
+
   statement {
     actions = [
       "logs:CreateLogStream",
@@ -353,6 +485,18 @@ resource "aws_iam_role_policy_attachment" "lambda-api-role-policy-attachment" {
   policy_arn = "${aws_iam_policy.lambda-api-policy.arn}"
 }
 
+resource "aws_iam_role_policy_attachment" "lambda-api-role-db-policy-attachment" {
+  count      = "${var.api_lambda_transport == "local" ? 1 : 0}"
+  role       = "lambda_${replace("${var.domain_name}", ".", "")}_api"
+  policy_arn = "${aws_iam_policy.lambda-db-policy.arn}"
+}
+
+resource "aws_iam_role_policy_attachment" "lambda-api-role-mailer-policy-attachment" {
+  count      = "${var.api_lambda_transport == "local" ? 1 : 0}"
+  role       = "lambda_${replace("${var.domain_name}", ".", "")}_api"
+  policy_arn = "${aws_iam_policy.lambda-mailer-policy.arn}"
+}
+
 resource "aws_cloudwatch_log_group" "lambda-api" {
   name              = "/aws/lambda/${replace("${var.domain_name}", ".", "")}_api"
   retention_in_days = "${var.cloudwatch_retention_in_days}"
@@ -366,6 +510,8 @@ data "aws_iam_policy_document" "lambda-cron-policy" {
     resources = [
       "${aws_lambda_function.lambda-db.arn}",
       "${aws_lambda_function.lambda-checker.arn}",
+      "${aws_lambda_function.lambda-mailer.arn}",
+      "${aws_lambda_function.lambda-cron.arn}",
     ]
   }
 
@@ -377,6 +523,22 @@ data "aws_iam_policy_document" "lambda-cron-policy" {
 
     resources = ["${aws_cloudwatch_log_group.lambda-cron.arn}"]
   }
+
+  # missing checkpoints must be reported as such, not as access denied
+  statement {
+    actions   = ["s3:ListBucket"]
+    resources = ["${aws_s3_bucket.backend-backup.arn}"]
+  }
+
+  # runs and shards checkpoints
+  statement {
+    actions = [
+      "s3:GetObject",
+      "s3:PutObject",
+    ]
+
+    resources = ["${aws_s3_bucket.backend-backup.arn}/cron/*"]
+  }
 }
 
 resource "aws_iam_policy" "lambda-cron-policy" {
@@ -402,6 +564,19 @@ resource "aws_lambda_function" "lambda-cron" {
   source_code_hash = "${base64sha256(file("${path.module}/build/cron.zip"))}"
   runtime          = "python3.6"
   timeout          = "${var.lambda_timeout_in_seconds}"
+
+  environment {
+    variables = {
+      CHECKER_BATCH_SIZE    = "${var.checker_batch_size}"
+      DIGEST_ALERTS         = "${var.digest_alerts}"
+      DUE_SCHEDULING        = "${var.due_scheduling}"
+      CRON_SHARDS           = "${var.cron_shards}"
+      CRON_DISPATCH_RATE    = "${var.cron_dispatch_rate}"
+      CRON_MIN_REMAINING_MS = "${var.lambda_timeout_in_seconds * 1000 / 3}"
+      LOG_SAMPLE_RATE       = "${var.log_sample_rate}"
+      WIRE_ENVELOPE         = "${var.wire_envelope}"
+    }
+  }
 }
 
 resource "aws_cloudwatch_log_group" "lambda-cron" {
@@ -436,11 +611,15 @@ data "aws_iam_policy_document" "lambda-db-policy" {
       "dynamodb:GetItem",
       "dynamodb:PutItem",
       "dynamodb:DeleteItem",
+      "dynamodb:BatchWriteItem",
+      "dynamodb:UpdateItem",
+      "dynamodb:Query",
     ]
 
     resources = [
       "${aws_dynamodb_table.pending_table.arn}",
       "${aws_dynamodb_table.users_table.arn}",
+      "${aws_dynamodb_table.users_table.arn}/index/due_day-index",
     ]
   }
 
@@ -453,8 +632,16 @@ data "aws_iam_policy_document" "lambda-db-policy" {
     resources = ["${aws_cloudwatch_log_group.lambda-db.arn}"]
   }
 
+  # missing manifests must be reported as such, not as access denied
+  statement {
+    actions   = ["s3:ListBucket"]
+    resources = ["${aws_s3_bucket.backend-backup.arn}"]
+  }
+
   statement {
     actions = [
+      "s3:AbortMultipartUpload",
+      "s3:GetObject",
       "s3:PutObject",
     ]
 
@@ -485,6 +672,14 @@ resource "aws_lambda_function" "lambda-db" {
   source_code_hash = "${base64sha256(file("${path.module}/build/data.zip"))}"
   runtime          = "python3.6"
   timeout          = "${var.lambda_timeout_in_seconds}"
+
+  environment {
+    variables = {
+      SCAN_SEGMENTS        = "${var.dynamodb_scan_segments}"
+      BACKUP_MODE          = "${var.backup_mode}"
+      FULL_BACKUP_INTERVAL = "${var.full_backup_interval_in_days * 86400}"
+    }
+  }
 }
 
 resource "aws_cloudwatch_log_group" "lambda-db" {
@@ -518,10 +713,31 @@ resource "aws_lambda_permission" "allow-cloudwatch-db-backup-event" {
 # Mailer lambda
 data "aws_iam_policy_document" "lambda-mailer-policy" {
   statement {
-    actions   = ["ses:SendEmail"]
+    actions   = ["ses:SendEmail", "ses:GetSendQuota"]
     resources = ["*"]
   }
 
+  statement {
+    actions = [
+      "sqs:ChangeMessageVisibility",
+      "sqs:DeleteMessage",
+      "sqs:GetQueueAttributes",
+      "sqs:GetQueueUrl",
+      "sqs:ReceiveMessage",
+    ]
+
+    resources = ["${aws_sqs_queue.mail-queue.arn}"]
+  }
+
+  statement {
+    actions = [
+      "dynamodb:DeleteItem",
+      "dynamodb:PutItem",
+    ]
+
+    resources = ["${aws_dynamodb_table.idempotency_table.arn}"]
+  }
+
   statement {
     actions = [
       "logs:CreateLogStream",
@@ -556,9 +772,14 @@ resource "aws_lambda_function" "lambda-mailer" {
   runtime          = "python3.6"
   timeout          = "${var.lambda_timeout_in_seconds}"
 
+  reserved_concurrent_executions = "${var.mailer_reserved_concurrency}"
+
   environment {
     variables = {
-      REPORT_TO_EMAIL = "${var.ses_bounce_email}"
+      REPORT_TO_EMAIL    = "${var.ses_bounce_email}"
+      MAILER_CONCURRENCY = "${var.mailer_reserved_concurrency}"
+      IDEMPOTENCY_TABLE  = "${aws_dynamodb_table.idempotency_table.name}"
+      LOG_SAMPLE_RATE    = "${var.log_sample_rate}"
     }
   }
 }
@@ -568,16 +789,56 @@ resource "aws_cloudwatch_log_group" "lambda-mailer" {
   retention_in_days = "${var.cloudwatch_retention_in_days}"
 }
 
+# Mail queue, activation emails enqueued by the API and sent by the mailer
+resource "aws_sqs_queue" "mail-queue" {
+  name = "${replace("${var.domain_name}", ".", "")}_mail"
+
+  # must be at least the mailer timeout, a batch is redelivered only after it expires
+  visibility_timeout_seconds = "${var.lambda_timeout_in_seconds * 6}"
+  redrive_policy             = "{\"deadLetterTargetArn\":\"${aws_sqs_queue.mail-dead-letter-queue.arn}\",\"maxReceiveCount\":${var.mail_queue_max_receives}}"
+}
+
+resource "aws_sqs_queue" "mail-dead-letter-queue" {
+  name                      = "${replace("${var.domain_name}", ".", "")}_mail_dead_letter"
+  message_retention_seconds = 1209600
+}
+
+resource "aws_lambda_event_source_mapping" "mail-queue-mailer" {
+  event_source_arn        = "${aws_sqs_queue.mail-queue.arn}"
+  function_name           = "${aws_lambda_function.lambda-mailer.arn}"
+  batch_size              = 10
+  function_response_types = ["ReportBatchItemFailures"]
+}
+
 # Checker lambda
 data "aws_iam_policy_document" "lambda-checker-policy" {
   statement {
     actions = ["lambda:InvokeFunction"]
 
     resources = [
+      "${aws_lambda_function.lambda-db.arn}",
       "${aws_lambda_function.lambda-mailer.arn}",
     ]
   }
 
+  statement {
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:PutItem",
+    ]
+
+    resources = ["${aws_dynamodb_table.certs_table.arn}"]
+  }
+
+  statement {
+    actions = [
+      "dynamodb:DeleteItem",
+      "dynamodb:PutItem",
+    ]
+
+    resources = ["${aws_dynamodb_table.idempotency_table.arn}"]
+  }
+
   statement {
     actions = [
       "logs:CreateLogStream",
@@ -611,6 +872,20 @@ resource "aws_lambda_function" "lambda-checker" {
   source_code_hash = "${base64sha256(file("${path.module}/build/checker.zip"))}"
   runtime          = "python3.6"
   timeout          = "${var.lambda_timeout_in_seconds}"
+
+  reserved_concurrent_executions = "${var.checker_reserved_concurrency}"
+
+  environment {
+    variables = {
+      CHECKER_MODE      = "${var.checker_mode}"
+      CERT_CACHE_TABLE  = "${aws_dynamodb_table.certs_table.name}"
+      DUE_SCHEDULING    = "${var.due_scheduling}"
+      SSLEXPIRED_RATE   = "${var.sslexpired_rate}"
+      IDEMPOTENCY_TABLE = "${aws_dynamodb_table.idempotency_table.name}"
+      LOG_SAMPLE_RATE   = "${var.log_sample_rate}"
+      WIRE_ENVELOPE     = "${var.wire_envelope}"
+    }
+  }
 }
 
 resource "aws_cloudwatch_log_group" "lambda-checker" {
@@ -654,8 +929,21 @@ data "aws_iam_policy_document" "lambda-reporter-policy" {
   }
 
   statement {
-    actions   = ["s3:ListBucket"]
-    resources = ["${aws_s3_bucket.ses-delivery-to-s3.arn}"]
+    actions = ["s3:ListBucket"]
+
+    resources = [
+      "${aws_s3_bucket.ses-delivery-to-s3.arn}",
+      "${aws_s3_bucket.backend-backup.arn}",
+    ]
+  }
+
+  statement {
+    actions = [
+      "s3:GetObject",
+      "s3:PutObject",
+    ]
+
+    resources = ["${aws_s3_bucket.backend-backup.arn}/reporter-checkpoint.json"]
   }
 
   statement {
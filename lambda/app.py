@@ -2,6 +2,8 @@
 from botocore.exceptions import ClientError
 from chalice import (Chalice, ChaliceViewError, BadRequestError)
 from chalicelib import (lambda_db, lambda_mailer_blocking, APPNAME, LOGGER)
+from chalicelib.queue import mail_queue
+from chalicelib.subscriptions import import_subscriptions
 
 
 # XXX for now Chalice doesn't support environment variables, hence we can't assume
@@ -28,6 +30,30 @@ def feedback_router():
         lambda_mailer_blocking('send_feedback', app.current_request.raw_body))
 
 
+# Input formats of /import request bodies, detected from the first line if not listed
+IMPORT_FORMATS = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'jsonl',
+}
+
+
+@app.route('/import', methods=['POST'], api_key_required=True,
+           content_types=['text/csv', 'application/x-ndjson', 'text/plain'])
+def import_router():
+    '''Process /import request, bulk subscription from CSV or JSON Lines body.'''
+    LOGGER.info('processing import request of %d bytes', len(app.current_request.raw_body))
+    fmt = IMPORT_FORMATS.get(app.current_request.headers.get('content-type', '').split(';')[0])
+
+    def put_pending(records):
+        output = lambda_db('put_users_to_pending', records)
+        if 'response' not in output:
+            raise RuntimeError(output.get('errorMessage', 'unexpected output'))
+        return output['response']
+
+    body = app.current_request.raw_body.decode('utf-8')
+    return import_subscriptions(body.splitlines(), put_pending, mail_queue(), fmt)
+
+
 @app.route('/user/{user}', methods=['PUT', 'DELETE'], cors=True)
 def user_router(user):
     '''Dispatch /user request.'''
@@ -72,9 +98,10 @@ def add_user(user):
             if not output.get('uuid'):
                 raise BadRequestError('missing expected uuid from output')
             uuid = output['uuid']
-            output = lambda_mailer_blocking('send_activation_link',
-                                            user, params['domain'], days, uuid)
-            return process_lambda_output(output)
+            # activation email is sent by the mailer draining the queue, off the request path
+            mail_queue().send({'action': ['send_activation_link',
+                                          user, params['domain'], days, uuid]})
+            return {"Message": 'Please check your emails to confirm your subscription'}
 
         except ClientError as err:
             raise BadRequestError('%s' % err)
@@ -1,10 +1,99 @@
 '''sslnotify.me lambda checker.'''
 import json
-import urllib.request, urllib.error, urllib.parse
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor, wait)
+from datetime import datetime
+from os import environ
+from threading import local
+from time import (sleep, time)
+from urllib.parse import urlsplit
 
-from sslnotifyme import (lambda_mailer, LOGGER, lambda_main_wrapper)
+from sslnotifyme import (lambda_db, lambda_mailer, logs, LOGGER, lambda_main_wrapper, metrics,
+                         RECORD_LOGGER)
+from sslnotifyme.cache import (CertCache, DynamoDBCacheBackend, DynamoDBResultBackend,
+                               ResultCache)
+from sslnotifyme.ratelimit import (AIMDLimiter, RetryQueue, TokenBucket, backoff_delay)
+from sslnotifyme.schedule import (DUE_SCHEDULING, next_check_at)
 
 SSLEXPIRED_API_URL = "http://sslexpired.info"
+# 'sslexpired' queries sslexpired.info APIs, 'probe' connects to the domains directly
+CHECKER_MODE = environ.get('CHECKER_MODE', 'sslexpired')
+PROBE_TIMEOUT = float(environ.get('PROBE_TIMEOUT', 10))
+PROBE_CONCURRENCY = int(environ.get('PROBE_CONCURRENCY', 100))
+CERT_CACHE_TTL = int(environ.get('CERT_CACHE_TTL', 86400))
+CERT_CACHE_SIZE = int(environ.get('CERT_CACHE_SIZE', 10000))
+CERT_CACHE_TABLE = environ.get('CERT_CACHE_TABLE')
+# Seconds sslexpired.info responses are reused for, shorter than the daily cron interval
+RESULT_CACHE_TTL = int(environ.get('RESULT_CACHE_TTL', 12 * 3600))
+SSLEXPIRED_TIMEOUT = float(environ.get('SSLEXPIRED_TIMEOUT', 10))
+# Initial concurrency of the sslexpired.info requests, adapted up to CHECKER_MAX_WORKERS.
+# Limits are per container: the total is bounded by the checker reserved concurrency
+CHECKER_WORKERS = int(environ.get('CHECKER_WORKERS', 10))
+CHECKER_MAX_WORKERS = int(environ.get('CHECKER_MAX_WORKERS', 32))
+# sslexpired.info requests per second and burst, 0 is unlimited
+SSLEXPIRED_RATE = float(environ.get('SSLEXPIRED_RATE', 20))
+SSLEXPIRED_BURST = int(environ.get('SSLEXPIRED_BURST', 20))
+# sslexpired.info requests slower than this many seconds reduce concurrency, like errors
+SSLEXPIRED_LATENCY_TARGET = float(environ.get('SSLEXPIRED_LATENCY_TARGET', 2))
+# Attempts of each check, failed ones are retried with jittered exponential backoff
+CHECK_MAX_ATTEMPTS = int(environ.get('CHECK_MAX_ATTEMPTS', 3))
+CHECK_RETRY_BASE = float(environ.get('CHECK_RETRY_BASE', 0.5))
+CHECK_RETRY_MAX = float(environ.get('CHECK_RETRY_MAX', 10))
+
+# Per thread keep-alive HTTP connection to SSLEXPIRED_API_URL
+_SESSION = local()
+
+
+def _cache_backend(backend_class=DynamoDBCacheBackend):
+    '''Return persistent cache backend if CERT_CACHE_TABLE is configured.'''
+    if CERT_CACHE_TABLE:
+        return backend_class(CERT_CACHE_TABLE)
+    return None
+
+
+# Module level, hence shared by all the invocations served by a warm container
+CACHE = CertCache(CERT_CACHE_TTL, CERT_CACHE_SIZE, _cache_backend())
+RESULT_CACHE = ResultCache(RESULT_CACHE_TTL, CERT_CACHE_SIZE,
+                           _cache_backend(DynamoDBResultBackend))
+RATE_LIMITER = TokenBucket(SSLEXPIRED_RATE, SSLEXPIRED_BURST)
+CONCURRENCY_LIMITER = AIMDLimiter(CHECKER_WORKERS, 1, CHECKER_MAX_WORKERS,
+                                  latency_target=SSLEXPIRED_LATENCY_TARGET)
+
+
+def _sslexpired_get(path):
+    '''Return deserialized JSON response of GET request to SSLEXPIRED_API_URL.
+
+    The connection is kept alive and reused by the following requests of the same thread,
+    a request failing on a reused connection is retried once on a new one.'''
+    from http.client import (HTTPConnection, HTTPSConnection, HTTPException)
+    url = urlsplit(SSLEXPIRED_API_URL)
+    retries = 0
+    with metrics.timed('HTTPDuration', Target='sslexpired'):
+        for retry in (True, False):
+            conn = getattr(_SESSION, 'conn', None)
+            if conn is None:
+                retry = False  # fresh connection, nothing stale to retry
+                conn_class = HTTPSConnection if url.scheme == 'https' else HTTPConnection
+                conn = _SESSION.conn = conn_class(url.netloc, timeout=SSLEXPIRED_TIMEOUT)
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (HTTPException, OSError):
+                conn.close()
+                _SESSION.conn = None
+                if retry:
+                    retries += 1
+                    continue
+                metrics.record('HTTPErrors', 1, 'Count', Target='sslexpired')
+                raise
+    metrics.record('HTTPRetries', retries, 'Count', Target='sslexpired')
+    metrics.record('HTTPResponseSize', len(body), 'Bytes', Target='sslexpired')
+    if response.status >= 400:
+        metrics.record('HTTPErrors', 1, 'Count', Target='sslexpired')
+        raise HTTPException('HTTP %d %s from %s%s' % (response.status, response.reason,
+                                                      SSLEXPIRED_API_URL, path))
+    return json.loads(body.decode('utf-8'))
 
 
 class Checker(object):
@@ -12,39 +101,310 @@ class Checker(object):
 
     @staticmethod
     def check_sslexpired(domain, days=None):
-        '''Return response from sslexpired.info API.'''
-        url = '%s/%s%s' % (SSLEXPIRED_API_URL, domain,
-                           ('?days=%s' % days) if days else '')
-        LOGGER.info('invoking %s', url)
-        return json.load(urllib.request.urlopen(url))
+        '''Return response from sslexpired.info API, within rate and concurrency limits.
+
+        Responses are cached in RESULT_CACHE, so that each domain is queried once per run.'''
+        entry = RESULT_CACHE.get(domain, days=days)
+        if entry:
+            return entry['result']
+        path = '/%s%s' % (domain, ('?days=%s' % days) if days else '')
+        RATE_LIMITER.acquire()
+        with CONCURRENCY_LIMITER.slot():
+            RECORD_LOGGER.info('invoking %s%s', SSLEXPIRED_API_URL, path)
+            result = _sslexpired_get(path)
+        RESULT_CACHE.set(domain, result, days=days)
+        return result
+
+    @staticmethod
+    def fetch_certificates(domains_days):
+        '''Return probe results for dict of domain: largest days threshold.
+
+        Cached notAfter dates are used only when far enough from the threshold to be
+        out of alert state, alerts are always confirmed probing the domain again in
+        case a new certificate has been issued in the meanwhile.'''
+        from sslnotifyme.probe import (probe_certificates, DAY_IN_SECONDS)
+        now = time()
+        results = {}
+        for domain, days in domains_days.items():
+            entry = CACHE.get(domain, now)
+            if entry and entry['not_after'] - now >= (int(days) + 1) * DAY_IN_SECONDS:
+                results[domain] = {'not_after': entry['not_after']}
+
+        missing = [domain for domain in domains_days if domain not in results]
+        if missing:
+            RECORD_LOGGER.info('probing %s', ', '.join(missing))
+            with metrics.timed('ProbeDuration'):
+                probes = probe_certificates(missing, PROBE_TIMEOUT, PROBE_CONCURRENCY)
+            metrics.record('ProbedDomains', len(missing), 'Count')
+            for domain, probe in probes.items():
+                if 'not_after' in probe:
+                    CACHE.set(domain, probe['not_after'], now)
+                results[domain] = probe
+        return results
+
+    @staticmethod
+    def probe_with_retries(domains_days):
+        '''Return (probe results, number of retries) for dict of domain: days threshold.
+
+        Failed probes are retried with jittered exponential backoff up to
+        CHECK_MAX_ATTEMPTS, only the errors left are reported (as alerts) to subscribers.'''
+        probes = Checker.fetch_certificates(domains_days)
+        retried = 0
+        for attempt in range(1, CHECK_MAX_ATTEMPTS):
+            failed = dict((domain, days) for domain, days in domains_days.items()
+                          if 'error' in probes[domain])
+            if not failed:
+                break
+            LOGGER.warning('probe of %d domain(s) failed, retrying', len(failed))
+            sleep(backoff_delay(attempt, CHECK_RETRY_BASE, CHECK_RETRY_MAX))
+            probes.update(Checker.fetch_certificates(failed))
+            retried += len(failed)
+        return probes, retried
+
+    @staticmethod
+    def probe(domain, days=None):
+        '''Return sslexpired.info-like response computed from a native TLS probe.'''
+        from sslnotifyme.probe import expiry_result
+        probe = Checker.probe_with_retries({domain: days or 0})[0][domain]
+        return expiry_result(domain, probe, days or 0)
+
+    @staticmethod
+    def check_certificate(domain, days=None):
+        '''Return check response for domain, using the configured CHECKER_MODE.'''
+        if CHECKER_MODE == 'probe':
+            return Checker.probe(domain, days)
+        return Checker.check_sslexpired(domain, days)
+
+    @staticmethod
+    def check_thresholds(domain, thresholds, probe=None):
+        '''Return dict of check responses for domain, keyed by days threshold.
+
+        In probe mode the certificate is fetched once (unless a probe result is given)
+        and every threshold computed locally. sslexpired.info computes the alert state
+        for a single days value instead, so we query it starting from the largest
+        threshold and stop at the first one not in alert state, which in the common
+        case means the domain is checked only once.'''
+        if CHECKER_MODE == 'probe':
+            from sslnotifyme.probe import expiry_result
+            if probe is None:
+                probe = Checker.probe_with_retries({domain: max(thresholds)})[0][domain]
+            return dict((days, expiry_result(domain, probe, days)) for days in thresholds)
+
+        results = {}
+        for days in sorted(thresholds, reverse=True):
+            results[days] = Checker.check_sslexpired(domain, days)
+            if 'alert' not in results[days]:
+                break
+        return results
+
+    @staticmethod
+    def valid_record(record):
+        '''Return True if record has the fields needed to be checked.'''
+        return 'domain' in record and 'days' in record
+
+    @staticmethod
+    def notify(record, result, digest=False):
+        '''Invoke mailer if result is in alert state, return True if so.
+
+        With digest the mailer is not invoked, alerts are collected by the caller.'''
+        if result.get('err'):
+            LOGGER.error('errors found processing record: %s', result)
+
+        if 'alert' in result and digest:
+            RECORD_LOGGER.info('collecting alert to %(email)s for domain %(domain)s', record)
+            return True
+
+        if 'alert' in result:
+            RECORD_LOGGER.info('sending alert to %(email)s for domain %(domain)s', record)
+            # alerts are daily, a redelivered or retried check sends each one once a day
+            lambda_mailer('send_alert', record['email'], record['domain'],
+                          result['response'], record['uuid'],
+                          idempotency_key='send_alert:%s:%s:%s' % (
+                              datetime.utcnow().strftime('%Y-%m-%d'), record['email'],
+                              record['domain']))
+            return True
+
+        RECORD_LOGGER.info('domain %(domain)s for %(email)s is not in alert state', record)
+        return False
 
     @staticmethod
     def check_and_send_alert(record):
         '''Send alert email if sslexpired check has alerts.'''
-        if not ('domain' in record and 'days' in record):
+        logs.summarize(records=1)
+        if not Checker.valid_record(record):
             err = 'error: wrong record format: %s' % record
             print(err)
+            logs.summarize(errors=1)
             return err
 
+        for attempt in range(1, CHECK_MAX_ATTEMPTS + 1):
+            try:
+                result = Checker.check_certificate(record['domain'], record['days'])
+                break
+            # pylint: disable=broad-except
+            except Exception:
+                if attempt == CHECK_MAX_ATTEMPTS:
+                    msg = 'exceptions invoking %s' % SSLEXPIRED_API_URL
+                    LOGGER.exception(msg)
+                    logs.summarize(errors=1)
+                    return {'errorMessage': msg}
+                LOGGER.warning('check of %s failed, retrying', record['domain'])
+                sleep(backoff_delay(attempt, CHECK_RETRY_BASE, CHECK_RETRY_MAX))
+
+        logs.summarize(alerts=int(Checker.notify(record, result)))
+        return {'response': 'ok'}
+
+    @staticmethod
+    def check_domain(domain, records, probe=None):
+        '''Return (records, check responses keyed by days threshold) for domain.
+
+        Exceptions are logged and returned in place of the responses.'''
+        thresholds = set(int(record['days']) for record in records)
         try:
-            result = Checker.check_sslexpired(record['domain'], record['days'])
+            return records, Checker.check_thresholds(domain, thresholds, probe)
         # pylint: disable=broad-except
-        except Exception:
+        except Exception as err:
+            LOGGER.exception('exceptions invoking %s', SSLEXPIRED_API_URL)
+            return records, err
+
+    @staticmethod
+    def notify_domain(domain, records, results, digest=False):
+        '''Notify domain records in alert state, return per record outcomes.
+
+        With digest, outcomes in alert state carry message and uuid for the digest email.'''
+        if isinstance(results, Exception):
             msg = 'exceptions invoking %s' % SSLEXPIRED_API_URL
-            LOGGER.exception(msg)
-            return {'errorMessage': msg}
+            return [{'email': record.get('email'), 'domain': domain, 'errorMessage': msg}
+                    for record in records]
 
-        if result.get('err'):
-            LOGGER.error('errors found processing record: %s', result)
+        outcomes = []
+        for record in records:
+            result = results.get(int(record['days']), {})
+            outcome = {'email': record.get('email'), 'domain': domain,
+                       'alert': Checker.notify(record, result, digest)}
+            if digest and outcome['alert']:
+                outcome.update(message=result['response'], uuid=record['uuid'])
+            outcomes.append(outcome)
+        return outcomes
 
-        if 'alert' in result:
-            LOGGER.info('sending alert to %(email)s for domain %(domain)s', record)
-            lambda_mailer('send_alert', record['email'], record['domain'],
-                          result['response'], record['uuid'])
-        else:
-            LOGGER.info('domain %(domain)s for %(email)s is not in alert state', record)
+    @staticmethod
+    def check_domain_and_send_alerts(domain, records):
+        '''Check domain once, send alert to each subscriber according to its days threshold.'''
+        records = [record for record in records
+                   if Checker.valid_record(record) and record['domain'] == domain]
+        outcomes = Checker.notify_domain(domain, *Checker.check_domain(domain, records))
+        if records and all('errorMessage' in outcome for outcome in outcomes):
+            return {'errorMessage': outcomes[0]['errorMessage']}
 
-        return {'response': 'ok'}
+        return {'response': '%d alert(s) for %d record(s) of domain %s'
+                            % (sum(1 for outcome in outcomes if outcome.get('alert')),
+                               len(records), domain)}
+
+    @staticmethod
+    def schedule_updates(results, probes, now=None):
+        '''Return list of next check schedule updates of checked records.
+
+        Records of domains with errors are due again the day after, like alerts.'''
+        updates = []
+        for domain, (domain_records, domain_results) in results.items():
+            not_after = probes.get(domain, {}).get('not_after')
+            for record in domain_records:
+                failed = isinstance(domain_results, Exception)
+                result = {} if failed else domain_results.get(int(record['days']), {})
+                update = {'email': record['email'],
+                          'next_check_at': next_check_at(record['days'], not_after,
+                                                         failed or 'alert' in result, now)}
+                if not_after:
+                    update['not_after'] = not_after
+                updates.append(update)
+        return updates
+
+    @staticmethod
+    def check_and_send_alert_batch(records, digest=False):
+        '''Check a chunk of records with a bounded pool of workers, each domain once.
+
+        Return per record outcomes, a summary and aggregate timings in milliseconds.
+        With digest alerts are not sent, they are returned to be grouped per recipient.'''
+        start = time()
+        outcomes = []
+        domains = {}
+        for record in records:
+            if Checker.valid_record(record):
+                domains.setdefault(record['domain'], []).append(record)
+            else:
+                LOGGER.error('error: wrong record format: %s', record)
+                outcomes.append({'email': record.get('email'), 'domain': record.get('domain'),
+                                 'errorMessage': 'wrong record format'})
+
+        probes = {}
+        retried = 0
+        if CHECKER_MODE == 'probe':
+            # all the domains are probed concurrently by the asyncio engine
+            probes, retried = Checker.probe_with_retries(dict(
+                (domain, max(int(record['days']) for record in domain_records))
+                for domain, domain_records in domains.items()))
+        probed = time()
+
+        def check(domain):
+            return Checker.check_domain(domain, domains[domain], probes.get(domain))
+
+        # concurrency is limited by CONCURRENCY_LIMITER, the pool just has to be big enough
+        results = {}
+        retries = RetryQueue(CHECK_MAX_ATTEMPTS, CHECK_RETRY_BASE, CHECK_RETRY_MAX)
+        with ThreadPoolExecutor(max_workers=CHECKER_MAX_WORKERS) as pool:
+            running = dict((pool.submit(check, domain), domain) for domain in domains)
+            while running or len(retries):
+                if running:
+                    done, _ = wait(running, retries.next_delay(), FIRST_COMPLETED)
+                else:
+                    sleep(retries.next_delay())
+                    done = ()
+                for future in done:
+                    domain = running.pop(future)
+                    results[domain] = future.result()
+                    if isinstance(results[domain][1], Exception) and retries.push(domain):
+                        LOGGER.warning('check of %s failed, retrying', domain)
+                        del results[domain]
+                for domain, _ in retries.ready():
+                    running[pool.submit(check, domain)] = domain
+                    retried += 1
+        checked = time()
+        metrics.record('CheckConcurrencyLimit', CONCURRENCY_LIMITER.limit, 'Count')
+
+        for domain, (domain_records, domain_results) in results.items():
+            outcomes.extend(Checker.notify_domain(domain, domain_records, domain_results,
+                                                  digest))
+
+        scheduled = 0
+        if DUE_SCHEDULING:
+            updates = Checker.schedule_updates(results, probes)
+            try:
+                lambda_db('update_schedules', updates)
+                scheduled = len(updates)
+            # pylint: disable=broad-except
+            except Exception:
+                LOGGER.exception('exception updating %d schedule(s)', len(updates))
+        end = time()
+
+        LOGGER.info('%d record(s) for %d domain(s) processed in %.3fs',
+                    len(records), len(domains), end - start)
+        summary = {
+            'records': len(records),
+            'domains': len(domains),
+            'alerts': sum(1 for outcome in outcomes if outcome.get('alert')),
+            'errors': sum(1 for outcome in outcomes if 'errorMessage' in outcome),
+            'scheduled': scheduled,
+            'retries': retried,
+        }
+        logs.summarize(**summary)
+        return {'response': outcomes,
+                'summary': summary,
+                'timings': {
+                    'probe_ms': int((probed - start) * 1000),
+                    'check_ms': int((checked - probed) * 1000),
+                    'notify_ms': int((end - checked) * 1000),
+                    'total_ms': int((end - start) * 1000),
+                }}
 
 
 # pylint: disable=unused-argument
@@ -1,27 +1,359 @@
 '''cron function.
 
-Scans the user table and, for each user, invokes one lambda checker.
-If the check generates an alert, invokes mailer lambda to notify the user.'''
-from sslnotifyme import (lambda_db, lambda_checker, lambda_main_wrapper, LOGGER)
+Streams the user table from lambda db one page at a time and invokes one lambda checker
+for each chunk of records as soon as the page arrives, records of the same domain in a
+page are kept in the same chunk so that each domain is checked once per page, checkers
+cache the sslexpired.info responses so that it's queried once per run.
+If the check generates an alert, invokes mailer lambda to notify the subscribed users.
+
+With DUE_SCHEDULING enabled only the records due to be checked are queried, instead of
+scanning the whole table, except for the weekly sweep of the records left behind.
+
+With DIGEST_ALERTS enabled checkers are invoked synchronously, their alerts collected and
+sent by the mailer as one digest email per user.
+
+The daily run is split into shards, DynamoDB scan segments or due day buckets, each one
+processed by its own cron invocation: progress is checkpointed after each page and the
+invocation continues in a new one when running out of time.'''
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor, wait)
+from datetime import datetime
+from functools import partial
+from os import environ
+from time import sleep
+from sslnotifyme import (lambda_db, lambda_checker, lambda_checker_blocking, lambda_cron,
+                         lambda_mailer, lambda_main_wrapper, logs, LOGGER)
+from sslnotifyme.checkpoint import S3CheckpointStore
+from sslnotifyme.ratelimit import (RetryQueue, TokenBucket)
+from sslnotifyme.schedule import (DUE_SCHEDULING, due_days, sweep_day)
+
+# Number of records of each page fetched from lambda db, keeps payloads and memory bounded
+USERS_PAGE_SIZE = int(environ.get('USERS_PAGE_SIZE', 1000))
+# Number of records processed by each lambda checker invocation
+CHECKER_BATCH_SIZE = int(environ.get('CHECKER_BATCH_SIZE', 100))
+DIGEST_ALERTS = environ.get('DIGEST_ALERTS', '').lower() in ('1', 'true', 'yes')
+# Number of concurrent blocking checker invocations in digest mode
+DIGEST_WORKERS = int(environ.get('DIGEST_WORKERS', 10))
+# Number of recipients for each lambda mailer invocation in digest mode
+DIGEST_BATCH_SIZE = int(environ.get('DIGEST_BATCH_SIZE', 200))
+# Number of scan segments the users table is split into, ignored with DUE_SCHEDULING
+CRON_SHARDS = int(environ.get('CRON_SHARDS', 4))
+# Shard processing continues in a new invocation when less time than this is left, at
+# most half of the time left at the start of the invocation
+CRON_MIN_REMAINING_MS = int(environ.get('CRON_MIN_REMAINING_MS', 60000))
+# Shard processing is abandoned after this many consecutive invocations without progress
+CRON_MAX_STALLED = int(environ.get('CRON_MAX_STALLED', 3))
+# BACKUP_BUCKET prefix of the runs and shards checkpoints
+CRON_CHECKPOINT_PREFIX = environ.get('CRON_CHECKPOINT_PREFIX', 'cron/')
+# Lambda checker invocations per second of each cron invocation, 0 is unlimited
+CRON_DISPATCH_RATE = float(environ.get('CRON_DISPATCH_RATE', 10))
+# Attempts of each lambda checker invocation, failed ones are retried with backoff
+DISPATCH_MAX_ATTEMPTS = int(environ.get('DISPATCH_MAX_ATTEMPTS', 3))
+DISPATCH_RETRY_BASE = float(environ.get('DISPATCH_RETRY_BASE', 0.5))
+DISPATCH_RETRY_MAX = float(environ.get('DISPATCH_RETRY_MAX', 10))
+
+# Module level, hence shared by all the threads of the invocation
+DISPATCH_LIMITER = TokenBucket(CRON_DISPATCH_RATE)
+
+
+def checkpoint_store(run_id, name):
+    '''Return store of checkpoint name of run.'''
+    return S3CheckpointStore('%s%s/%s.json' % (CRON_CHECKPOINT_PREFIX, run_id, name))
 
 
 class Cron(object):
     '''Cron object class.'''
 
+    def __init__(self, context=None):
+        self._context = context
+        self._min_remaining_ms = None
+
+    def _running_out_of_time(self):
+        '''Return True if the lambda is about to time out.
+
+        The threshold is capped at half of the time left at the first call, so that
+        lambdas with a timeout shorter than CRON_MIN_REMAINING_MS still make progress.'''
+        if self._context is None:
+            return False
+        remaining = self._context.get_remaining_time_in_millis()
+        if self._min_remaining_ms is None:
+            self._min_remaining_ms = min(CRON_MIN_REMAINING_MS, remaining // 2)
+        return remaining < self._min_remaining_ms
+
+    @staticmethod
+    def fetch_page(query, cursor, args=()):
+        '''Return (page of users, next cursor) fetched from lambda db.'''
+        output = lambda_db(query, cursor, USERS_PAGE_SIZE, *args)
+        if 'errorMessage' in output:
+            raise RuntimeError('error fetching users: %s' % output['errorMessage'])
+        return output.get('response', []), output.get('cursor')
+
+    @staticmethod
+    def pages():
+        '''Return generator of pages of validated users to be checked, fetched from lambda db.'''
+        query = 'get_due_users_page' if DUE_SCHEDULING else 'get_validated_users_page'
+        cursor = None
+        while True:
+            page, cursor = Cron.fetch_page(query, cursor)
+            yield page
+            if not cursor:
+                return
+
+    @staticmethod
+    def shards():
+        '''Return list of {'id', 'query', 'args'} shards of the users to be checked.'''
+        if DUE_SCHEDULING:
+            shards = [{'id': 'day-%s' % day, 'query': 'get_due_users_page', 'args': [day]}
+                      for day in due_days()]
+            if sweep_day():
+                shards.extend({'id': 'stale-%d-of-%d' % (segment, CRON_SHARDS),
+                               'query': 'get_stale_users_page',
+                               'args': [segment, CRON_SHARDS]}
+                              for segment in range(CRON_SHARDS))
+            return shards
+        return [{'id': 'segment-%d-of-%d' % (segment, CRON_SHARDS),
+                 'query': 'get_validated_users_page', 'args': [segment, CRON_SHARDS]}
+                for segment in range(CRON_SHARDS)]
+
+    @staticmethod
+    def domain_chunks(pages):
+        '''Return generator of (records chunk, number of domains starting in it) from pages.'''
+        for page in pages:
+            domains = Cron.group_by_domain(page)
+            count = len(domains)
+            for chunk in Cron.chunks(domains, CHECKER_BATCH_SIZE):
+                yield chunk, count
+                count = 0
+
+    @staticmethod
+    def group_by_domain(records):
+        '''Return dict of records lists keyed by domain.'''
+        domains = {}
+        for record in records:
+            domains.setdefault(record.get('domain'), []).append(record)
+        return domains
+
+    @staticmethod
+    def chunks(domains, size):
+        '''Return generator of records lists of about size records, domains are not split.'''
+        chunk = []
+        for records in domains.values():
+            chunk.extend(records)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def collect_digests(outcomes):
+        '''Return dict of alerts lists keyed by recipient from checkers outcomes.'''
+        digests = {}
+        for outcome in outcomes:
+            if outcome.get('alert'):
+                digests.setdefault(outcome['email'], []).append({
+                    'domain': outcome['domain'],
+                    'message': outcome['message'],
+                    'uuid': outcome['uuid'],
+                })
+        return digests
+
+    @staticmethod
+    def invoke_checkers(chunks, key=None):
+        '''Invoke async lambda checker for each chunk, within CRON_DISPATCH_RATE.
+
+        Failed invocations are retried with jittered exponential backoff, return number
+        of invocations and list of the chunks still failing after DISPATCH_MAX_ATTEMPTS.
+        With key, each chunk is checked once even if invoked again by a retried run.'''
+        retries = RetryQueue(DISPATCH_MAX_ATTEMPTS, DISPATCH_RETRY_BASE, DISPATCH_RETRY_MAX)
+        pending = list(enumerate(chunks))
+        failed = []
+        invoked = 0
+        while pending or len(retries):
+            for index, chunk in pending:
+                DISPATCH_LIMITER.acquire()
+                try:
+                    lambda_checker('check_and_send_alert_batch', chunk,
+                                   idempotency_key=key and '%s:%d' % (key, index))
+                    invoked += 1
+                # pylint: disable=broad-except
+                except Exception:
+                    LOGGER.exception('exception invoking lambda checker')
+                    if not retries.push(index, chunk):
+                        failed.append(chunk)
+            if len(retries):
+                sleep(retries.next_delay())
+            pending = retries.ready()
+        return invoked, failed
+
+    @staticmethod
+    def check_and_send_digests(pages, key=None):
+        '''Invoke checkers synchronously, send one alert digest per recipient.
+
+        With key, each digests batch is sent once even if the run is retried.'''
+        def check(chunk):
+            DISPATCH_LIMITER.acquire()
+            return lambda_checker_blocking('check_and_send_alert_batch', chunk, True)
+
+        def collect(futures):
+            for future in futures:
+                result = future.result()
+                if 'errorMessage' in result:
+                    LOGGER.error('error processing batch: %s', result['errorMessage'])
+                outcomes.extend(result.get('response', []))
+
+        outcomes = []
+        batches = domains = 0
+        with ThreadPoolExecutor(max_workers=DIGEST_WORKERS) as pool:
+            running = set()
+            for chunk, count in Cron.domain_chunks(pages):
+                running.add(pool.submit(check, chunk))
+                batches += 1
+                domains += count
+                if len(running) >= DIGEST_WORKERS * 2:  # don't fetch pages too far ahead
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    collect(done)
+            collect(wait(running).done)
+
+        digests = Cron.collect_digests(outcomes)
+        recipients = sorted(digests)
+        for offset in range(0, len(recipients), DIGEST_BATCH_SIZE):
+            batch = recipients[offset:offset + DIGEST_BATCH_SIZE]
+            lambda_mailer('send_alert_digests', dict((email, digests[email]) for email in batch),
+                          idempotency_key=key and 'digests:%s:%d' % (key, offset))
+
+        msg = '%d record(s) for %d domain(s) processed successfully in %d batch(es), ' \
+              '%d alert digest(s) queued' % (len(outcomes), domains, batches, len(digests))
+        LOGGER.info(msg)
+        return {'response': msg}
+
+    @staticmethod
+    def dispatch_page(page, key=None):
+        '''Check page of users, return number of checker batches.
+
+        key identifies the page within the run, its actions are skipped when the page is
+        dispatched again after a failure.'''
+        if DIGEST_ALERTS:
+            Cron.check_and_send_digests([page], key)
+            return 1
+        batches, failed = Cron.invoke_checkers(
+            (chunk for chunk, _ in Cron.domain_chunks([page])), key)
+        if failed:
+            logs.summarize(errors=sum(len(chunk) for chunk in failed))
+            # the shard invocation fails and is retried from the page checkpoint
+            raise RuntimeError('%d lambda checker invocation(s) failed' % len(failed))
+        return batches
+
+    def start_run(self, run_id=None):
+        '''Start daily run, invoking one lambda cron for each shard.
+
+        Runs are identified by UTC date by default, so that a run is started only once.'''
+        run_id = run_id or datetime.utcnow().strftime('%Y-%m-%d')
+        run_store = checkpoint_store(run_id, 'run')
+        if run_store.load():
+            LOGGER.warning('run %s already started', run_id)
+            return self.shard_summary(run_id)
+
+        shards = Cron.shards()
+        run_store.save({'run_id': run_id, 'shards': shards,
+                        'started': datetime.utcnow().isoformat()})
+        for shard in shards:
+            checkpoint_store(run_id, shard['id']).save(
+                {'cursor': None, 'done': False, 'pages': 0, 'records': 0, 'invocations': 0,
+                 'stalled': 0})
+            lambda_cron('process_shard', run_id, shard['id'])
+        msg = 'run %s started with %d shard(s)' % (run_id, len(shards))
+        LOGGER.info(msg)
+        return {'response': msg}
+
+    def process_shard(self, run_id, shard_id):
+        '''Dispatch shard pages from its checkpoint, continue in a new invocation on timeout.
+
+        At least one page is processed by each invocation. Invocations failing before
+        completing a page are counted, the shard is abandoned after CRON_MAX_STALLED.'''
+        shard = dict((shard['id'], shard) for shard in
+                     checkpoint_store(run_id, 'run').load()['shards'])[shard_id]
+        store = checkpoint_store(run_id, shard_id)
+        state = store.load()
+        if state['done']:
+            logs.summarize(skipped=1)
+            return {'response': 'shard %s of run %s already done' % (shard_id, run_id)}
+        if state.get('stalled', 0) >= CRON_MAX_STALLED:
+            msg = 'shard %s of run %s abandoned after %d invocation(s) without progress' % (
+                shard_id, run_id, state['stalled'])
+            LOGGER.error(msg)
+            logs.summarize(errors=1)
+            return {'errorMessage': msg}
+
+        state['invocations'] += 1
+        state['stalled'] = state.get('stalled', 0) + 1
+        store.save(state)  # counted as stalled until a page is done
+        while True:
+            page, cursor = Cron.fetch_page(shard['query'], state['cursor'], shard['args'])
+            Cron.dispatch_page(page, 'cron:%s:%s:%d' % (run_id, shard_id, state['pages']))
+            logs.summarize(records=len(page), pages=1)
+            state.update(cursor=cursor, done=not cursor, pages=state['pages'] + 1,
+                         records=state['records'] + len(page), stalled=0)
+            store.save(state)
+            if state['done']:
+                msg = 'shard %s of run %s done, %d record(s) in %d page(s)' % (
+                    shard_id, run_id, state['records'], state['pages'])
+                LOGGER.info(msg)
+                return {'response': msg}
+
+            if self._running_out_of_time():
+                lambda_cron('process_shard', run_id, shard_id)
+                msg = 'shard %s of run %s continues after %d page(s)' % (
+                    shard_id, run_id, state['pages'])
+                LOGGER.info(msg)
+                return {'response': msg}
+
+    def shard_summary(self, run_id=None):
+        '''Return completion summary of the shards of run, today's by default.'''
+        run_id = run_id or datetime.utcnow().strftime('%Y-%m-%d')
+        run = checkpoint_store(run_id, 'run').load()
+        if not run:
+            return {'errorMessage': 'run %s not found' % run_id}
+
+        states = dict((shard['id'], checkpoint_store(run_id, shard['id']).load())
+                      for shard in run['shards'])
+        pending = sorted(shard_id for shard_id, state in states.items() if not state['done'])
+        return {'response': {
+            'run_id': run_id,
+            'started': run['started'],
+            'shards': len(states),
+            'done': len(states) - len(pending),
+            'pending': pending,
+            'abandoned': sorted(shard_id for shard_id in pending
+                                if states[shard_id].get('stalled', 0) >= CRON_MAX_STALLED),
+            'records': sum(state['records'] for state in states.values()),
+            'pages': sum(state['pages'] for state in states.values()),
+            'invocations': sum(state['invocations'] for state in states.values()),
+        }}
+
     @staticmethod
     def scan_and_notify_alerts_queue():
-        '''Trigger a lambda checker for each validated user.'''
-        counter = 0
-        for record in lambda_db('get_validated_users').get('response'):
-            lambda_checker('check_and_send_alert', record)
-            counter += 1
-        msg = '%d record(s) processed successfully' % counter
+        '''Trigger a lambda checker for each chunk of validated users due to be checked.'''
+        if DIGEST_ALERTS:
+            return Cron.check_and_send_digests(Cron.pages())
+
+        counter = batches = domains = 0
+        for page in Cron.pages():
+            chunks = list(Cron.domain_chunks([page]))
+            invoked, failed = Cron.invoke_checkers(chunk for chunk, _ in chunks)
+            for chunk in failed:
+                LOGGER.error('lambda checker invocation failed for %d record(s)', len(chunk))
+            counter += sum(len(chunk) for chunk, _ in chunks) - \
+                sum(len(chunk) for chunk in failed)
+            batches += invoked
+            domains += sum(count for _, count in chunks)
+            logs.summarize(records=sum(len(chunk) for chunk, _ in chunks), pages=1,
+                           errors=sum(len(chunk) for chunk in failed))
+        msg = '%d record(s) for %d domain(s) processed successfully in %d batch(es)' % (
+            counter, domains, batches)
         LOGGER.info(msg)
         return {'response': msg}
 
 
-# pylint: disable=unused-argument
 def lambda_main(event, context):
     '''Lambda entry point.'''
-    return lambda_main_wrapper(event, Cron,
-                               default=['scan_and_notify_alerts_queue'])
+    return lambda_main_wrapper(event, partial(Cron, context), default=['start_run'])
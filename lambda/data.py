@@ -1,18 +1,118 @@
 '''data layer abstraction.'''
+import json
+from os import environ
+from sys import argv
 from time import time
-import boto3
-from sslnotifyme import (DOMAINNAME, BACKUP_BUCKET, lambda_main_wrapper)
+from sslnotifyme import (DOMAINNAME, BACKUP_BUCKET, LOGGER, aws_client, lambda_main_wrapper)
+from sslnotifyme.schedule import (DUE_DAY_INDEX, due_day, due_days)
+
+# Number of DynamoDB parallel scan segments, each one scanned by its own thread
+SCAN_SEGMENTS = int(environ.get('SCAN_SEGMENTS', 1))
+# 'incremental' stores only records changed since the previous backup, 'full' everything
+BACKUP_MODE = environ.get('BACKUP_MODE', 'incremental')
+# Maximum age in seconds of the full backup incremental ones are based on
+FULL_BACKUP_INTERVAL = int(environ.get('FULL_BACKUP_INTERVAL', 86400))
+# Size of S3 multipart upload parts, minimum allowed by S3 is 5 MB
+UPLOAD_PART_SIZE = int(environ.get('UPLOAD_PART_SIZE', 8 * 1024 * 1024))
+# Number of threads writing restored records
+RESTORE_WORKERS = int(environ.get('RESTORE_WORKERS', 8))
+# Attempts to write UnprocessedItems before giving up
+RESTORE_MAX_ATTEMPTS = int(environ.get('RESTORE_MAX_ATTEMPTS', 8))
+# Log restore progress every this many records
+RESTORE_PROGRESS_EVERY = int(environ.get('RESTORE_PROGRESS_EVERY', 10000))
+# BatchWriteItem maximum number of requests
+BATCH_WRITE_SIZE = 25
+# Default number of records of each page returned by the paged queries
+PAGE_SIZE = int(environ.get('PAGE_SIZE', 1000))
+# Number of threads writing checks schedule updates
+SCHEDULE_WORKERS = int(environ.get('SCHEDULE_WORKERS', 8))
+
+
+class MultipartUpload(object):
+    '''Write-only file-like object uploading data to S3 in multipart upload parts.'''
+
+    def __init__(self, client, bucket, key, part_size=None):
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._part_size = part_size or UPLOAD_PART_SIZE
+        self._buffer = bytearray()
+        self._parts = []
+        self.size = 0
+        self._upload_id = client.create_multipart_upload(
+            ACL='private', Bucket=bucket, Key=key)['UploadId']
+
+    def _upload_part(self):
+        number = len(self._parts) + 1
+        response = self._client.upload_part(
+            Body=bytes(self._buffer), Bucket=self._bucket, Key=self._key,
+            PartNumber=number, UploadId=self._upload_id)
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': number})
+        self._buffer = bytearray()
+
+    def write(self, data):
+        '''Buffer data, upload a part each time the buffer reaches the part size.'''
+        self._buffer.extend(data)
+        self.size += len(data)
+        if len(self._buffer) >= self._part_size:
+            self._upload_part()
+        return len(data)
+
+    def flush(self):
+        '''Nothing to do, parts are uploaded as soon as they are big enough.'''
+
+    def close(self):
+        '''Upload the last part and complete the upload.'''
+        if self._buffer or not self._parts:
+            self._upload_part()
+        self._client.complete_multipart_upload(
+            Bucket=self._bucket, Key=self._key, UploadId=self._upload_id,
+            MultipartUpload={'Parts': self._parts})
+
+    def abort(self):
+        '''Abort the upload, discarding the uploaded parts.'''
+        self._client.abort_multipart_upload(
+            Bucket=self._bucket, Key=self._key, UploadId=self._upload_id)
+
+
+class BackupWriter(object):
+    '''Write JSON lines into gzip compressed S3 object, streaming it while written.'''
+
+    def __init__(self, client, bucket, key):
+        import gzip
+        self.key = key
+        self.lines = 0
+        self._upload = MultipartUpload(client, bucket, key)
+        self._gzip = gzip.GzipFile(fileobj=self._upload, mode='wb')
+
+    def write(self, obj):
+        '''Append JSON serialized obj as new line.'''
+        self._gzip.write(json.dumps(obj, sort_keys=True).encode('utf-8') + b'\n')
+        self.lines += 1
+
+    def close(self):
+        '''Flush compressed data and complete the upload, return uploaded bytes.'''
+        self._gzip.close()
+        self._upload.close()
+        return self._upload.size
+
+    def abort(self):
+        '''Discard the upload.'''
+        self._upload.abort()
 
 
 class Backup(object):
     '''Backup object.'''
     def __init__(self, prefix=''):
-        self._client = boto3.client('s3')
+        self._client = aws_client('s3')
         self._prefix = prefix
 
+    def key(self, suffix, timestamp=None):
+        '''Return bucket key made of prefix, UNIX epoch and suffix.'''
+        return '%s%d%s' % (self._prefix, int(timestamp or time()), suffix)
+
     def persist(self, data):
         '''Persiste data to bucket object with current timestamp.'''
-        import json
         key = '%s%d.json' % (
             self._prefix,
             int(time())) # we use UNIX epoch as filename
@@ -25,39 +125,167 @@ class Backup(object):
         )
         return {'response': 's3://%s/%s' % (BACKUP_BUCKET, key)}
 
+    def writer(self, key):
+        '''Return BackupWriter streaming gzip compressed JSON lines to key.'''
+        return BackupWriter(self._client, BACKUP_BUCKET, key)
+
+    def put_json(self, key, data, compress=False):
+        '''Store data as JSON object, optionally gzip compressed.'''
+        body = json.dumps(data).encode('utf-8')
+        if compress:
+            import gzip
+            body = gzip.compress(body)
+        self._client.put_object(ACL='private', Body=body, Bucket=BACKUP_BUCKET, Key=key)
+
+    def get_json(self, key):
+        '''Return deserialized JSON object, None if not found.'''
+        try:
+            body = self._client.get_object(Bucket=BACKUP_BUCKET, Key=key)['Body'].read()
+        except self._client.exceptions.NoSuchKey:
+            return None
+        if key.endswith('.gz'):
+            import gzip
+            body = gzip.decompress(body)
+        return json.loads(body.decode('utf-8'))
+
+    def snapshots(self, key):
+        '''Return list of snapshot keys to restore in order, expanding manifests.'''
+        if not key.endswith('.manifest.json'):
+            return [key]
+        manifest = self.get_json(key)
+        if manifest is None:
+            raise ValueError('backup manifest %s not found' % key)
+        return [manifest['base']] + manifest['incrementals']
+
+    def iter_lines(self, key):
+        '''Return generator of {'table', 'record'|'deleted'} lines of snapshot in key.
+
+        Supports the gzip compressed JSON lines snapshots, streamed while read, and
+        the legacy JSON dumps written by persist.'''
+        if key.endswith('.jsonl.gz'):
+            import gzip
+            body = self._client.get_object(Bucket=BACKUP_BUCKET, Key=key)['Body']
+            with gzip.GzipFile(fileobj=body, mode='rb') as lines:
+                for line in lines:
+                    yield json.loads(line.decode('utf-8'))
+        else:
+            dump = self.get_json(key)
+            if dump is None:
+                raise ValueError('backup %s not found' % key)
+            for table in ('users', 'pending'):
+                for record in dump.get(table, []):
+                    yield {'table': table, 'record': record}
+
+
+def encode_cursor(state):
+    '''Return opaque cursor string of JSON serializable pagination state, None if no state.'''
+    if not state:
+        return None
+    from base64 import urlsafe_b64encode
+    return urlsafe_b64encode(json.dumps(state, sort_keys=True).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    '''Return pagination state of cursor returned by encode_cursor, None if no cursor.'''
+    if not cursor:
+        return None
+    from base64 import urlsafe_b64decode
+    try:
+        return json.loads(urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise ValueError('invalid cursor %r' % cursor)
+
+
+def record_hash(record):
+    '''Return hash of record content.'''
+    from hashlib import sha1
+    return sha1(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
 
 class DataStore(object):
     '''Data abstraction class.'''
 
     def __init__(self):
         '''Initialize object.'''
-        self._client = boto3.client('dynamodb')
+        self._client = aws_client('dynamodb')
         self._tables = {
             'users': '%s_users' % DOMAINNAME.replace('.', ''),
             'pending': '%s_pending' % DOMAINNAME.replace('.', ''),
         }
         self._tables_keys = {
-            'users': (('email', 'S'), ('domain', 'S'), ('days', 'N'), ('uuid', 'S')),
+            'users': (('email', 'S'), ('domain', 'S'), ('days', 'N'), ('uuid', 'S'),
+                      ('not_after', 'N'), ('next_check_at', 'N'), ('due_day', 'S')),
             'pending': (('email', 'S'), ('domain', 'S'), ('days', 'N'),
                         ('uuid', 'S'), ('ttl', 'N')),
         }
 
+    def _scan_segment(self, table, segment=0, total_segments=1, page_size=None):
+        '''Return generator of raw items pages from one scan segment, following pagination.'''
+        kwargs = {
+            'TableName': self._tables[table],
+            'Select': 'ALL_ATTRIBUTES',
+        }
+        if total_segments > 1:
+            kwargs['Segment'] = segment
+            kwargs['TotalSegments'] = total_segments
+        if page_size:
+            kwargs['Limit'] = page_size
+
+        while True:
+            response = self._client.scan(**kwargs)
+            yield response.get('Items', [])
+            if not response.get('LastEvaluatedKey'):
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def _iter_records(self, table, segments=None, page_size=None):
+        '''Return generator of parsed records, scanning segments in parallel.'''
+        segments = segments or SCAN_SEGMENTS
+        if segments == 1:
+            for page in self._scan_segment(table, page_size=page_size):
+                for record in page:
+                    yield self._parse_record(record, table)
+            return
+
+        from concurrent.futures import ThreadPoolExecutor
+        from queue import Queue
+        from threading import Event
+        done = object()  # sentinel put in queue when a segment has been fully scanned
+        pages = Queue(maxsize=segments * 2)  # keep memory bounded to a few pages
+        closed = Event()
+
+        def scan(segment):
+            try:
+                for page in self._scan_segment(table, segment, segments, page_size):
+                    if closed.is_set():
+                        return
+                    pages.put(page)
+            finally:
+                pages.put(done)
+
+        with ThreadPoolExecutor(max_workers=segments) as pool:
+            futures = [pool.submit(scan, segment) for segment in range(segments)]
+            running = segments
+            try:
+                while running:
+                    page = pages.get()
+                    if page is done:
+                        running -= 1
+                        continue
+                    for record in page:
+                        yield self._parse_record(record, table)
+            finally:
+                # unblock segment scans if the consumer stopped iterating early
+                closed.set()
+                while running:
+                    if pages.get() is done:
+                        running -= 1
+            for future in futures:
+                future.result()  # re-raise exceptions from segment scans, if any
+
     def _get_all_records(self, table):
-        '''Return users dict.'''
-        records = self._client.scan(
-            TableName=self._tables[table],
-            Select='ALL_ATTRIBUTES',
-        ).get('Items')
-        result_set = []
-        for record in records:
-            result_set.append(self._parse_record(record, table))
-        return result_set
-
-    def _fetch_user(self, user, table):
-        return self._client.get_item(
-            TableName=self._tables[table],
-            Key={'email': {'S': user}},
-        ).get('Item')
+        '''Return list of all parsed records in table.'''
+        return list(self._iter_records(table))
 
     def _fetch_and_delete_user(self, user, table):
         response = self._client.delete_item(
@@ -67,6 +295,7 @@ class DataStore(object):
         return response.get('Attributes', {})
 
     def _put_user(self, user, domain, uuid, days, table):
+        now = int(time())  # new subscriptions are due to be checked right away
         self._client.put_item(
             TableName=self._tables[table],
             Item={
@@ -74,8 +303,25 @@ class DataStore(object):
                 'domain': {'S': domain},
                 'uuid': {'S': uuid},
                 'days': {'N': days},
+                'next_check_at': {'N': str(now)},
+                'due_day': {'S': due_day(now)},
             })
 
+    def _query_due_day(self, day, page_size=None, start_key=None):
+        '''Return response of query of one page of raw items in due day bucket.'''
+        kwargs = {
+            'TableName': self._tables['users'],
+            'IndexName': DUE_DAY_INDEX,
+            'KeyConditionExpression': '#due_day = :day',
+            'ExpressionAttributeNames': {'#due_day': 'due_day'},
+            'ExpressionAttributeValues': {':day': {'S': day}},
+        }
+        if page_size:
+            kwargs['Limit'] = page_size
+        if start_key:
+            kwargs['ExclusiveStartKey'] = start_key
+        return self._client.query(**kwargs)
+
     def _parse_record(self, record, table):
         result = {}
         if record:
@@ -84,11 +330,22 @@ class DataStore(object):
                     result[key_name] = record[key_name].get(key_type)
         return result
 
-    def _verify_user(self, user, uuid, table):
-        '''Verify if uuid is matching user in table, return record if valid.'''
-        parsed = self._parse_record(self._fetch_user(user, table), table)
-        if parsed.get('uuid') and parsed['uuid'] == uuid:
-            return parsed
+    def _delete_if_uuid(self, user, uuid, table):
+        '''Delete user from table only if uuid matches, return deleted record, None if not.
+
+        The uuid check is enforced by DynamoDB, so there is no window between read
+        and write: of two concurrent requests, only one gets the record.'''
+        try:
+            response = self._client.delete_item(
+                TableName=self._tables[table],
+                Key={'email': {'S': user}},
+                ConditionExpression='#uuid = :uuid',
+                ExpressionAttributeNames={'#uuid': 'uuid'},
+                ExpressionAttributeValues={':uuid': {'S': uuid}},
+                ReturnValues='ALL_OLD')
+        except self._client.exceptions.ConditionalCheckFailedException:
+            return None
+        return self._parse_record(response.get('Attributes'), table)
 
     def get_validated_users(self):
         '''Return dict with validated users data.'''
@@ -103,63 +360,347 @@ class DataStore(object):
         return {'response': self._parse_record(self._fetch_and_delete_user(user, 'pending'),
                                                'pending')}
 
-    def put_user_to_pending(self, user, domain, days):
-        '''Put record into 'pending' table, returns generated uniq id.'''
+    @staticmethod
+    def _pending_record(user, domain, days):
+        '''Return record of pending user, with generated uniq id and expiration.'''
         from datetime import (datetime, timedelta)
         import uuid
         ttl = datetime.utcnow() + timedelta(days=2)
-        uniq = uuid.uuid4().hex
+        return {'email': user, 'domain': domain, 'days': int(round(days)),
+                'uuid': uuid.uuid4().hex, 'ttl': ttl.strftime('%s')}
+
+    def put_user_to_pending(self, user, domain, days):
+        '''Put record into 'pending' table, returns generated uniq id.'''
+        record = self._pending_record(user, domain, days)
         self._client.put_item(
             TableName=self._tables['pending'],
-            Item={
-                'email': {'S': user},
-                'domain': {'S': domain},
-                'uuid': {'S': uniq},
-                'days': {'N': str(int(round(days)))},
-                'ttl': {'N': ttl.strftime('%s')},
-            })
-        return {'response': 'user added successfully', 'uuid': uniq}
+            Item=self._to_item(record, 'pending'))
+        return {'response': 'user added successfully', 'uuid': record['uuid']}
+
+    def put_users_to_pending(self, records):
+        '''Put list of email, domain and days records into 'pending' table with BatchWriteItem.
+
+        Return the records with their generated uniq ids, emails must be unique.'''
+        records = [self._pending_record(record['email'], record['domain'], record['days'])
+                   for record in records]
+        for offset in range(0, len(records), BATCH_WRITE_SIZE):
+            self._batch_write([
+                ('pending', {'PutRequest': {'Item': self._to_item(record, 'pending')}})
+                for record in records[offset:offset + BATCH_WRITE_SIZE]])
+        return {'response': [{'email': record['email'], 'domain': record['domain'],
+                              'days': record['days'], 'uuid': record['uuid']}
+                             for record in records]}
 
     def put_user_to_users(self, user, domain, days, uuid):
         '''Put user into users table.'''
-        self._client.put_item(
-            TableName=self._tables['users'],
-            Item={
-                'email': {'S': user},
-                'domain': {'S': domain},
-                'uuid': {'S': uuid},
-                'days': {'N': str(int(round(days)))},
-            })
+        self._put_user(user, domain, uuid, str(int(round(days))), 'users')
         return {'response': 'user added successfully'}
 
+    def get_validated_users_page(self, cursor=None, page_size=None, segment=None,
+                                 total_segments=None):
+        '''Return dict with one page of validated users and the cursor of the next one.
+
+        The cursor is None after the last page, pages can be empty. With segment and
+        total_segments only that scan segment is returned.'''
+        try:
+            state = decode_cursor(cursor) or {}
+        except ValueError as err:
+            return {'errorMessage': str(err)}
+        kwargs = {
+            'TableName': self._tables['users'],
+            'Select': 'ALL_ATTRIBUTES',
+            'Limit': int(page_size or PAGE_SIZE),
+        }
+        if total_segments and int(total_segments) > 1:
+            kwargs['Segment'] = int(segment)
+            kwargs['TotalSegments'] = int(total_segments)
+        if state.get('key'):
+            kwargs['ExclusiveStartKey'] = state['key']
+        response = self._client.scan(**kwargs)
+        next_key = response.get('LastEvaluatedKey')
+        return {'response': [self._parse_record(item, 'users')
+                             for item in response.get('Items', [])],
+                'cursor': encode_cursor({'key': next_key} if next_key else None)}
+
+    def get_due_users_page(self, cursor=None, page_size=None, day=None):
+        '''Return dict with one page of users due to be checked and the cursor of the next one.
+
+        Day buckets, or only day if given, are queried one after the other, the cursor
+        carries those left.'''
+        try:
+            state = decode_cursor(cursor) or {'days': [day] if day else due_days()}
+        except ValueError as err:
+            return {'errorMessage': str(err)}
+        days = state['days']
+        response = self._query_due_day(days[0], int(page_size or PAGE_SIZE), state.get('key'))
+        next_key = response.get('LastEvaluatedKey')
+        if next_key:
+            next_state = {'days': days, 'key': next_key}
+        else:
+            next_state = {'days': days[1:]} if days[1:] else None
+        return {'response': [self._parse_record(item, 'users')
+                             for item in response.get('Items', [])],
+                'cursor': encode_cursor(next_state)}
+
+    def get_stale_users_page(self, cursor=None, page_size=None, segment=None,
+                             total_segments=None, before=None):
+        '''Return dict with one page of users due before the lookback and the next cursor.
+
+        These records, due before day 'before' (the oldest bucket queried by
+        get_due_users_page by default) or never scheduled, would not be checked anymore.'''
+        try:
+            state = decode_cursor(cursor) or {'before': before or due_days()[-1]}
+        except ValueError as err:
+            return {'errorMessage': str(err)}
+        kwargs = {
+            'TableName': self._tables['users'],
+            'Limit': int(page_size or PAGE_SIZE),
+            'FilterExpression': 'attribute_not_exists(#due_day) OR #due_day < :before',
+            'ExpressionAttributeNames': {'#due_day': 'due_day'},
+            'ExpressionAttributeValues': {':before': {'S': state['before']}},
+        }
+        if total_segments and int(total_segments) > 1:
+            kwargs['Segment'] = int(segment)
+            kwargs['TotalSegments'] = int(total_segments)
+        if state.get('key'):
+            kwargs['ExclusiveStartKey'] = state['key']
+        response = self._client.scan(**kwargs)
+        next_key = response.get('LastEvaluatedKey')
+        return {'response': [self._parse_record(item, 'users')
+                             for item in response.get('Items', [])],
+                'cursor': encode_cursor({'before': state['before'], 'key': next_key}
+                                        if next_key else None)}
+
+    def _update_schedule(self, update):
+        '''Store schedule update of user, return False if user is not subscribed anymore.'''
+        values = {':next': {'N': str(int(update['next_check_at']))},
+                  ':day': {'S': due_day(update['next_check_at'])}}
+        expression = 'SET next_check_at = :next, due_day = :day'
+        if update.get('not_after'):
+            values[':not_after'] = {'N': str(int(update['not_after']))}
+            expression += ', not_after = :not_after'
+        try:
+            self._client.update_item(
+                TableName=self._tables['users'],
+                Key={'email': {'S': update['email']}},
+                UpdateExpression=expression,
+                ConditionExpression='attribute_exists(email)',
+                ExpressionAttributeValues=values)
+        except self._client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def update_schedules(self, updates):
+        '''Store list of {'email', 'next_check_at', 'not_after'} checks schedule updates.'''
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=SCHEDULE_WORKERS) as pool:
+            updated = sum(pool.map(self._update_schedule, updates))
+        return {'response': '%d schedule(s) updated' % updated}
+
+    def backfill_schedule(self):
+        '''Make validated users without a schedule due to be checked today.'''
+        now = int(time())
+        updates = [{'email': record['email'], 'next_check_at': now}
+                   for record in self._iter_records('users') if not record.get('due_day')]
+        self.update_schedules(updates)
+        return {'response': '%d record(s) scheduled' % len(updates)}
+
     def validate_pending_user(self, user, uuid):
         '''Move user from pending to users table if uuid is valid, return True if found.'''
-        record = self._verify_user(user, uuid, 'pending')
+        record = self._delete_if_uuid(user, uuid, 'pending')
         if record:
-            self._fetch_and_delete_user(user, 'pending')
-            self._put_user(
-                record['email'], record['domain'], record['uuid'], record['days'],
-                'users')
+            # no condition needed: only the caller winning the conditional delete gets
+            # here, and the record must replace any previous subscription of the user
+            try:
+                self._put_user(
+                    record['email'], record['domain'], record['uuid'], record['days'],
+                    'users')
+            # pylint: disable=broad-except
+            except Exception:
+                # put the pending record back, so that validation can be retried
+                self._client.put_item(TableName=self._tables['pending'],
+                                      Item=self._to_item(record, 'pending'))
+                raise
             return {'response': 'user validation successful'}
         return {'errorMessage': 'user not found or wrong uuid'}
 
     def delete_validated_user(self, user, uuid):
         '''Delete user from valid users table if uuid is valid, return True if found.'''
-        record = self._verify_user(user, uuid, 'users')
-        if record:
-            self._fetch_and_delete_user(user, 'users')
+        if self._delete_if_uuid(user, uuid, 'users'):
             return {'response': 'user deletion successful'}
         return {'errorMessage': 'user not found or wrong uuid'}
 
-    def backup_tables(self):
-        '''Store data as JSON into S3 BACKUP_BUCKET.'''
-        return Backup('dynamodb-').persist({
-            'users': self.get_validated_users()['response'],
-            'pending': self.get_pending_users()['response'],
-        })
+    def backup_tables(self, mode=None):
+        '''Stream tables as gzip compressed JSON lines into S3 BACKUP_BUCKET.
+
+        Each line holds table and record. Incremental backups store only the records
+        changed since the previous backup, compared by content hash, plus 'deleted'
+        lines for removed ones, a new full backup is taken once the one they are based
+        on is FULL_BACKUP_INTERVAL old. Every backup writes a manifest listing the full
+        backup and the incremental ones to be applied on top of it, the latest manifest
+        is also copied to dynamodb-latest.manifest.json.'''
+        backup = Backup('dynamodb-')
+        now = int(time())
+        latest = backup.get_json('dynamodb-latest.manifest.json')
+        index = None
+        # manifests written before base_created was introduced are taken as full ones
+        if (mode or BACKUP_MODE) == 'incremental' and latest and \
+                now - latest.get('base_created', latest['created']) < FULL_BACKUP_INTERVAL:
+            index = backup.get_json(latest['index'])
+        full = index is None
+
+        writer = backup.writer(backup.key('.jsonl.gz', now))
+        new_index = {}
+        counts = {}
+        try:
+            for table in ('users', 'pending'):
+                hashes = new_index[table] = {}
+                previous = (index or {}).get(table, {})
+                changed = 0
+                for record in self._iter_records(table):
+                    digest = hashes[record.get('email')] = record_hash(record)
+                    if full or previous.get(record.get('email')) != digest:
+                        writer.write({'table': table, 'record': record})
+                        changed += 1
+                deleted = [email for email in previous if email not in hashes]
+                for email in deleted:
+                    writer.write({'table': table, 'deleted': email})
+                counts[table] = {'records': len(hashes), 'changed': changed,
+                                 'deleted': len(deleted)}
+            size = writer.close()
+        except Exception:
+            writer.abort()
+            raise
+
+        manifest = {
+            'created': now,
+            'type': 'full' if full else 'incremental',
+            'snapshot': writer.key,
+            'index': backup.key('.index.json.gz', now),
+            'base': writer.key if full else latest['base'],
+            'base_created': now if full else latest.get('base_created', latest['created']),
+            'incrementals': [] if full else latest['incrementals'] + [writer.key],
+            'counts': counts,
+            'bytes': size,
+        }
+        backup.put_json(manifest['index'], new_index, compress=True)
+        manifest_key = backup.key('.manifest.json', now)
+        backup.put_json(manifest_key, manifest)
+        backup.put_json('dynamodb-latest.manifest.json', manifest)
+        LOGGER.info('%s backup stored to %s, %d bytes', manifest['type'], writer.key, size)
+        return {'response': 's3://%s/%s' % (BACKUP_BUCKET, writer.key),
+                'manifest': 's3://%s/%s' % (BACKUP_BUCKET, manifest_key),
+                'type': manifest['type'],
+                'counts': counts}
+
+    def _to_item(self, record, table):
+        '''Return DynamoDB item of parsed record, reverse of _parse_record.'''
+        return dict((key_name, {key_type: str(record[key_name])})
+                    for key_name, key_type in self._tables_keys[table]
+                    if record.get(key_name) is not None)
+
+    def _batch_write(self, requests):
+        '''Write list of (table, request) with BatchWriteItem, retrying UnprocessedItems.'''
+        from time import sleep
+        items = {}
+        for table, request in requests:
+            items.setdefault(self._tables[table], []).append(request)
+        for attempt in range(RESTORE_MAX_ATTEMPTS):
+            items = self._client.batch_write_item(RequestItems=items).get('UnprocessedItems')
+            if not items:
+                return len(requests)
+            sleep(min(0.05 * 2 ** attempt, 5))  # exponential backoff on throttling
+        raise RuntimeError('%d items still unprocessed after %d attempts' % (
+            sum(len(reqs) for reqs in items.values()), RESTORE_MAX_ATTEMPTS))
+
+    def restore_backup(self, key=None, workers=None):
+        '''Load backup stored in BACKUP_BUCKET key into tables, latest backup by default.
+
+        Records are written in BatchWriteItem chunks by a pool of threads, each
+        snapshot of a manifest is fully written before the next one is applied.'''
+        from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor, wait)
+        key = key or 'dynamodb-latest.manifest.json'
+        workers = workers or RESTORE_WORKERS
+        counts = {'users': 0, 'pending': 0, 'deleted': 0}
+        started = time()
+        state = {'written': 0, 'logged': 0}
+
+        def collect(futures):
+            for future in futures:
+                state['written'] += future.result()
+            if state['written'] - state['logged'] >= RESTORE_PROGRESS_EVERY:
+                state['logged'] = state['written']
+                LOGGER.info('restored %d items, %.0f items/s', state['written'],
+                            state['written'] / max(time() - started, 0.001))
+
+        backup = Backup('dynamodb-')
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for snapshot in backup.snapshots(key):
+                pending = set()
+                chunk = []
+                for line in backup.iter_lines(snapshot):
+                    table = line['table']
+                    if 'deleted' in line:
+                        request = {'DeleteRequest': {'Key': {'email': {'S': line['deleted']}}}}
+                        counts['deleted'] += 1
+                    else:
+                        request = {'PutRequest': {'Item': self._to_item(line['record'], table)}}
+                        counts[table] += 1
+                    chunk.append((table, request))
+                    if len(chunk) == BATCH_WRITE_SIZE:
+                        pending.add(pool.submit(self._batch_write, chunk))
+                        chunk = []
+                    if len(pending) >= workers * 2:  # keep memory bounded
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                if chunk:
+                    pending.add(pool.submit(self._batch_write, chunk))
+                collect(wait(pending).done)
+
+        elapsed = time() - started
+        LOGGER.info('restored %d items from %s in %.1fs', state['written'], key, elapsed)
+        return {'response': counts,
+                'seconds': round(elapsed, 3),
+                'items_per_second': round(state['written'] / max(elapsed, 0.001), 1)}
 
 
 # pylint: disable=unused-argument
 def lambda_main(event, context):
     '''Lambda entry point.'''
     return lambda_main_wrapper(event, DataStore)
+
+
+def import_file(path, fmt=None):
+    '''Import subscriptions from CSV or JSON Lines file, '-' for STDIN.'''
+    from sys import stdin
+    from sslnotifyme.queue import mail_queue
+    from sslnotifyme.subscriptions import import_subscriptions
+
+    def put_pending(records):
+        return DataStore().put_users_to_pending(records)['response']
+
+    if path == '-':
+        return import_subscriptions(stdin, put_pending, mail_queue(), fmt)
+    with open(path, newline='') as lines:
+        return import_subscriptions(lines, put_pending, mail_queue(), fmt)
+
+
+def print_usage():
+    '''Print usage to STDOUT.'''
+    print('usage: %s backup [full|incremental] | restore [s3_key] | backfill | '
+          'import file|- [csv|jsonl]' % argv[0])
+
+
+if __name__ == '__main__':
+    if len(argv) == 1:
+        print_usage()
+    elif argv[1] == 'backup':
+        print(json.dumps(DataStore().backup_tables(*argv[2:3])))
+    elif argv[1] == 'restore':
+        print(json.dumps(DataStore().restore_backup(*argv[2:3])))
+    elif argv[1] == 'backfill':
+        print(json.dumps(DataStore().backfill_schedule()))
+    elif argv[1] == 'import' and len(argv) > 2:
+        print(json.dumps(import_file(*argv[2:4]), indent=2))
+    else:
+        print_usage()
@@ -1,25 +1,88 @@
 '''email sending function.'''
+import json
 from os import environ
-import boto3
-from botocore.exceptions import ClientError
-from sslnotifyme import (lambda_main_wrapper, APPNAME, DOMAINNAME, FRONTEND_URL, LOGGER)
+from time import (sleep, time)
+from sslnotifyme import (lambda_main_wrapper, aws_client, logs, APPNAME, DOMAINNAME,
+                         FRONTEND_URL, LOGGER, RECORD_LOGGER)
+from sslnotifyme.queue import (mail_queue, SQS_BATCH_SIZE)
+from sslnotifyme.ratelimit import (TokenBucket, backoff_delay)
 
 FROM_EMAIL = environ.get('FROM_EMAIL', "%s <noreply@%s>" % (DOMAINNAME, DOMAINNAME))
 FEEDBACK_EMAIL = environ.get('FEEDBACK_EMAIL', "feedback@%s" % DOMAINNAME)
 REPORT_TO_EMAIL = environ.get('REPORT_TO_EMAIL', 'report@%s' % DOMAINNAME)
+# Maximum number of concurrent mailer invocations (its reserved concurrency), each one
+# sends at most its share of the SES maximum send rate
+MAILER_CONCURRENCY = int(environ.get('MAILER_CONCURRENCY', 1))
+# Attempts of each email throttled by SES, retried with jittered exponential backoff
+SES_MAX_ATTEMPTS = int(environ.get('SES_MAX_ATTEMPTS', 4))
+SES_RETRY_BASE = float(environ.get('SES_RETRY_BASE', 1))
+# Mailer commands accepted from the mail queue
+QUEUED_COMMANDS = ('send_activation_link', 'send_alert', 'send_feedback', 'send_report')
+
+
+def client_error():
+    '''Return botocore ClientError, imported only when handling exceptions.'''
+    from botocore.exceptions import ClientError
+    return ClientError
+
+
+def is_throttling(err):
+    '''Return True if SES ClientError is due to the sending rate limits.'''
+    error = err.response.get('Error', {})
+    return error.get('Code') == 'Throttling' or \
+        'rate exceeded' in error.get('Message', '').lower()
 
 
 def send_ses_email(send_to, subject, body, tag='notag'):
-    '''Send SES email.'''
-    boto3.client('ses').send_email(
-        Source=FROM_EMAIL,
-        Destination={'ToAddresses': [send_to]},
-        Message={'Subject': {'Data': subject},
-                 'Body': {'Text': {'Data': body}}},
-        # https://docs.aws.amazon.com/ses/latest/DeveloperGuide/monitor-sending-activity.html
-        ConfigurationSetName=APPNAME,
-        Tags=[{'Name': 'emailType',
-               'Value': '%s%s' % (APPNAME, tag)}])
+    '''Send SES email, retrying up to SES_MAX_ATTEMPTS times when throttled.'''
+    for attempt in range(1, SES_MAX_ATTEMPTS + 1):
+        try:
+            aws_client('ses').send_email(
+                Source=FROM_EMAIL,
+                Destination={'ToAddresses': [send_to]},
+                Message={'Subject': {'Data': subject},
+                         'Body': {'Text': {'Data': body}}},
+                # https://docs.aws.amazon.com/ses/latest/DeveloperGuide/monitor-sending-activity.html
+                ConfigurationSetName=APPNAME,
+                Tags=[{'Name': 'emailType',
+                       'Value': '%s%s' % (APPNAME, tag)}])
+            return
+        except client_error() as err:
+            if not is_throttling(err) or attempt == SES_MAX_ATTEMPTS:
+                raise
+            LOGGER.warning('sending email to %s throttled, retrying', send_to)
+            sleep(backoff_delay(attempt, SES_RETRY_BASE))
+
+
+def ses_max_send_rate():
+    '''Return number of emails per second each mailer invocation can send.
+
+    SES maximum send rate is shared by up to MAILER_CONCURRENCY concurrent invocations.'''
+    return max(1, int(aws_client('ses').get_send_quota()['MaxSendRate'] / MAILER_CONCURRENCY))
+
+
+def run_queued(message):
+    '''Run the Mailer command of queued message, return False if it must be retried.
+
+    Invalid messages are logged and discarded, retrying them would fail again.'''
+    action = message.get('action') if isinstance(message, dict) else None
+    if not action or action[0] not in QUEUED_COMMANDS:
+        LOGGER.error('discarding invalid queued message %s', message)
+        logs.summarize(skipped=1)
+        return True
+    try:
+        output = getattr(Mailer, action[0])(*action[1:])
+    # pylint: disable=broad-except
+    except Exception:
+        LOGGER.exception('exception processing queued command %s', action[0])
+        logs.summarize(errors=1)
+        return False
+    return not (isinstance(output, dict) and 'errorMessage' in output)
+
+
+def unsubscribe_link(email, uuid):
+    '''Return link to unsubscribe email from alerts.'''
+    return '%s/unsubscribe.html?user=%s&uuid=%s' % (FRONTEND_URL, email, uuid)
 
 
 class Mailer(object):
@@ -28,7 +91,7 @@ class Mailer(object):
     @staticmethod
     def send_alert(email, domain, message, uuid):
         '''Send alert email via SES.'''
-        link = '%s/unsubscribe.html?user=%s&uuid=%s' % (FRONTEND_URL, email, uuid)
+        link = unsubscribe_link(email, uuid)
         body = '''%s
 
 You will receive this alert every day until a new certificate has been issued to replace the current one.
@@ -38,15 +101,72 @@ To disable the alert, unsubscribe following this link: %s
 -- 
 %s
 ''' % (message, link, DOMAINNAME)
+        logs.summarize(records=1, alerts=1)
         try:
-            LOGGER.info('sending alert message for domain %s to %s', domain, email)
+            RECORD_LOGGER.info('sending alert message for domain %s to %s', domain, email)
             send_ses_email(email, 'SSL alert for domain %s' % domain, body, 'ExpiryAlert')
             return {'response': 'email sent successfully'}
-        except ClientError:
+        except client_error():
             LOGGER.exception('exception sending alert email to %s', email)
+            logs.summarize(errors=1)
             return {'errorMessage': 'internal error delivering email to the '
                                     'email system, please try again later'}
 
+    @staticmethod
+    def send_alert_digest(email, alerts):
+        '''Send one email via SES with all the alerts for the given recipient.
+
+        alerts is a list of dicts with domain, message and uuid keys.'''
+        if len(alerts) == 1:
+            alert = alerts[0]
+            return Mailer.send_alert(email, alert['domain'], alert['message'], alert['uuid'])
+
+        sections = '\n\n'.join('''%s
+
+To disable the alert for domain %s, unsubscribe following this link: %s''' % (
+            alert['message'], alert['domain'], unsubscribe_link(email, alert['uuid']))
+                                for alert in alerts)
+        body = '''%s
+
+You will receive these alerts every day until new certificates have been issued to replace the current ones.
+
+-- 
+%s
+''' % (sections, DOMAINNAME)
+        logs.summarize(records=1, alerts=len(alerts))
+        try:
+            RECORD_LOGGER.info('sending alert digest message for %d domains to %s',
+                               len(alerts), email)
+            send_ses_email(email, 'SSL alert for %d domains' % len(alerts), body, 'ExpiryAlert')
+            return {'response': 'email sent successfully'}
+        except client_error():
+            LOGGER.exception('exception sending alert digest email to %s', email)
+            logs.summarize(errors=1)
+            return {'errorMessage': 'internal error delivering email to the '
+                                    'email system, please try again later'}
+
+    @staticmethod
+    def send_alert_digests(digests):
+        '''Send alert digests via SES, dict of alerts lists keyed by recipient.
+
+        Recipients are processed in batches of this invocation share of the SES max send
+        rate, each batch lasting at least one second to respect the SES sending limits.'''
+        rate = ses_max_send_rate()
+        recipients = sorted(digests)
+        failed = []
+        for offset in range(0, len(recipients), rate):
+            start = time()
+            for email in recipients[offset:offset + rate]:
+                if 'errorMessage' in Mailer.send_alert_digest(email, digests[email]):
+                    failed.append(email)
+            elapsed = time() - start
+            if offset + rate < len(recipients) and elapsed < 1:
+                sleep(1 - elapsed)
+
+        LOGGER.info('%d alert digest(s) sent, %d failed', len(recipients) - len(failed),
+                    len(failed))
+        return {'response': {'sent': len(recipients) - len(failed), 'failed': failed}}
+
     @staticmethod
     def send_activation_link(email, domain, days, uuid):
         '''Send link to email address via SES.'''
@@ -63,12 +183,14 @@ To enable the service, please verify your email address clicking on the followin
 -- 
 %s
 ''' % (domain, days, link, DOMAINNAME)
+        logs.summarize(records=1)
         try:
-            LOGGER.info('sending activation link %s for domain %s', link, domain)
+            RECORD_LOGGER.info('sending activation link %s for domain %s', link, domain)
             send_ses_email(email, 'Confirm subscription to %s' % DOMAINNAME, body, 'ValidationLink')
             return {'response': 'Please check your emails to confirm your subscription'}
-        except ClientError:
+        except client_error():
             LOGGER.exception('exception sending confirmation email to %s', email)
+            logs.summarize(errors=1)
             return {'errorMessage': 'Error sending confirmation email, '
                                     'please ensure your email address is valid and that '
                                     'your mailbox is not full'}
@@ -80,7 +202,7 @@ To enable the service, please verify your email address clicking on the followin
             LOGGER.info('sending feedback mail')
             send_ses_email(FEEDBACK_EMAIL, 'Form feedback entry', content, tag='Feedback')
             return {'response': 'thank you for your submission'}
-        except ClientError:
+        except client_error():
             LOGGER.exception('exception sending feedback email')
             return {'errorMessage': 'Error sending feedback email, '
                                     'please try later'}
@@ -92,12 +214,60 @@ To enable the service, please verify your email address clicking on the followin
             LOGGER.info('sending report mail')
             send_ses_email(REPORT_TO_EMAIL, 'Daily report', report, tag='DailyReport')
             return {'response': 'report sent via email'}
-        except ClientError:
+        except client_error():
             LOGGER.exception('exception sending feedback email')
             return {'errorMessage': 'Internal error sending report email'}
 
+    @staticmethod
+    def process_records(records):
+        '''Run commands of mail queue messages delivered by SQS event source.
+
+        Return the failed ones as batchItemFailures, so that only those are redelivered.'''
+        bucket = TokenBucket(ses_max_send_rate())
+        failures = []
+        for record in records:
+            bucket.acquire()
+            try:
+                message = json.loads(record['body'])
+            except ValueError:
+                message = None
+            if not run_queued(message):
+                failures.append({'itemIdentifier': record['messageId']})
+
+        LOGGER.info('%d queued message(s) processed, %d failed', len(records) - len(failures),
+                    len(failures))
+        return {'batchItemFailures': failures}
+
+    @staticmethod
+    def drain_queue(max_messages=None):
+        '''Run commands of mail queue messages until it's empty, or max_messages received.
+
+        Failed messages are released to be retried, local queue backends give up on
+        them after MAIL_QUEUE_MAX_RECEIVES attempts.'''
+        queue = mail_queue()
+        bucket = TokenBucket(ses_max_send_rate())
+        processed = failed = 0
+        while max_messages is None or processed + failed < max_messages:
+            batch = queue.receive(SQS_BATCH_SIZE if max_messages is None else
+                                  min(SQS_BATCH_SIZE, max_messages - processed - failed))
+            if not batch:
+                break
+            for message in batch:
+                bucket.acquire()
+                if run_queued(message['body']):
+                    queue.delete(message['receipt'])
+                    processed += 1
+                else:
+                    queue.release(message['receipt'])
+                    failed += 1
+
+        LOGGER.info('%d queued message(s) processed, %d failed', processed, failed)
+        return {'response': {'processed': processed, 'failed': failed}}
+
 
 # pylint: disable=unused-argument
 def lambda_main(event, context):
-    '''Lambda entry point.'''
+    '''Lambda entry point, SQS events deliver mail queue messages.'''
+    if 'Records' in event:
+        return lambda_main_wrapper({'action': ['process_records', event['Records']]}, Mailer)
     return lambda_main_wrapper(event, Mailer)
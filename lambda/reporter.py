@@ -1,74 +1,208 @@
 '''Lambda report of non-expected CloudWatchLogs entry.'''
+from calendar import timegm
+from concurrent.futures import ThreadPoolExecutor
 from datetime import (datetime, timedelta)
+from os import environ
 from re import match
 from sys import argv
-import boto3
-from sslnotifyme import (APPNAME, BOUNCES_BUCKET, LOGGER, lambda_mailer, lambda_main_wrapper)
-
-
-# We want only the last 25 hours worth of logs
-START_TIME = datetime.utcnow() - timedelta(hours=25)
-
+from sslnotifyme import (APPNAME, BOUNCES_BUCKET, LOGGER, aws_client, lambda_mailer,
+                         lambda_main_wrapper)
+from sslnotifyme.checkpoint import S3CheckpointStore
+from sslnotifyme.logs import parse_summary
+
+
+# Without a checkpoint, we want only the last 25 hours worth of logs
+DEFAULT_LOOKBACK = timedelta(hours=25)
+# CloudWatch Logs filter pattern matching the events worth reporting and the invocations
+# summary lines, applied server side
+REPORT_FILTER_PATTERN = environ.get(
+    'REPORT_FILTER_PATTERN',
+    '?ERROR ?WARNING ?CRITICAL ?Traceback ?Exception ?error ?"Task timed out" ?"_summary"')
+# Each report window overlaps the previous one by this many milliseconds, so that late
+# ingested events are not lost, the events already reported are skipped
+REPORT_OVERLAP_MS = int(environ.get('REPORT_OVERLAP_MS', 15 * 60 * 1000))
+# Number of log groups fetched concurrently
+REPORTER_WORKERS = int(environ.get('REPORTER_WORKERS', 8))
+# BACKUP_BUCKET key of the high-water marks saved after each successful report
+REPORT_CHECKPOINT_KEY = environ.get('REPORT_CHECKPOINT_KEY', 'reporter-checkpoint.json')
+# Log events not worth reporting: lambda runtime lines, INFO logs, EMF metrics lines and
+# invocations summary lines, these are aggregated instead
+REPORT_EXCLUDE_REGEXP = r'^(START |END |REPORT |\[INFO\]|\{"_aws"|\{"_summary")'
+# strftime format of BOUNCES_BUCKET keys prefix, if keys are date-prefixed
+BOUNCES_KEY_DATE_FORMAT = environ.get('BOUNCES_KEY_DATE_FORMAT', '')
+
+
+def epoch_ms(moment):
+    '''Return milliseconds since UNIX epoch of naive UTC datetime.'''
+    return timegm(moment.utctimetuple()) * 1000
+
+
+def checkpoint_store():
+    '''Return store of the reporter checkpoint.'''
+    return S3CheckpointStore(REPORT_CHECKPOINT_KEY)
+
+
+def get_log_group_names():
+    '''Return names of the application lambdas CloudWatch Logs groups.'''
+    paginator = aws_client("logs").get_paginator('describe_log_groups')
+    return [group["logGroupName"]
+            for page in paginator.paginate(logGroupNamePrefix="/aws/lambda/%s_" % APPNAME)
+            for group in page.get('logGroups', [])]
+
+
+def get_log_events(group_name, filter_pattern=None, start=None, end=None):
+    '''Return list of events of log group in [start, end) milliseconds, following all the pages.'''
+    kwargs = {
+        'logGroupName': group_name,
+        'startTime': start or epoch_ms(datetime.utcnow() - DEFAULT_LOOKBACK),
+    }
+    if end:
+        kwargs['endTime'] = end - 1  # endTime is inclusive
+    if filter_pattern:
+        kwargs['filterPattern'] = filter_pattern
+
+    events = []
+    while True:
+        response = aws_client("logs").filter_log_events(**kwargs)
+        events.extend(response.get('events', []))
+        if not response.get('nextToken'):
+            return events
+        kwargs['nextToken'] = response['nextToken']
+
+
+def generate_logs(filter_pattern=None, starts=None, end=None):
+    '''Return generator to fetch CloudWatch Logs lambda events, groups fetched concurrently.
+
+    starts is an optional dict of start times in milliseconds keyed by group name,
+    when given only its groups are fetched.'''
+    group_names = sorted(starts) if starts is not None else get_log_group_names()
+    if not group_names:
+        return
+    starts = starts or {}
+
+    def fetch(name):
+        return get_log_events(name, filter_pattern, starts.get(name), end)
+
+    with ThreadPoolExecutor(max_workers=REPORTER_WORKERS) as pool:
+        for group_name, events in zip(group_names, pool.map(fetch, group_names)):
+            for event in events:
+                yield (group_name, event)
+
+
+def generate_valid_logs(exclude_regexp, filter_pattern=None, starts=None, end=None):
+    '''Generate logs from raw CloudWatch logs generator, filter out the given regexp.
+
+    filter_pattern is applied by CloudWatch Logs, exclude_regexp to the returned events.'''
+    for group, event in generate_logs(filter_pattern, starts, end):
+        if not match(exclude_regexp, event['message']):
+            yield (group, event)
 
-def generate_logs():
-    '''Return generator to fetch CloudWatch Logs lambda events.'''
-    prefix = "/aws/lambda/%s_" % APPNAME
-    client = boto3.client("logs")
 
-    groups = client.describe_log_groups(logGroupNamePrefix=prefix).get('logGroups')
-    group_names = [group["logGroupName"] for group in groups]
+def event_id(event):
+    '''Return unique id of CloudWatch Logs event.'''
+    return event.get('eventId') or '%d:%s' % (event['timestamp'], event['message'])
 
-    start_epoch = int(START_TIME.strftime('%s')) * 1000  # APIs expect milliseconds
 
-    for group_name in group_names:
-        response = client.filter_log_events(
-            logGroupName=group_name,
-            startTime=start_epoch,
-        )
-        for event in response['events']:
-            yield (group_name, event)
+def summary_report(totals):
+    '''Return printable report of the summary counts aggregated by group and command.'''
+    report = []
+    for (group, command), counts in sorted(totals.items()):
+        invocations = counts.pop('invocations')
+        report.append('%s %s: %d invocation(s), %s\n' % (
+            group, command, invocations,
+            ', '.join('%s %d' % (name, value) for name, value in sorted(counts.items()))))
+    return report
 
 
-def generate_valid_logs(exclude_regexp):
-    '''Generate logs from raw CloudWatch logs generator, filter out the given regexp.'''
-    for group, event in generate_logs():
-        if not match(exclude_regexp, event['message']):
-            yield (group, event)
+def generate_bucket_objects(since=None):
+    '''Return generator of BOUNCES_BUCKET objects newer then since (naive UTC datetime).
 
+    With date-prefixed keys, listing starts after the prefix of the since date.'''
+    since = since or datetime.utcnow() - DEFAULT_LOOKBACK
+    kwargs = {'Bucket': BOUNCES_BUCKET}
+    if BOUNCES_KEY_DATE_FORMAT:
+        kwargs['StartAfter'] = since.strftime(BOUNCES_KEY_DATE_FORMAT)
 
-def generate_bucket_objects():
-    '''Return generator of BOUNCES_BUCKET objects newer then START_TIME.'''
-    objs = boto3.client('s3').list_objects(Bucket=BOUNCES_BUCKET).get('Contents', [])
-    for obj in objs:
-        if obj['LastModified'].replace(tzinfo=None) > START_TIME:
-            yield obj
+    paginator = aws_client('s3').get_paginator('list_objects_v2')
+    for page in paginator.paginate(**kwargs):
+        for obj in page.get('Contents', []):
+            if obj['LastModified'].replace(tzinfo=None) > since:
+                yield obj
 
 
 class Reporter(object):
     '''Reporter object class.'''
 
     @staticmethod
-    def get_report(exclude_regexp):
-        '''Return printable report of interesting CloudWatch log events.'''
-        report = ''
-
-        for group, entry in generate_valid_logs(exclude_regexp):
-            report += '%s %d %s' % (group, entry["timestamp"], entry["message"])
+    def get_incremental_report(exclude_regexp, filter_pattern=None, checkpoint=None):
+        '''Return printable report of what happened after checkpoint, and the new checkpoint.
+
+        The checkpoint stores, for each log group, the end of the time window already
+        reported and the ids of the events reported in the last REPORT_OVERLAP_MS of it,
+        fetched again by the next report to catch late ingested events, and the time
+        of the last bounces check.
+
+        Invocations summary lines are aggregated per log group and command, reported
+        before the other events.'''
+        checkpoint = checkpoint or {}
+        end = epoch_ms(datetime.utcnow())
+        report = []
+
+        ends = checkpoint.get('logs', {})
+        reported = checkpoint.get('reported', {})
+        starts = dict((group, ends[group] - REPORT_OVERLAP_MS if ends.get(group) else None)
+                      for group in get_log_group_names())
+        new_checkpoint = {'logs': dict((group, end) for group in starts),
+                          'reported': dict((group, []) for group in starts),
+                          'bounces': {}}
+        totals = {}
+        for group, entry in generate_logs(filter_pattern, starts, end):
+            summary = parse_summary(entry['message'])
+            if not summary and match(exclude_regexp, entry['message']):
+                continue
+            entry_id = event_id(entry)
+            if entry_id in reported.get(group, ()):
+                continue
+            if entry['timestamp'] >= end - REPORT_OVERLAP_MS:
+                new_checkpoint['reported'][group].append(entry_id)
+            if summary:
+                command, counts = summary
+                total = totals.setdefault((group, command), {'invocations': 0})
+                total['invocations'] += 1
+                for name, value in counts.items():
+                    total[name] = total.get(name, 0) + value
+            else:
+                report.append('%s %d %s' % (group, entry["timestamp"], entry["message"]))
+        report[:0] = summary_report(totals)
+
+        since = checkpoint.get('bounces', {}).get('since')
+        for obj in generate_bucket_objects(datetime.utcfromtimestamp(since) if since else None):
+            report.append('Found new email bounce in %s bucket: %s\n' % (BOUNCES_BUCKET,
+                                                                         obj.get('Key')))
+        new_checkpoint['bounces']['since'] = end // 1000
+
+        return ''.join(report), new_checkpoint
 
-        for obj in generate_bucket_objects():
-            report += 'Found new email bounce in %s bucket: %s\n' % (BOUNCES_BUCKET,
-                                                                     obj.get('Key'))
-
-        return report
+    @staticmethod
+    def get_report(exclude_regexp, filter_pattern=None):
+        '''Return printable report of interesting CloudWatch log events.'''
+        return Reporter.get_incremental_report(exclude_regexp, filter_pattern)[0]
 
     @staticmethod
     def send_report():
-        '''Get a report from CloudWatch logs and S3, send via email.'''
-        report = Reporter.get_report(exclude_regexp=r'^(START |END |REPORT |\[INFO\])')
+        '''Get a report from CloudWatch logs and S3 since last run, send via email.'''
+        store = checkpoint_store()
+        report, checkpoint = Reporter.get_incremental_report(
+            exclude_regexp=REPORT_EXCLUDE_REGEXP,
+            filter_pattern=REPORT_FILTER_PATTERN,
+            checkpoint=store.load())
         if report:
-            return lambda_mailer('send_report', report)
-        LOGGER.info('empty report')
-        return {'response': 'empty report'}
+            output = lambda_mailer('send_report', report)
+        else:
+            LOGGER.info('empty report')
+            output = {'response': 'empty report'}
+        store.save(checkpoint)
+        return output
 
 
 # pylint: disable=unused-argument
@@ -86,6 +220,6 @@ if __name__ == '__main__':
     if len(argv) == 1:
         print_usage()
     elif argv[1] == 'print':
-        print(Reporter.get_report(exclude_regexp=r'^(START |END |REPORT )'))
+        print(Reporter.get_report(exclude_regexp=r'^(START |END |REPORT |\{"_aws")'))
     else:
         print_usage()
@@ -2,7 +2,9 @@
 import json
 import logging
 from os import environ
-import boto3
+from threading import Lock
+
+from .logs import RECORD_LOGGER
 
 DOMAINNAME = environ.get('DOMAINNAME', 'sslnotify.me')
 APPNAME = DOMAINNAME.replace(".", "")
@@ -13,32 +15,143 @@ BACKUP_BUCKET = "%s-backend-backup" % APPNAME
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
+# botocore configuration shared by all the AWS clients
+AWS_MAX_POOL_CONNECTIONS = int(environ.get('AWS_MAX_POOL_CONNECTIONS', 25))
+AWS_MAX_ATTEMPTS = int(environ.get('AWS_MAX_ATTEMPTS', 3))
+AWS_CONNECT_TIMEOUT = float(environ.get('AWS_CONNECT_TIMEOUT', 5))
+AWS_READ_TIMEOUT = float(environ.get('AWS_READ_TIMEOUT', 60))
+
+# Clients are cached at module level, hence reused by warm lambda containers
+_CLIENTS = {}
+# boto3 default session is not thread safe, clients must be created holding this lock
+_CLIENTS_LOCK = Lock()
+
+
+def aws_client(service):
+    '''Return boto3 client for service, created on first use and cached afterwards.
+
+    Clients are thread safe, they can be shared by multiple threads, and instrumented
+    to record their API calls metrics.
+    boto3 is imported here to keep it out of the lambdas cold start when not needed.'''
+    client = _CLIENTS.get(service)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(service)
+            if client is None:
+                import boto3
+                from botocore.config import Config
+                from .metrics import instrument_client
+                client = _CLIENTS[service] = instrument_client(boto3.client(service, config=Config(
+                    max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+                    retries={'max_attempts': AWS_MAX_ATTEMPTS},
+                    connect_timeout=AWS_CONNECT_TIMEOUT,
+                    read_timeout=AWS_READ_TIMEOUT)))
+    return client
+
+
+def reset_aws_clients():
+    '''Drop cached clients, next aws_client calls will create new ones.'''
+    with _CLIENTS_LOCK:
+        _CLIENTS.clear()
+
+
+class LambdaTransport(object):
+    '''Invoke lambdas via AWS Lambda APIs.'''
+
+    @staticmethod
+    def invoke(lambda_name, payload, blocking):
+        '''Invoke lambda with JSON payload, return JSON response if blocking.'''
+        result = aws_client('lambda').invoke(
+            FunctionName="%s_%s" % (APPNAME, lambda_name),
+            InvocationType='RequestResponse' if blocking else 'Event',
+            Payload=payload)
+        if blocking:
+            return result['Payload'].read()
+        return None
+
+
+class LocalTransport(object):
+    '''Dispatch to the lambda module entry point in the same process.
+
+    Payloads are still serialized to JSON so that the semantics don't change, async
+    invocations are executed synchronously and their errors logged.'''
+
+    @staticmethod
+    def invoke(lambda_name, payload, blocking):
+        '''Call lambda_main of the module serving lambda_name, return JSON response if blocking.'''
+        from importlib import import_module
+        module = import_module(LAMBDA_MODULES[lambda_name])
+        if blocking:
+            return json.dumps(module.lambda_main(json.loads(payload), None))
+        try:
+            module.lambda_main(json.loads(payload), None)
+        # pylint: disable=broad-except
+        except Exception:
+            LOGGER.exception('exception processing local async invocation of %s', lambda_name)
+        return None
+
+
+TRANSPORTS = {
+    'lambda': LambdaTransport,
+    'local': LocalTransport,
+}
+# Modules implementing each lambda, needed by the local transport
+LAMBDA_MODULES = {
+    'checker': 'checker',
+    'cron': 'cron',
+    'db': 'data',
+    'mailer': 'mailer',
+    'reporter': 'reporter',
+}
+# 'lambda' to invoke other lambdas via AWS APIs, 'local' to run them in the same process
+LAMBDA_TRANSPORT = environ.get('LAMBDA_TRANSPORT', 'lambda')
+
+
+def _transport():
+    '''Return transport selected via LAMBDA_TRANSPORT.'''
+    return TRANSPORTS[LAMBDA_TRANSPORT]
+
+
+def _invoke_lambda(lambda_name, args, blocking, idempotency_key=None):
+    '''Invoke lambda via the configured transport, recording duration and payload sizes.
+
+    With idempotency_key the action is skipped if already completed by the target. The
+    payload is enveloped in the compact wire format if WIRE_ENVELOPE is enabled.'''
+    from . import (metrics, wire)
+    dimensions = {'Function': lambda_name, 'Command': str(args[0]) if args else '',
+                  'InvocationType': 'RequestResponse' if blocking else 'Event'}
+    event = {"action": args}
+    if idempotency_key:
+        event['idempotency_key'] = idempotency_key
+    payload = json.dumps(wire.request_event(event))
+    metrics.record('LambdaPayloadSize', len(payload), 'Bytes', **dimensions)
+    with metrics.timed('LambdaInvokeDuration', **dimensions):
+        result = _transport().invoke(lambda_name, payload, blocking)
+    if blocking:
+        metrics.record('LambdaResponseSize', len(result), 'Bytes', **dimensions)
+    return result
+
 
 def _invoke_lambda_blocking(lambda_name, *args):
     '''Invoke blocking lambda, return payload.'''
-    LOGGER.info('invoking lambda_blocking %s', lambda_name)
-    result = boto3.client('lambda').invoke(
-        FunctionName="%s_%s" % (APPNAME, lambda_name),
-        InvocationType='RequestResponse',
-        Payload=json.dumps({"action": args}))
-    LOGGER.info('lambda_blocking %s invoked succesfully', lambda_name)
-    return json.loads(result['Payload'].read())
+    from . import wire
+    RECORD_LOGGER.info('invoking lambda_blocking %s', lambda_name)
+    result = _invoke_lambda(lambda_name, args, True)
+    RECORD_LOGGER.info('lambda_blocking %s invoked succesfully', lambda_name)
+    return wire.decode(json.loads(result))
 
 
-def _invoke_lambda_async(lambda_name, *args):
+def _invoke_lambda_async(lambda_name, *args, idempotency_key=None):
     '''Invoke async lambda mailer.'''
-    LOGGER.info('invoking lambda_async %s', lambda_name)
-    boto3.client('lambda').invoke(
-        FunctionName="%s_%s" % (APPNAME, lambda_name),
-        InvocationType='Event',
-        Payload=json.dumps({"action": args}))
-    LOGGER.info('lambda_async %s invoked succesfully', lambda_name)
+    RECORD_LOGGER.info('invoking lambda_async %s', lambda_name)
+    _invoke_lambda(lambda_name, args, False, idempotency_key)
+    RECORD_LOGGER.info('lambda_async %s invoked succesfully', lambda_name)
     return {'response': 'lambda %s invoked succesfully' % lambda_name}
 
 
-def lambda_mailer(*args):
+def lambda_mailer(*args, idempotency_key=None):
     '''Invoke async lambda mailer.'''
-    return _invoke_lambda_async('mailer', *args)
+    return _invoke_lambda_async('mailer', *args, idempotency_key=idempotency_key)
 
 
 def lambda_mailer_blocking(*args):
@@ -51,13 +164,46 @@ def lambda_db(*args):
     return _invoke_lambda_blocking('db', *args)
 
 
-def lambda_checker(*args):
+def lambda_checker(*args, idempotency_key=None):
     '''Invoke async lambda checker.'''
-    return _invoke_lambda_async('checker', *args)
+    return _invoke_lambda_async('checker', *args, idempotency_key=idempotency_key)
+
+
+def lambda_cron(*args):
+    '''Invoke async lambda cron.'''
+    return _invoke_lambda_async('cron', *args)
+
+
+def lambda_checker_blocking(*args):
+    '''Return deserialized data from lambda checker blocking invocation.'''
+    return _invoke_lambda_blocking('checker', *args)
 
 
 def lambda_main_wrapper(event, proxy, default=None):
-    '''Wrap lambda_main request.'''
+    '''Wrap lambda_main request, emitting the invocation metrics and summary line.
+
+    Requests with idempotency_key are skipped if the key was already completed. Events
+    in the compact wire format are decoded, responses are encoded if the caller accepts.'''
+    from . import (logs, metrics, wire)
+    accept = wire.accepts_envelope(event)
+    event = wire.decode(event)
+    try:
+        key = event.get('idempotency_key')
+        if key:
+            from .idempotency import run_once
+            output = run_once(key, lambda: _lambda_main(event, proxy, default),
+                              {'response': 'action %s already processed' % key})
+        else:
+            output = _lambda_main(event, proxy, default)
+        return wire.encode(output) if accept else output
+    finally:
+        metrics.flush()
+        logs.flush_summary(str((event.get('action') or [''])[0]))
+
+
+def _lambda_main(event, proxy, default=None):
+    '''Dispatch lambda_main request to proxy command.'''
+    from . import (logs, metrics)
     if default and not 'action' in event:
         event['action'] = default
 
@@ -74,7 +220,17 @@ def lambda_main_wrapper(event, proxy, default=None):
                     cmd)
 
         if func:
-            return func(*args)
+            with metrics.timed('CommandDuration', Command=cmd):
+                try:
+                    output = func(*args)
+                except Exception:
+                    metrics.record('CommandErrors', 1, 'Count', Command=cmd)
+                    logs.summarize(errors=1)
+                    raise
+            metrics.record('CommandErrors',
+                           int(isinstance(output, dict) and 'errorMessage' in output),
+                           'Count', Command=cmd)
+            return output
         else:
             msg = 'command %s not valid' % cmd
             LOGGER.error(msg)
@@ -0,0 +1,162 @@
+'''Certificate expiry and check results caches.
+
+Certificates expiry date changes only when a new certificate is issued, so the observed
+notAfter can be reused across checks of the same domain, in the same warm container or,
+with a persistent backend, across invocations. sslexpired.info responses are cached
+the same way, for a shorter time, so that a domain is queried once per daily run even
+when its subscribers are split across pages, shards and checker invocations.'''
+import json
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+from . import (LOGGER, aws_client)
+
+
+class CertCache(object):
+    '''LRU in-memory cache of certificates notAfter keyed by domain, with TTL.'''
+
+    def __init__(self, ttl=86400, maxsize=10000, backend=None):
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._backend = backend
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _fresh(self, entry, now):
+        return entry and now - entry['fetched_at'] < self._ttl
+
+    def _store(self, domain, entry):
+        with self._lock:
+            self._entries[domain] = entry
+            self._entries.move_to_end(domain)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def get(self, domain, now=None):
+        '''Return {'not_after', 'fetched_at'} entry for domain if fresh, None otherwise.'''
+        now = now or time()
+        with self._lock:
+            entry = self._entries.get(domain)
+            if self._fresh(entry, now):
+                self._entries.move_to_end(domain)
+                return entry
+            self._entries.pop(domain, None)
+
+        if self._backend:
+            entry = self._backend.get(domain)
+            if self._fresh(entry, now):
+                self._store(domain, entry)
+                return entry
+        return None
+
+    def set(self, domain, not_after, now=None):
+        '''Store notAfter observed for domain.'''
+        entry = {'not_after': int(not_after), 'fetched_at': int(now or time())}
+        self._store(domain, entry)
+        if self._backend:
+            self._backend.set(domain, entry, self._ttl)
+
+
+class DynamoDBCacheBackend(object):
+    '''Persistent cache backend, entries expire via the table 'ttl' attribute.
+
+    Uses the shared DynamoDB client from the registry unless a client is given.'''
+
+    def __init__(self, table, client=None):
+        self._table = table
+        self._given_client = client
+
+    @property
+    def _client(self):
+        return self._given_client or aws_client('dynamodb')
+
+    def get(self, domain):
+        '''Return cached entry for domain, None if not found or on errors.'''
+        try:
+            item = self._client.get_item(
+                TableName=self._table,
+                Key={'domain': {'S': domain}},
+            ).get('Item')
+        # pylint: disable=broad-except
+        except Exception:
+            LOGGER.exception('exception reading %s from cache table %s', domain, self._table)
+            return None
+        if item:
+            return {'not_after': int(item['not_after']['N']),
+                    'fetched_at': int(item['fetched_at']['N'])}
+        return None
+
+    def set(self, domain, entry, ttl):
+        '''Store entry for domain, errors are logged and ignored.'''
+        try:
+            self._client.put_item(
+                TableName=self._table,
+                Item={
+                    'domain': {'S': domain},
+                    'not_after': {'N': str(entry['not_after'])},
+                    'fetched_at': {'N': str(entry['fetched_at'])},
+                    'ttl': {'N': str(entry['fetched_at'] + int(ttl))},
+                })
+        # pylint: disable=broad-except
+        except Exception:
+            LOGGER.exception('exception writing %s to cache table %s', domain, self._table)
+
+
+class ResultCache(CertCache):
+    '''LRU in-memory cache of check results keyed by (domain, days), with TTL.'''
+
+    @staticmethod
+    def key(domain, days):
+        '''Return cache key of the check of domain with days threshold.'''
+        return 'sslexpired:%s?days=%s' % (domain, days or '')
+
+    def get(self, domain, now=None, days=None):  # pylint: disable=arguments-differ
+        '''Return {'result', 'fetched_at'} entry for the check if fresh, None otherwise.'''
+        return super(ResultCache, self).get(self.key(domain, days), now)
+
+    def set(self, domain, result, now=None, days=None):  # pylint: disable=arguments-differ
+        '''Store result of the check of domain with days threshold.'''
+        key = self.key(domain, days)
+        entry = {'result': result, 'fetched_at': int(now or time())}
+        self._store(key, entry)
+        if self._backend:
+            self._backend.set(key, entry, self._ttl)
+
+
+class DynamoDBResultBackend(DynamoDBCacheBackend):
+    '''Persistent check results backend, sharing the certificates cache table.'''
+
+    def get(self, domain):
+        '''Return cached entry for key, None if not found or on errors.'''
+        try:
+            item = self._client.get_item(
+                TableName=self._table,
+                Key={'domain': {'S': domain}},
+            ).get('Item')
+        # pylint: disable=broad-except
+        except Exception:
+            LOGGER.exception('exception reading %s from cache table %s', domain, self._table)
+            return None
+        if item and 'result' in item:
+            return {'result': json.loads(item['result']['S']),
+                    'fetched_at': int(item['fetched_at']['N'])}
+        return None
+
+    def set(self, domain, entry, ttl):
+        '''Store entry for key, errors are logged and ignored.'''
+        try:
+            self._client.put_item(
+                TableName=self._table,
+                Item={
+                    'domain': {'S': domain},
+                    'result': {'S': json.dumps(entry['result'])},
+                    'fetched_at': {'N': str(entry['fetched_at'])},
+                    'ttl': {'N': str(entry['fetched_at'] + int(ttl))},
+                })
+        # pylint: disable=broad-except
+        except Exception:
+            LOGGER.exception('exception writing %s to cache table %s', domain, self._table)
@@ -0,0 +1,46 @@
+'''Checkpoint stores, persisting the progress of incremental jobs between runs.'''
+import json
+from copy import deepcopy
+
+from . import (BACKUP_BUCKET, aws_client)
+
+
+class MemoryCheckpointStore(object):
+    '''Checkpoint store kept in process memory, useful for tests and local runs.'''
+
+    def __init__(self, state=None):
+        self._state = deepcopy(state)
+
+    def load(self):
+        '''Return last saved state, None if never saved.'''
+        return deepcopy(self._state)
+
+    def save(self, state):
+        '''Persist state.'''
+        self._state = deepcopy(state)
+
+
+class S3CheckpointStore(object):
+    '''Checkpoint store persisting state as JSON object into S3 bucket.'''
+
+    def __init__(self, key, bucket=BACKUP_BUCKET):
+        self._key = key
+        self._bucket = bucket
+
+    def load(self):
+        '''Return last saved state, None if never saved.'''
+        client = aws_client('s3')
+        try:
+            body = client.get_object(Bucket=self._bucket, Key=self._key)['Body'].read()
+        except client.exceptions.NoSuchKey:
+            return None
+        return json.loads(body.decode('utf-8'))
+
+    def save(self, state):
+        '''Persist state.'''
+        aws_client('s3').put_object(
+            ACL='private',
+            Body=json.dumps(state),
+            Bucket=self._bucket,
+            Key=self._key,
+        )
@@ -0,0 +1,145 @@
+'''Idempotency stores, letting lambdas skip actions already done by a previous delivery.
+
+Async invocations may be delivered more than once, callers tag them with an idempotency
+key: before running the action the key is claimed, marked completed when it succeeds and
+released when it fails, so that only retries of failed actions run again. Claims of
+invocations dying without releasing them expire after IDEMPOTENCY_LOCK_TTL seconds.'''
+from os import environ
+from threading import Lock
+from time import time
+
+from . import (aws_client, logs, metrics, LOGGER)
+
+# DynamoDB table of the idempotency keys, keys are kept in memory if not configured
+IDEMPOTENCY_TABLE = environ.get('IDEMPOTENCY_TABLE')
+# Seconds completed keys are kept for, via the table 'ttl' attribute
+IDEMPOTENCY_TTL = int(environ.get('IDEMPOTENCY_TTL', 2 * 86400))
+# Seconds claims of running actions last for, at least the lambda timeout
+IDEMPOTENCY_LOCK_TTL = int(environ.get('IDEMPOTENCY_LOCK_TTL', 900))
+
+_STORE = []
+_STORE_LOCK = Lock()
+
+
+class MemoryIdempotencyStore(object):
+    '''Idempotency store kept in process memory, shared by the invocations of a container.'''
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, lock_ttl=IDEMPOTENCY_LOCK_TTL):
+        self._ttl = ttl
+        self._lock_ttl = lock_ttl
+        self._keys = {}
+        self._lock = Lock()
+
+    def claim(self, key, now=None):
+        '''Return True if key was claimed, False if completed or claimed by others.'''
+        now = now or time()
+        with self._lock:
+            entry = self._keys.get(key)
+            if entry and entry['expires'] > now:
+                return False
+            self._keys[key] = {'status': 'running', 'expires': now + self._lock_ttl}
+            return True
+
+    def complete(self, key, now=None):
+        '''Mark key completed, claims fail until it expires.'''
+        with self._lock:
+            self._keys[key] = {'status': 'completed', 'expires': (now or time()) + self._ttl}
+
+    def release(self, key):
+        '''Drop claim of failed action, so that it can be retried.'''
+        with self._lock:
+            self._keys.pop(key, None)
+
+
+class DynamoDBIdempotencyStore(object):
+    '''Idempotency store claiming keys with conditional writes, expiring via 'ttl'.
+
+    Uses the shared DynamoDB client from the registry unless a client is given.'''
+
+    def __init__(self, table, client=None, ttl=IDEMPOTENCY_TTL,
+                 lock_ttl=IDEMPOTENCY_LOCK_TTL):
+        self._table = table
+        self._given_client = client
+        self._ttl = ttl
+        self._lock_ttl = lock_ttl
+
+    @property
+    def _client(self):
+        return self._given_client or aws_client('dynamodb')
+
+    def claim(self, key, now=None):
+        '''Return True if key was claimed, False if completed or claimed by others.'''
+        now = int(now or time())
+        try:
+            self._client.put_item(
+                TableName=self._table,
+                Item={
+                    'key': {'S': key},
+                    'status': {'S': 'running'},
+                    'ttl': {'N': str(now + self._lock_ttl)},
+                },
+                # DynamoDB deletes expired items lazily, hence the explicit ttl check
+                ConditionExpression='attribute_not_exists(#key) OR #ttl <= :now',
+                ExpressionAttributeNames={'#key': 'key', '#ttl': 'ttl'},
+                ExpressionAttributeValues={':now': {'N': str(now)}},
+            )
+            return True
+        except self._client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def complete(self, key, now=None):
+        '''Mark key completed, claims fail until it expires.'''
+        self._client.put_item(
+            TableName=self._table,
+            Item={
+                'key': {'S': key},
+                'status': {'S': 'completed'},
+                'ttl': {'N': str(int(now or time()) + self._ttl)},
+            })
+
+    def release(self, key):
+        '''Drop claim of failed action, so that it can be retried.'''
+        self._client.delete_item(TableName=self._table, Key={'key': {'S': key}})
+
+
+def idempotency_store():
+    '''Return the store of the idempotency keys, created on first use.'''
+    with _STORE_LOCK:
+        if not _STORE:
+            _STORE.append(DynamoDBIdempotencyStore(IDEMPOTENCY_TABLE) if IDEMPOTENCY_TABLE
+                          else MemoryIdempotencyStore())
+        return _STORE[0]
+
+
+def run_once(key, func, skipped=None):
+    '''Run func unless key was already completed, return its output or skipped if so.
+
+    Outputs with errorMessage and exceptions release the key. Errors of the store are
+    logged and func runs anyway: duplicates are preferred to lost actions.'''
+    store = idempotency_store()
+    try:
+        claimed = store.claim(key)
+    # pylint: disable=broad-except
+    except Exception:
+        LOGGER.exception('exception claiming idempotency key %s', key)
+        return func()
+    if not claimed:
+        LOGGER.info('skipping already processed action %s', key)
+        metrics.record('DuplicateActions', 1, 'Count')
+        logs.summarize(skipped=1)
+        return skipped
+
+    try:
+        output = func()
+    except Exception:
+        store.release(key)
+        raise
+    try:
+        if isinstance(output, dict) and 'errorMessage' in output:
+            store.release(key)
+        else:
+            store.complete(key)
+    # pylint: disable=broad-except
+    except Exception:
+        LOGGER.exception('exception recording idempotency key %s', key)
+    return output
@@ -0,0 +1,75 @@
+'''Log volume control: sampled per record logging and invocation summaries.
+
+Routine per record INFO lines are logged to RECORD_LOGGER, which keeps only a
+LOG_SAMPLE_RATE fraction of them, warnings and errors are always kept. The counts of
+what each invocation processed are summarized instead, lambda_main_wrapper prints them
+as one JSON line starting with {"_summary" read by the reporter.'''
+import json
+import logging
+from collections import OrderedDict
+from os import environ
+from random import random
+from threading import Lock
+
+# Fraction of the routine per record INFO lines logged, 1 logs all of them
+LOG_SAMPLE_RATE = float(environ.get('LOG_SAMPLE_RATE', 1))
+# Counts always present in the summary lines
+SUMMARY_COUNTS = ('records', 'alerts', 'errors', 'skipped')
+SUMMARY_PREFIX = '{"_summary"'
+
+
+class SamplingFilter(logging.Filter):
+    '''Logging filter keeping a rate fraction of the records up to INFO level.'''
+
+    def __init__(self, rate=LOG_SAMPLE_RATE, rand=random):
+        super(SamplingFilter, self).__init__()
+        self.rate = rate
+        self._random = rand
+
+    def filter(self, record):
+        '''Return True if record is to be logged.'''
+        return record.levelno > logging.INFO or self.rate >= 1 or self._random() < self.rate
+
+
+RECORD_LOGGER = logging.getLogger('sslnotifyme.records')
+RECORD_LOGGER.addFilter(SamplingFilter())
+
+_COUNTS = {}
+_COUNTS_LOCK = Lock()
+
+
+def summarize(**counts):
+    '''Add counts to the summary of the current invocation.'''
+    with _COUNTS_LOCK:
+        for name, value in counts.items():
+            _COUNTS[name] = _COUNTS.get(name, 0) + value
+
+
+def summary_line(command, counts):
+    '''Return JSON summary line of command invocation counts.'''
+    summary = OrderedDict([('command', command)])
+    for name in SUMMARY_COUNTS:
+        summary[name] = counts.get(name, 0)
+    for name in sorted(set(counts) - set(SUMMARY_COUNTS)):
+        summary[name] = counts[name]
+    return json.dumps(OrderedDict([('_summary', summary)]))
+
+
+def parse_summary(line):
+    '''Return (command, counts) of summary line, None if it's not one.'''
+    if not line.startswith(SUMMARY_PREFIX):
+        return None
+    try:
+        summary = json.loads(line)['_summary']
+    except (KeyError, ValueError):
+        return None
+    command = summary.pop('command', None)
+    return command, summary
+
+
+def flush_summary(command, output=print):
+    '''Print summary line of the current invocation, reset the counts.'''
+    with _COUNTS_LOCK:
+        counts = dict(_COUNTS)
+        _COUNTS.clear()
+    output(summary_line(command, counts))
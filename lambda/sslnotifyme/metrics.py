@@ -0,0 +1,176 @@
+'''Invocation metrics: commands, downstream calls wall time, retries and payload sizes.
+
+Metrics are recorded into the current collector: by default they are buffered during
+the invocation and printed by lambda_main_wrapper as CloudWatch Embedded Metric Format
+lines, extracted by CloudWatch Logs into custom metrics. MemoryCollector keeps them in
+memory instead, for tests and benchmarks.'''
+import json
+from collections import OrderedDict
+from contextlib import contextmanager
+from os import environ
+from threading import Lock
+from time import (perf_counter, time)
+
+METRICS_NAMESPACE = environ.get('METRICS_NAMESPACE',
+                                environ.get('DOMAINNAME', 'sslnotify.me').replace('.', ''))
+METRICS_ENABLED = environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Maximum number of values of a metric in an EMF line
+EMF_MAX_VALUES = 100
+
+
+class MemoryCollector(object):
+    '''Collector keeping metrics in memory.'''
+
+    def __init__(self):
+        self.records = []
+        self._lock = Lock()
+
+    def record(self, name, value, unit, dimensions):
+        '''Store metric value.'''
+        with self._lock:
+            self.records.append({'name': name, 'value': value, 'unit': unit,
+                                 'dimensions': dimensions})
+
+    def values(self, name, **dimensions):
+        '''Return values of metric name recorded with (at least) the given dimensions.'''
+        with self._lock:
+            return [record['value'] for record in self.records if record['name'] == name and
+                    all(record['dimensions'].get(key) == value
+                        for key, value in dimensions.items())]
+
+    def flush(self):
+        '''Nothing to do, metrics are kept until cleared.'''
+
+    def clear(self):
+        '''Drop recorded metrics.'''
+        with self._lock:
+            self.records = []
+
+
+class EMFCollector(MemoryCollector):
+    '''Collector printing buffered metrics as CloudWatch Embedded Metric Format lines.'''
+
+    def __init__(self, namespace=None, output=print):
+        super(EMFCollector, self).__init__()
+        self._namespace = namespace or METRICS_NAMESPACE
+        self._output = output
+
+    def lines(self, records, timestamp=None):
+        '''Return EMF JSON lines of records, one for each dimensions set.'''
+        groups = OrderedDict()
+        for record in records:
+            key = tuple(sorted(record['dimensions'].items()))
+            metrics = groups.setdefault(key, OrderedDict())
+            metrics.setdefault((record['name'], record['unit']), []).append(record['value'])
+
+        lines = []
+        timestamp = int((timestamp or time()) * 1000)
+        for dimensions, metrics in groups.items():
+            offset = 0
+            while any(len(values) > offset for values in metrics.values()):
+                chunk = [(name, unit, values[offset:offset + EMF_MAX_VALUES])
+                         for (name, unit), values in metrics.items() if len(values) > offset]
+                # _aws first, so that metrics lines are told apart by their prefix
+                document = OrderedDict([('_aws', {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self._namespace,
+                        'Dimensions': [[key for key, _ in dimensions]],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, unit, _ in chunk],
+                    }],
+                })])
+                document.update(dimensions)
+                for name, _, values in chunk:
+                    document[name] = values if len(values) > 1 else values[0]
+                lines.append(json.dumps(document))
+                offset += EMF_MAX_VALUES
+        return lines
+
+    def flush(self):
+        '''Print buffered metrics and drop them.'''
+        with self._lock:
+            records, self.records = self.records, []
+        for line in self.lines(records):
+            self._output(line)
+
+
+_COLLECTOR = EMFCollector()
+
+
+def collector():
+    '''Return current collector.'''
+    return _COLLECTOR
+
+
+def set_collector(new_collector):
+    '''Replace current collector, return the previous one.'''
+    global _COLLECTOR  # pylint: disable=global-statement
+    previous, _COLLECTOR = _COLLECTOR, new_collector
+    return previous
+
+
+def record(name, value, unit='Milliseconds', **dimensions):
+    '''Record metric value with dimensions into the current collector.'''
+    if METRICS_ENABLED:
+        _COLLECTOR.record(name, value, unit, dimensions)
+
+
+def flush():
+    '''Flush the current collector.'''
+    if METRICS_ENABLED:
+        _COLLECTOR.flush()
+
+
+@contextmanager
+def timed(name, **dimensions):
+    '''Record wall time in milliseconds of the with block, also when raising.'''
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record(name, round((perf_counter() - start) * 1000, 3), **dimensions)
+
+
+def _payload_size(body):
+    '''Return size of request body if known without reading it, None otherwise.'''
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    return None
+
+
+def _before_call(model, params, context, **kwargs):
+    context['metrics_start'] = perf_counter()
+    size = _payload_size(params.get('body'))
+    if size is not None:
+        record('AWSRequestSize', size, 'Bytes', Service=model.service_model.service_name,
+               Operation=model.name)
+
+
+def _after_call(http_response, parsed, model, context, **kwargs):
+    dimensions = {'Service': model.service_model.service_name, 'Operation': model.name}
+    if 'metrics_start' in context:
+        record('AWSCallDuration',
+               round((perf_counter() - context['metrics_start']) * 1000, 3), **dimensions)
+    record('AWSCallRetries', parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+           'Count', **dimensions)
+    length = http_response.headers.get('content-length')
+    if length is not None:
+        record('AWSResponseSize', int(length), 'Bytes', **dimensions)
+    if http_response.status_code >= 300:
+        record('AWSCallErrors', 1, 'Count', **dimensions)
+
+
+def _after_call_error(model, context, **kwargs):
+    dimensions = {'Service': model.service_model.service_name, 'Operation': model.name}
+    if 'metrics_start' in context:
+        record('AWSCallDuration',
+               round((perf_counter() - context['metrics_start']) * 1000, 3), **dimensions)
+    record('AWSCallErrors', 1, 'Count', **dimensions)
+
+
+def instrument_client(client):
+    '''Record duration, retries and payload sizes of the boto3 client API calls.'''
+    client.meta.events.register('before-call.*.*', _before_call)
+    client.meta.events.register('after-call.*.*', _after_call)
+    client.meta.events.register('after-call-error.*.*', _after_call_error)
+    return client
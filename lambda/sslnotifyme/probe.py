@@ -0,0 +1,127 @@
+'''Native TLS certificate probe.
+
+Opens a TLS connection to each domain, reads the peer certificate notAfter date and
+computes the alert state locally, producing the same result dict returned by the
+sslexpired.info APIs.'''
+import asyncio
+import ssl
+from calendar import timegm
+from time import (strptime, time)
+
+DEFAULT_PORT = 443
+DAY_IN_SECONDS = 86400
+
+
+def _read_tlv(der, offset):
+    '''Return (tag, content start, content end) of the DER element at offset.'''
+    tag = der[offset]
+    length = der[offset + 1]
+    offset += 2
+    if length & 0x80:
+        count = length & 0x7f
+        length = int.from_bytes(der[offset:offset + count], 'big')
+        offset += count
+    return tag, offset, offset + length
+
+
+def _parse_asn1_time(tag, value):
+    '''Return UNIX epoch from ASN.1 UTCTime or GeneralizedTime value.'''
+    value = value.decode('ascii').rstrip('Z')
+    if tag == 0x17:  # UTCTime, two digits year
+        year = int(value[:2])
+        value = '%d%s' % (2000 + year if year < 50 else 1900 + year, value[2:])
+    return timegm(strptime(value[:14], '%Y%m%d%H%M%S'))
+
+
+def parse_not_after(der):
+    '''Return notAfter of DER encoded X.509 certificate as UNIX epoch.'''
+    _, cert, _ = _read_tlv(der, 0)
+    _, offset, _ = _read_tlv(der, cert)  # tbsCertificate
+    tag, _, end = _read_tlv(der, offset)
+    if tag == 0xa0:  # optional explicit version
+        offset = end
+    for _ in range(3):  # skip serialNumber, signature, issuer
+        offset = _read_tlv(der, offset)[2]
+    _, validity, _ = _read_tlv(der, offset)
+    not_before_end = _read_tlv(der, validity)[2]
+    tag, start, end = _read_tlv(der, not_before_end)
+    return _parse_asn1_time(tag, der[start:end])
+
+
+def split_domain(domain):
+    '''Return (host, port) tuple from domain[:port] string.'''
+    host, _, port = domain.strip().partition(':')
+    return host, int(port) if port else DEFAULT_PORT
+
+
+def _ssl_context():
+    '''Return SSL context which accepts any certificate, expiry included.'''
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+async def _probe(domain, timeout, context, semaphore):
+    '''Return notAfter dict for domain, or error dict.'''
+    host, port = split_domain(domain)
+    async with semaphore:
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=context, server_hostname=host),
+                timeout)
+        except asyncio.TimeoutError:
+            return {'error': 'timeout connecting to %s:%d' % (host, port)}
+        except (OSError, ssl.SSLError) as err:
+            return {'error': 'error connecting to %s:%d: %s' % (host, port, err)}
+
+        try:
+            der = writer.get_extra_info('ssl_object').getpeercert(binary_form=True)
+            if not der:
+                return {'error': 'no certificate found for %s:%d' % (host, port)}
+            return {'not_after': parse_not_after(der)}
+        except (IndexError, ValueError) as err:
+            return {'error': 'error parsing certificate for %s:%d: %s' % (host, port, err)}
+        finally:
+            writer.close()
+
+
+async def _probe_all(domains, timeout, concurrency):
+    '''Probe domains concurrently, at most concurrency connections at once.'''
+    semaphore = asyncio.Semaphore(concurrency)
+    context = _ssl_context()
+    results = await asyncio.gather(*[_probe(domain, timeout, context, semaphore)
+                                     for domain in domains])
+    return dict(zip(domains, results))
+
+
+def probe_certificates(domains, timeout=10, concurrency=100):
+    '''Return dict of probe results keyed by domain.
+
+    Each result is either {'not_after': epoch} or {'error': message}.'''
+    domains = list(set(domains))
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_probe_all(domains, timeout, concurrency))
+    finally:
+        loop.close()
+
+
+def expiry_result(domain, probe, days, now=None):
+    '''Return sslexpired.info-like result dict for probe result and days threshold.'''
+    if 'error' in probe:
+        msg = 'error checking SSL certificate for domain %s: %s' % (domain, probe['error'])
+        return {'response': msg, 'err': probe['error'], 'alert': True}
+
+    now = now or time()
+    days_left = int((probe['not_after'] - now) // DAY_IN_SECONDS)
+    if probe['not_after'] <= now:
+        return {'response': 'SSL certificate for domain %s is expired' % domain,
+                'alert': True, 'days_left': days_left}
+    if days_left < int(days):
+        return {'response': 'SSL certificate for domain %s will expire in %d days'
+                            % (domain, days_left),
+                'alert': True, 'days_left': days_left}
+    return {'response': 'SSL certificate for domain %s will expire in %d days'
+                        % (domain, days_left),
+            'days_left': days_left}
@@ -0,0 +1,239 @@
+'''Work queues, decoupling the producers of lambda commands from their execution.
+
+Messages are JSON serializable dicts in the lambda payload format ({'action': [...]}),
+consumers receive them, run them and delete the ones processed successfully. Messages
+released without being deleted are redelivered, up to max_receives times for the local
+backends, SQS relies on the redrive policy of the queue instead.'''
+import json
+from collections import deque
+from os import (environ, listdir, makedirs, path, remove, rename)
+from threading import Lock
+from uuid import uuid4
+
+from . import (APPNAME, aws_client)
+
+# 'sqs', 'file' or 'memory' backend of the mail queue
+MAIL_QUEUE_BACKEND = environ.get('MAIL_QUEUE_BACKEND', 'sqs')
+# Name of the SQS mail queue
+MAIL_QUEUE_NAME = environ.get('MAIL_QUEUE_NAME', '%s_mail' % APPNAME)
+# Directory of the file backed mail queue
+MAIL_QUEUE_PATH = environ.get('MAIL_QUEUE_PATH', '/tmp/%s_mail' % APPNAME)
+# Deliveries of each message before the local backends consider it dead
+MAIL_QUEUE_MAX_RECEIVES = int(environ.get('MAIL_QUEUE_MAX_RECEIVES', 5))
+# Maximum number of entries of SQS batch APIs
+SQS_BATCH_SIZE = 10
+
+_QUEUES = {}
+_QUEUES_LOCK = Lock()
+
+
+class MemoryQueue(object):
+    '''Queue kept in process memory, useful for tests and local runs.'''
+
+    def __init__(self, max_receives=MAIL_QUEUE_MAX_RECEIVES):
+        self._max_receives = max_receives
+        self._ready = deque()
+        self._inflight = {}
+        self._lock = Lock()
+        self.dead = []
+
+    def __len__(self):
+        return len(self._ready)
+
+    def send(self, message):
+        '''Enqueue message, return its id.'''
+        return self.send_batch([message])[0]
+
+    def send_batch(self, messages):
+        '''Enqueue messages, return their ids.'''
+        ids = [str(uuid4()) for _ in messages]
+        with self._lock:
+            for msg_id, message in zip(ids, messages):
+                self._ready.append({'id': msg_id, 'body': json.dumps(message), 'receives': 0})
+        return ids
+
+    def receive(self, max_messages=SQS_BATCH_SIZE):
+        '''Return up to max_messages messages, hidden from other consumers until released.'''
+        received = []
+        with self._lock:
+            while self._ready and len(received) < max_messages:
+                item = self._ready.popleft()
+                item['receives'] += 1
+                self._inflight[item['id']] = item
+                received.append({'id': item['id'], 'receipt': item['id'],
+                                 'body': json.loads(item['body'])})
+        return received
+
+    def delete(self, receipt):
+        '''Remove processed message.'''
+        with self._lock:
+            self._inflight.pop(receipt, None)
+
+    def release(self, receipt):
+        '''Make message available again, or dead if received max_receives times.'''
+        with self._lock:
+            item = self._inflight.pop(receipt, None)
+            if item is None:
+                return
+            if item['receives'] >= self._max_receives:
+                self.dead.append(json.loads(item['body']))
+            else:
+                self._ready.append(item)
+
+
+class FileQueue(object):
+    '''Queue persisted into a local directory, one JSON file per message.
+
+    Receiving a message renames its file, so that concurrent consumers in different
+    processes never receive the same message.'''
+
+    def __init__(self, directory=MAIL_QUEUE_PATH, max_receives=MAIL_QUEUE_MAX_RECEIVES):
+        self._directory = directory
+        self._max_receives = max_receives
+        for subdir in ('ready', 'inflight', 'dead'):
+            makedirs(path.join(directory, subdir), exist_ok=True)
+
+    def _path(self, state, name):
+        return path.join(self._directory, state, name)
+
+    def _write(self, state, name, item):
+        tmp = self._path(state, '.%s.tmp' % name)
+        with open(tmp, 'w') as fhandle:
+            json.dump(item, fhandle)
+        rename(tmp, self._path(state, name))
+
+    def __len__(self):
+        return len([name for name in listdir(self._path('ready', ''))
+                    if not name.startswith('.')])
+
+    def send(self, message):
+        '''Enqueue message, return its id.'''
+        return self.send_batch([message])[0]
+
+    def send_batch(self, messages):
+        '''Enqueue messages, return their ids.'''
+        ids = []
+        for message in messages:
+            msg_id = str(uuid4())
+            self._write('ready', msg_id, {'body': message, 'receives': 0})
+            ids.append(msg_id)
+        return ids
+
+    def receive(self, max_messages=SQS_BATCH_SIZE):
+        '''Return up to max_messages messages, hidden from other consumers until released.'''
+        received = []
+        for name in sorted(listdir(self._path('ready', ''))):
+            if len(received) >= max_messages:
+                break
+            if name.startswith('.'):
+                continue
+            try:
+                rename(self._path('ready', name), self._path('inflight', name))
+            except FileNotFoundError:
+                # received by a concurrent consumer
+                continue
+            with open(self._path('inflight', name)) as fhandle:
+                item = json.load(fhandle)
+            item['receives'] += 1
+            self._write('inflight', name, item)
+            received.append({'id': name, 'receipt': name, 'body': item['body']})
+        return received
+
+    def delete(self, receipt):
+        '''Remove processed message.'''
+        try:
+            remove(self._path('inflight', receipt))
+        except FileNotFoundError:
+            pass
+
+    def release(self, receipt):
+        '''Make message available again, or dead if received max_receives times.'''
+        try:
+            with open(self._path('inflight', receipt)) as fhandle:
+                item = json.load(fhandle)
+        except FileNotFoundError:
+            return
+        state = 'dead' if item['receives'] >= self._max_receives else 'ready'
+        rename(self._path('inflight', receipt), self._path(state, receipt))
+
+
+class SQSQueue(object):
+    '''Queue backed by an SQS queue, its URL looked up on first use.'''
+
+    def __init__(self, name=MAIL_QUEUE_NAME):
+        self._name = name
+        self._url = None
+
+    @property
+    def url(self):
+        '''Return SQS queue URL.'''
+        if self._url is None:
+            self._url = aws_client('sqs').get_queue_url(QueueName=self._name)['QueueUrl']
+        return self._url
+
+    def __len__(self):
+        return int(aws_client('sqs').get_queue_attributes(
+            QueueUrl=self.url,
+            AttributeNames=['ApproximateNumberOfMessages'],
+        )['Attributes']['ApproximateNumberOfMessages'])
+
+    def send(self, message):
+        '''Enqueue message, return its id.'''
+        return aws_client('sqs').send_message(QueueUrl=self.url,
+                                              MessageBody=json.dumps(message))['MessageId']
+
+    def send_batch(self, messages):
+        '''Enqueue messages in batches of SQS_BATCH_SIZE, return their ids.
+
+        Raise RuntimeError if any entry of the batches failed.'''
+        ids = []
+        for offset in range(0, len(messages), SQS_BATCH_SIZE):
+            chunk = messages[offset:offset + SQS_BATCH_SIZE]
+            result = aws_client('sqs').send_message_batch(
+                QueueUrl=self.url,
+                Entries=[{'Id': str(i), 'MessageBody': json.dumps(message)}
+                         for i, message in enumerate(chunk)])
+            if result.get('Failed'):
+                raise RuntimeError('%d message(s) not enqueued: %s' % (
+                    len(result['Failed']), result['Failed'][0].get('Message')))
+            sent = dict((entry['Id'], entry['MessageId']) for entry in result['Successful'])
+            ids.extend(sent[str(i)] for i in range(len(chunk)))
+        return ids
+
+    def receive(self, max_messages=SQS_BATCH_SIZE):
+        '''Return up to max_messages messages, hidden from other consumers until released.'''
+        result = aws_client('sqs').receive_message(
+            QueueUrl=self.url,
+            MaxNumberOfMessages=min(max_messages, SQS_BATCH_SIZE))
+        return [{'id': msg['MessageId'], 'receipt': msg['ReceiptHandle'],
+                 'body': json.loads(msg['Body'])}
+                for msg in result.get('Messages', [])]
+
+    def delete(self, receipt):
+        '''Remove processed message.'''
+        aws_client('sqs').delete_message(QueueUrl=self.url, ReceiptHandle=receipt)
+
+    @staticmethod
+    def release(receipt):
+        '''Leave message to be redelivered when its visibility timeout expires.'''
+
+
+BACKENDS = {
+    'file': FileQueue,
+    'memory': MemoryQueue,
+    'sqs': SQSQueue,
+}
+
+
+def mail_queue():
+    '''Return the mail queue of the backend selected via MAIL_QUEUE_BACKEND.'''
+    with _QUEUES_LOCK:
+        if MAIL_QUEUE_BACKEND not in _QUEUES:
+            _QUEUES[MAIL_QUEUE_BACKEND] = BACKENDS[MAIL_QUEUE_BACKEND]()
+        return _QUEUES[MAIL_QUEUE_BACKEND]
+
+
+def reset_queues():
+    '''Drop cached queues, next mail_queue calls will create new ones.'''
+    with _QUEUES_LOCK:
+        _QUEUES.clear()
@@ -0,0 +1,166 @@
+'''Outbound calls rate limiting: token bucket, adaptive concurrency and retry queue.
+
+The token bucket caps the requests rate, the AIMD limiter adapts the number of
+concurrent requests to what the upstream can handle: it grows additively while calls
+succeed fast enough, and is cut multiplicatively on errors or slow calls. Failed
+work items are retried with jittered exponential backoff by the retry queue.'''
+import heapq
+from contextlib import contextmanager
+from itertools import count
+from random import random
+from threading import (Condition, Lock)
+from time import (monotonic, sleep)
+
+# Token deficits smaller than this are float rounding errors, not a reason to wait
+TOKENS_EPSILON = 1e-9
+
+
+class TokenBucket(object):
+    '''Thread safe token bucket, rate tokens per second up to burst, rate <= 0 is unlimited.'''
+
+    def __init__(self, rate, burst=None, clock=monotonic, sleeper=sleep):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self._tokens = self.burst
+        self._clock = clock
+        self._sleep = sleeper
+        self._updated = clock()
+        self._lock = Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        '''Take tokens if available, return seconds to wait for them otherwise (0 if taken).'''
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens - TOKENS_EPSILON:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        '''Take tokens, waiting until they are available.'''
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            self._sleep(wait)
+
+
+class AIMDLimiter(object):
+    '''Thread safe concurrency limiter with additive increase and multiplicative decrease.
+
+    Every successful call faster than latency_target grows the limit by increase/limit,
+    about increase every limit calls; errors and slow calls multiply it by decrease, at
+    most once every cooldown seconds so that a burst of failures counts as one signal.'''
+
+    def __init__(self, limit, minimum=1, maximum=None, increase=1.0, decrease=0.5,
+                 latency_target=None, cooldown=1.0, clock=monotonic):
+        self.minimum = minimum
+        self.maximum = maximum or limit
+        self.limit = float(min(max(limit, minimum), self.maximum))
+        self._increase = increase
+        self._decrease = decrease
+        self._latency_target = latency_target
+        self._cooldown = cooldown
+        self._clock = clock
+        self._decreased = None
+        self._inflight = 0
+        self._condition = Condition()
+
+    @property
+    def inflight(self):
+        '''Return number of calls in progress.'''
+        return self._inflight
+
+    def acquire(self):
+        '''Wait for a free slot and take it.'''
+        with self._condition:
+            while self._inflight >= int(self.limit):
+                self._condition.wait()
+            self._inflight += 1
+
+    def release(self, failed=False, latency=None):
+        '''Free slot, adapting the limit to the outcome of the call.'''
+        with self._condition:
+            self._inflight -= 1
+            slow = self._latency_target and latency is not None and \
+                latency > self._latency_target
+            if failed or slow:
+                now = self._clock()
+                if self._decreased is None or now - self._decreased >= self._cooldown:
+                    self.limit = max(self.minimum, self.limit * self._decrease)
+                    self._decreased = now
+            else:
+                self.limit = min(self.maximum, self.limit + self._increase / self.limit)
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        '''Hold a slot during the with block, exceptions count as failures.'''
+        self.acquire()
+        start = self._clock()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.release(failed, self._clock() - start)
+
+
+def backoff_delay(attempt, base=0.5, maximum=10.0, rand=random):
+    '''Return "full jitter" exponential backoff delay in seconds of retry attempt (1-based).'''
+    return rand() * min(maximum, base * 2 ** (attempt - 1))
+
+
+class RetryQueue(object):
+    '''Queue of failed items to be retried after a jittered backoff, up to max_attempts.'''
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=10.0, clock=monotonic,
+                 rand=random):
+        self.max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._clock = clock
+        self._rand = rand
+        self._attempts = {}
+        self._heap = []
+        self._counter = count()  # tie breaker, items don't need to be comparable
+
+    def __len__(self):
+        return len(self._heap)
+
+    def attempts(self, key):
+        '''Return number of failed attempts of item key.'''
+        return self._attempts.get(key, 0)
+
+    def push(self, key, item=None):
+        '''Schedule retry of item, identified by key, return False if out of attempts.'''
+        attempts = self._attempts[key] = self._attempts.get(key, 0) + 1
+        if attempts >= self.max_attempts:
+            return False
+        due = self._clock() + backoff_delay(attempts, self._base_delay, self._max_delay,
+                                            self._rand)
+        heapq.heappush(self._heap, (due, next(self._counter), key,
+                                    key if item is None else item))
+        return True
+
+    def ready(self):
+        '''Pop and return list of (key, item) due to be retried.'''
+        now = self._clock()
+        items = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, key, item = heapq.heappop(self._heap)
+            items.append((key, item))
+        return items
+
+    def next_delay(self):
+        '''Return seconds until the next retry is due, None if empty.'''
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - self._clock())
@@ -0,0 +1,54 @@
+'''Expiry-aware scheduling of the subscriptions checks.
+
+Each validated user record stores the last observed certificate notAfter and when it
+is next due to be checked, bucketed by UTC day in the 'due_day' attribute indexed by a
+GSI: the daily cron queries only the buckets due instead of scanning the whole table.
+Records left behind in older buckets, e.g. when a schedule update is lost, are caught
+by a weekly sweep of the table.
+
+The notAfter date is known only in probe mode (CHECKER_MODE=probe), with sslexpired.info
+every subscription is due again the day after.'''
+from datetime import datetime
+from os import environ
+from time import time
+
+# Enable cron queries of due records and checker schedule updates
+DUE_SCHEDULING = environ.get('DUE_SCHEDULING', '').lower() in ('1', 'true', 'yes')
+# Maximum interval in seconds between checks, catches replaced or unreachable certificates
+MAX_CHECK_INTERVAL = int(environ.get('MAX_CHECK_INTERVAL', 7 * 86400))
+# Number of past day buckets queried besides today's, to catch up missed cron runs
+DUE_LOOKBACK_DAYS = int(environ.get('DUE_LOOKBACK_DAYS', 7))
+# Weekday (0 is Monday) the cron also sweeps records due before the lookback, -1 never
+DUE_SWEEP_WEEKDAY = int(environ.get('DUE_SWEEP_WEEKDAY', 6))
+DUE_DAY_INDEX = 'due_day-index'
+DAY_IN_SECONDS = 86400
+
+
+def due_day(timestamp):
+    '''Return UTC day bucket (YYYY-MM-DD) of UNIX timestamp.'''
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+def due_days(now=None, lookback=None):
+    '''Return day buckets due at now, today's first.'''
+    now = now or time()
+    lookback = DUE_LOOKBACK_DAYS if lookback is None else lookback
+    return [due_day(now - day * DAY_IN_SECONDS) for day in range(lookback + 1)]
+
+
+def sweep_day(now=None):
+    '''Return True if records stranded before the lookback are to be swept at now.'''
+    return datetime.utcfromtimestamp(now or time()).weekday() == DUE_SWEEP_WEEKDAY
+
+
+def next_check_at(days, not_after=None, alert=False, now=None):
+    '''Return UNIX timestamp of the next check of a subscription with days threshold.
+
+    Subscriptions in alert state, or with unknown notAfter, are checked again the day
+    after, the others when entering the alert window, at most MAX_CHECK_INTERVAL later.'''
+    now = now or time()
+    tomorrow = now + DAY_IN_SECONDS
+    if alert or not not_after:
+        return int(tomorrow)
+    return int(min(max(int(not_after) - int(days) * DAY_IN_SECONDS, tomorrow),
+                   now + MAX_CHECK_INTERVAL))
@@ -0,0 +1,135 @@
+'''Bulk import of subscriptions from CSV or JSON Lines input.
+
+Rows are (email, domain, days) subscriptions, CSV input starts with a header naming
+these columns, days is optional. Rows are parsed and validated as they are read, valid
+ones are put into the pending table in batches of IMPORT_BATCH_SIZE and their activation
+emails enqueued in batches on the mail queue. Each row is reported, with the error if it
+was not imported: users tables are keyed by email, only the first row of each is.'''
+import csv
+import json
+import re
+from os import environ
+
+from . import LOGGER
+
+# Number of rows put into the pending table by each lambda db invocation
+IMPORT_BATCH_SIZE = int(environ.get('IMPORT_BATCH_SIZE', 500))
+DEFAULT_DAYS = 30
+EMAIL_REGEXP = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+DOMAIN_REGEXP = re.compile(r'^(?=.{1,253}(:|$))([a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?\.)+'
+                           r'[a-z]{2,63}(:[0-9]{1,5})?$', re.IGNORECASE)
+
+
+def parse_rows(lines, fmt=None):
+    '''Return generator of (row number, row dict or None, error) from lines of text.
+
+    fmt is 'csv' or 'jsonl', detected from the first line if not given.'''
+    lines = iter(lines)
+    first = next((line for line in lines if line.strip()), None)
+    if first is None:
+        return
+    if fmt is None:
+        fmt = 'jsonl' if first.lstrip().startswith('{') else 'csv'
+
+    def all_lines():
+        yield first
+        yield from lines
+
+    if fmt == 'csv':
+        reader = csv.DictReader(line for line in all_lines() if line.strip())
+        for number, row in enumerate(reader, 1):
+            yield number, row, None
+        return
+
+    for number, line in enumerate((line for line in all_lines() if line.strip()), 1):
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, None, 'invalid JSON'
+            continue
+        if not isinstance(row, dict):
+            yield number, None, 'row must be a JSON object'
+            continue
+        yield number, row, None
+
+
+def validate_row(row):
+    '''Return (record, None) for valid row, (None, error) otherwise.'''
+    email = str(row.get('email') or '').strip()
+    domain = str(row.get('domain') or '').strip().lower()
+    if not EMAIL_REGEXP.match(email):
+        return None, 'invalid email'
+    if not DOMAIN_REGEXP.match(domain):
+        return None, 'invalid domain'
+    days = row.get('days')
+    if days in (None, ''):
+        days = DEFAULT_DAYS
+    try:
+        days = int(days)
+        if days < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        return None, 'days value must be a positive number'
+    return {'email': email, 'domain': domain, 'days': days}, None
+
+
+def _flush(batch, put_pending, queue, report):
+    '''Put batch of (row number, record) into pending table, enqueue activation emails.'''
+    try:
+        pending = put_pending([record for _, record in batch])
+    # pylint: disable=broad-except
+    except Exception:
+        LOGGER.exception('exception importing %d row(s)', len(batch))
+        report.extend({'row': number, 'email': record['email'], 'status': 'error',
+                       'error': 'internal error storing subscription'}
+                      for number, record in batch)
+        return
+
+    try:
+        queue.send_batch([{'action': ['send_activation_link', record['email'],
+                                      record['domain'], record['days'], record['uuid']]}
+                          for record in pending])
+        status, error = 'pending', None
+    # pylint: disable=broad-except
+    except Exception:
+        LOGGER.exception('exception queueing %d activation email(s)', len(pending))
+        status, error = 'error', 'activation email not sent, subscribe again'
+
+    for (number, _), record in zip(batch, pending):
+        entry = {'row': number, 'email': record['email'], 'status': status}
+        if error:
+            entry['error'] = error
+        report.append(entry)
+
+
+def import_subscriptions(lines, put_pending, queue, fmt=None, batch_size=None):
+    '''Import subscriptions from lines of CSV or JSON Lines text, return per row report.
+
+    put_pending stores a list of records into the pending table, returning them with
+    their activation uuid. Activation emails are enqueued on queue.'''
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+    report = []
+    seen = set()
+    batch = []
+    for number, row, error in parse_rows(lines, fmt):
+        record = None
+        if not error:
+            record, error = validate_row(row)
+        if record and record['email'] in seen:
+            record, error = None, 'duplicate email'
+        if error:
+            report.append({'row': number, 'email': (row or {}).get('email'),
+                           'status': 'error', 'error': error})
+            continue
+        seen.add(record['email'])
+        batch.append((number, record))
+        if len(batch) == batch_size:
+            _flush(batch, put_pending, queue, report)
+            batch = []
+    if batch:
+        _flush(batch, put_pending, queue, report)
+
+    report.sort(key=lambda entry: entry['row'])
+    imported = sum(1 for entry in report if entry['status'] == 'pending')
+    LOGGER.info('%d subscription(s) imported, %d failed', imported, len(report) - imported)
+    return {'imported': imported, 'failed': len(report) - imported, 'rows': report}
@@ -0,0 +1,100 @@
+'''Compact wire format of the payloads exchanged by the lambdas.
+
+Lists of records are encoded as columnar tables, their keys stored once instead of on
+every record, then the JSON document is zlib compressed and base64 encoded into an
+envelope, itself a JSON object so that it's a valid lambda payload:
+
+    {"_envelope": "columnar+zlib", "data": "eJyr..."}
+
+Callers supporting envelopes add "_accept": "columnar+zlib" to their (plain or enveloped)
+events, lambda_main_wrapper then returns enveloped responses, plain JSON callers keep
+getting plain JSON. Payloads smaller than WIRE_MIN_BYTES are not worth enveloping.'''
+import base64
+import json
+import zlib
+from os import environ
+
+# Envelope the payloads of the lambda invocations and accept enveloped responses
+WIRE_ENVELOPE = environ.get('WIRE_ENVELOPE', '').lower() in ('1', 'true', 'yes')
+# JSON payloads shorter than this many bytes are sent as they are
+WIRE_MIN_BYTES = int(environ.get('WIRE_MIN_BYTES', 4096))
+ENVELOPE_FORMAT = 'columnar+zlib'
+
+
+def to_columns(obj):
+    '''Return obj with lists of two or more dicts replaced by columnar tables.
+
+    Tables are {'_columns': keys, '_rows': values lists}, keys missing from a record
+    are listed in '_absent' as [row, column] pairs.'''
+    if isinstance(obj, dict):
+        return dict((key, to_columns(value)) for key, value in obj.items())
+    if not isinstance(obj, list):
+        return obj
+
+    items = [to_columns(item) for item in obj]
+    if len(items) < 2 or not all(isinstance(item, dict) for item in items):
+        return items
+    columns = []
+    for item in items:
+        columns.extend(key for key in item if key not in columns)
+    rows = []
+    absent = []
+    for row, item in enumerate(items):
+        rows.append([item.get(key) for key in columns])
+        absent.extend([row, column] for column, key in enumerate(columns) if key not in item)
+    table = {'_columns': columns, '_rows': rows}
+    if absent:
+        table['_absent'] = absent
+    return table
+
+
+def from_columns(obj):
+    '''Return obj with the columnar tables replaced by lists of dicts, reverse of to_columns.'''
+    if isinstance(obj, list):
+        return [from_columns(item) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if '_columns' not in obj or '_rows' not in obj:
+        return dict((key, from_columns(value)) for key, value in obj.items())
+
+    columns = obj['_columns']
+    items = [dict((key, from_columns(value)) for key, value in zip(columns, row))
+             for row in obj['_rows']]
+    for row, column in obj.get('_absent', ()):
+        del items[row][columns[column]]
+    return items
+
+
+def is_envelope(obj):
+    '''Return True if obj is an envelope.'''
+    return isinstance(obj, dict) and obj.get('_envelope') == ENVELOPE_FORMAT
+
+
+def encode(obj, min_bytes=None):
+    '''Return obj enveloped, or obj itself if its JSON is shorter than min_bytes.'''
+    min_bytes = WIRE_MIN_BYTES if min_bytes is None else min_bytes
+    document = json.dumps(to_columns(obj), separators=(',', ':'))
+    if len(document) < min_bytes:
+        return obj
+    data = base64.b64encode(zlib.compress(document.encode('utf-8'))).decode('ascii')
+    return {'_envelope': ENVELOPE_FORMAT, 'data': data}
+
+
+def decode(obj):
+    '''Return content of envelope, obj itself if it's not an envelope.'''
+    if not is_envelope(obj):
+        return obj
+    document = zlib.decompress(base64.b64decode(obj['data'])).decode('utf-8')
+    return from_columns(json.loads(document))
+
+
+def request_event(event):
+    '''Return lambda event in the wire format selected via WIRE_ENVELOPE.'''
+    if not WIRE_ENVELOPE:
+        return event
+    return dict(encode(event), _accept=ENVELOPE_FORMAT)
+
+
+def accepts_envelope(event):
+    '''Return True if the caller of event accepts enveloped responses.'''
+    return isinstance(event, dict) and event.get('_accept') == ENVELOPE_FORMAT
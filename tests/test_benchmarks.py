@@ -0,0 +1,23 @@
+'''Py.test'''
+import sys
+
+sys.path.append('./lambda')
+sys.path.append('./benchmarks')
+import hotpaths
+
+
+def test_hotpaths_benchmarks():
+    '''Test hot paths benchmarks run and regressions are detected.'''
+    results = hotpaths.run(sizes=(50,), checks=10, log_events=400)
+    assert set(results) == set([
+        'datastore_scan_50', 'cron_dispatch_50', 'parse_record', 'checker_alert',
+        'mailer_digests', 'reporter_report'])
+    assert results['checker_alert']['emails'] == 5
+    for result in results.values():
+        assert result['throughput'] > 0
+        assert result['p50_ms'] <= result['p90_ms'] <= result['p99_ms']
+
+    baselines = dict((name, dict(result, throughput=result['throughput'] * 2))
+                     for name, result in results.items())
+    assert len(hotpaths.compare(results, baselines)) == len(results)
+    assert hotpaths.compare(results, results) == []
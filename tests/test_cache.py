@@ -0,0 +1,80 @@
+'''Py.test'''
+import sys
+from moto import mock_dynamodb2
+import boto3
+
+sys.path.append('./lambda')
+import checker
+from sslnotifyme import probe
+from sslnotifyme.cache import (CertCache, DynamoDBCacheBackend, DynamoDBResultBackend,
+                               ResultCache)
+
+
+def test_cache_ttl_and_lru():
+    '''Test entries expire after ttl and least recently used ones are evicted.'''
+    cache = CertCache(ttl=100, maxsize=2)
+    cache.set('a.com', 5000, now=1000)
+    cache.set('b.com', 5000, now=1000)
+    assert cache.get('a.com', now=1050)['not_after'] == 5000
+    cache.set('c.com', 5000, now=1050)  # evicts b.com, a.com has been used more recently
+    assert cache.get('b.com', now=1050) is None
+    assert cache.get('a.com', now=1050) is not None
+    assert cache.get('a.com', now=1100) is None
+    assert len(cache) == 1
+
+
+@mock_dynamodb2
+def test_cache_dynamodb_backend():
+    '''Test entries are shared across caches through the persistent backend.'''
+    dyn = boto3.client('dynamodb')
+    dyn.create_table(
+        TableName='certs',
+        AttributeDefinitions=[{'AttributeName': 'domain', 'AttributeType': 'S'}],
+        KeySchema=[{'AttributeName': 'domain', 'KeyType': 'HASH'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5},
+    )
+    CertCache(backend=DynamoDBCacheBackend('certs', dyn)).set('a.com', 5000, now=1000)
+    cache = CertCache(backend=DynamoDBCacheBackend('certs', dyn))
+    assert cache.get('a.com', now=1010) == {'not_after': 5000, 'fetched_at': 1000}
+    assert dyn.get_item(TableName='certs',
+                        Key={'domain': {'S': 'a.com'}})['Item']['ttl'] == {'N': '87400'}
+
+
+def test_checker_uses_cache(monkeypatch):
+    '''Test domains out of alert state are checked without probing them again.'''
+    probed = []
+
+    def probe_certificates(domains, *args):
+        probed.extend(domains)
+        return dict((domain, {'not_after': checker.time() + 90 * 86400}) for domain in domains)
+
+    monkeypatch.setattr(probe, 'probe_certificates', probe_certificates)
+    monkeypatch.setattr(checker, 'CACHE', CertCache())
+    monkeypatch.setattr(checker, 'CHECKER_MODE', 'probe')
+    for _ in range(3):
+        assert 'alert' not in checker.Checker.check_certificate('example.com', 30)
+    assert probed == ['example.com']
+    assert 'alert' in checker.Checker.check_certificate('example.com', 100)
+    assert probed == ['example.com', 'example.com']
+
+
+@mock_dynamodb2
+def test_sslexpired_results_cached_across_checkers(monkeypatch):
+    '''Test sslexpired.info is queried once per domain and days, by any checker.'''
+    dyn = boto3.client('dynamodb')
+    dyn.create_table(
+        TableName='certs',
+        AttributeDefinitions=[{'AttributeName': 'domain', 'AttributeType': 'S'}],
+        KeySchema=[{'AttributeName': 'domain', 'KeyType': 'HASH'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5},
+    )
+    queried = []
+    monkeypatch.setattr(checker, '_sslexpired_get',
+                        lambda path: queried.append(path) or {'response': path})
+    for _ in range(2):  # e.g. two checker containers checking pages of different shards
+        monkeypatch.setattr(checker, 'RESULT_CACHE', ResultCache(
+            backend=DynamoDBResultBackend('certs', dyn)))
+        for days in (30, 30, 10):
+            assert checker.Checker.check_sslexpired('example.com', days) == {
+                'response': '/example.com?days=%d' % days}
+    assert queried == ['/example.com?days=30', '/example.com?days=10']
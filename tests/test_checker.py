@@ -0,0 +1,175 @@
+'''Py.test'''
+import json
+import sys
+import threading
+import time
+from http.server import (BaseHTTPRequestHandler, HTTPServer)
+
+sys.path.append('./lambda')
+import checker
+from sslnotifyme import schedule
+
+
+def test_check_domain_once(monkeypatch):
+    '''Test domain is checked once when the largest threshold is not in alert state.'''
+    calls = []
+    monkeypatch.setattr(checker.Checker, 'check_sslexpired',
+                        staticmethod(lambda domain, days: calls.append(days) or {'response': 'ok'}))
+    monkeypatch.setattr(checker, 'lambda_mailer', lambda *args, **kwargs: None)
+    records = [{'email': 'user%d@example.com' % days, 'domain': 'example.com',
+                'days': str(days), 'uuid': 'uuid'} for days in (10, 30, 20, 30)]
+    checker.Checker.check_domain_and_send_alerts('example.com', records)
+    assert calls == [30]
+
+
+def test_check_domain_alerts_by_threshold(monkeypatch):
+    '''Test each subscriber is alerted according to its own days threshold.'''
+    monkeypatch.setattr(checker.Checker, 'check_sslexpired', staticmethod(
+        lambda domain, days: {'response': 'expiring', 'alert': True} if days >= 20
+        else {'response': 'ok'}))
+    sent = []
+    monkeypatch.setattr(checker, 'lambda_mailer', lambda *args, **kwargs: sent.append(args[1]))
+    records = [{'email': 'user%d@example.com' % days, 'domain': 'example.com',
+                'days': str(days), 'uuid': 'uuid'} for days in (10, 20, 30)]
+    checker.Checker.check_domain_and_send_alerts('example.com', records)
+    assert sorted(sent) == ['user20@example.com', 'user30@example.com']
+
+
+def test_check_batch(monkeypatch):
+    '''Test batch returns per record outcomes, checking each domain once, failed ones retried.'''
+    calls = []
+    monkeypatch.setattr(checker, 'CHECK_RETRY_BASE', 0.01)
+
+    def check_sslexpired(domain, days):
+        calls.append(domain)
+        if domain == 'broken.com':
+            raise IOError('connection refused')
+        return {'response': 'expiring', 'alert': True} if domain == 'alert.com' else {}
+
+    monkeypatch.setattr(checker.Checker, 'check_sslexpired', staticmethod(check_sslexpired))
+    sent = []
+    monkeypatch.setattr(checker, 'lambda_mailer', lambda *args, **kwargs: sent.append(args[1]))
+    records = [{'email': 'user%d@%s' % (i, domain), 'domain': domain, 'days': '30',
+                'uuid': 'uuid'} for i in range(3) for domain in ('ok.com', 'alert.com',
+                                                                    'broken.com')]
+    result = checker.Checker.check_and_send_alert_batch(records + [{'email': 'bad'}])
+    assert sorted(calls) == ['alert.com'] + ['broken.com'] * checker.CHECK_MAX_ATTEMPTS + [
+        'ok.com']
+    assert sorted(sent) == ['user%d@alert.com' % i for i in range(3)]
+    assert len(result['response']) == 10
+    assert result['summary'] == {'records': 10, 'domains': 3, 'alerts': 3, 'errors': 4,
+                                 'scheduled': 0, 'retries': checker.CHECK_MAX_ATTEMPTS - 1}
+    assert set(result['timings']) == set(['probe_ms', 'check_ms', 'notify_ms', 'total_ms'])
+
+
+def test_sslexpired_keep_alive(monkeypatch):
+    '''Test requests to sslexpired APIs reuse the same connection.'''
+    clients = set()
+
+    class Handler(BaseHTTPRequestHandler):
+        '''Fake sslexpired.info API handler.'''
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            clients.add(self.client_address)
+            body = json.dumps({'response': self.path}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    monkeypatch.setattr(checker, 'SSLEXPIRED_API_URL', 'http://127.0.0.1:%d' % server.server_port)
+    monkeypatch.setattr(checker, '_SESSION', threading.local())
+    for days in range(5):
+        assert checker.Checker.check_sslexpired('example.com', days + 1) == {
+            'response': '/example.com?days=%d' % (days + 1)}
+    checker._SESSION.conn.close()
+    server.shutdown()
+    assert len(clients) == 1
+
+
+def test_batch_updates_schedules(monkeypatch):
+    '''Test checked records are rescheduled according to their certificate expiry.'''
+    now = int(time.time())
+    monkeypatch.setattr(checker, 'CHECKER_MODE', 'probe')
+    monkeypatch.setattr(checker, 'DUE_SCHEDULING', True)
+    monkeypatch.setattr(checker, 'CHECK_RETRY_BASE', 0.01)
+    monkeypatch.setattr(checker.Checker, 'fetch_certificates', staticmethod(
+        lambda domains_days: {'far.com': {'not_after': now + 90 * 86400},
+                              'near.com': {'not_after': now + 10 * 86400},
+                              'broken.com': {'error': 'timeout'}}))
+    monkeypatch.setattr(checker, 'lambda_mailer', lambda *args, **kwargs: None)
+    updates = []
+    monkeypatch.setattr(checker, 'lambda_db', lambda *args: updates.extend(args[1]))
+    records = [{'email': 'user@%s' % domain, 'domain': domain, 'days': '30', 'uuid': 'uuid'}
+               for domain in ('far.com', 'near.com', 'broken.com')]
+    result = checker.Checker.check_and_send_alert_batch(records)
+    assert result['summary']['scheduled'] == 3
+
+    next_checks = dict((update['email'], update['next_check_at'] - now) for update in updates)
+    assert abs(next_checks['user@far.com'] - schedule.MAX_CHECK_INTERVAL) < 5
+    assert abs(next_checks['user@near.com'] - 86400) < 5
+    assert abs(next_checks['user@broken.com'] - 86400) < 5
+    assert 'not_after' not in [u for u in updates if u['email'] == 'user@broken.com'][0]
+
+
+def test_next_check_at():
+    '''Test next check is when entering the alert window, within a day and max interval.'''
+    now = 1000000000
+    day = 86400
+    assert schedule.next_check_at('30', now + 35 * day, now=now) == now + 5 * day
+    assert schedule.next_check_at(30, now + 30 * day, now=now) == now + day
+    assert schedule.next_check_at(30, now + 90 * day, now=now) == \
+        now + schedule.MAX_CHECK_INTERVAL
+    assert schedule.next_check_at(30, now + 90 * day, alert=True, now=now) == now + day
+    assert schedule.next_check_at(30, None, now=now) == now + day
+
+
+def test_batch_retries_until_success(monkeypatch):
+    '''Test failing checks are retried with backoff and not lost.'''
+    failures = {'flaky.com': 2}
+
+    def check_sslexpired(domain, days):
+        if failures.get(domain):
+            failures[domain] -= 1
+            raise IOError('too many requests')
+        return {'response': 'ok'}
+
+    monkeypatch.setattr(checker, 'CHECK_RETRY_BASE', 0.01)
+    monkeypatch.setattr(checker.Checker, 'check_sslexpired', staticmethod(check_sslexpired))
+    records = [{'email': 'user@%s' % domain, 'domain': domain, 'days': '30', 'uuid': 'uuid'}
+               for domain in ('flaky.com', 'ok.com')]
+    result = checker.Checker.check_and_send_alert_batch(records)
+    assert result['summary']['errors'] == 0
+    assert result['summary']['retries'] == 2
+
+
+def test_probe_errors_are_retried(monkeypatch):
+    '''Test failed probes are retried before alerting the subscribers.'''
+    probed = []
+
+    def fetch_certificates(domains_days):
+        probed.append(sorted(domains_days))
+        if len(probed) < 3:
+            return dict((domain, {'error': 'timeout'}) for domain in domains_days)
+        return dict((domain, {'not_after': time.time() + 90 * 86400})
+                    for domain in domains_days)
+
+    monkeypatch.setattr(checker, 'CHECKER_MODE', 'probe')
+    monkeypatch.setattr(checker, 'CHECK_RETRY_BASE', 0.01)
+    monkeypatch.setattr(checker.Checker, 'fetch_certificates', staticmethod(fetch_certificates))
+    monkeypatch.setattr(checker, 'lambda_mailer', lambda *args, **kwargs: sent.append(args))
+    sent = []
+    records = [{'email': 'user@flaky.com', 'domain': 'flaky.com', 'days': '30', 'uuid': 'uuid'}]
+    result = checker.Checker.check_and_send_alert_batch(records)
+    assert probed == [['flaky.com']] * 3
+    assert result['summary']['retries'] == 2
+    assert result['summary']['alerts'] == 0
+    assert sent == []
@@ -0,0 +1,235 @@
+'''Py.test'''
+import sys
+
+sys.path.append('./lambda')
+import cron
+from sslnotifyme.checkpoint import MemoryCheckpointStore
+
+
+def test_batches_keep_domains_together(monkeypatch):
+    '''Test cron invokes lambda checker with chunks of records, domains not split.'''
+    records = [{'email': 'user%d@example.com' % i, 'domain': 'domain%d.com' % (i % 7),
+                'days': '30', 'uuid': 'uuid'} for i in range(100)]
+    invoked = []
+    monkeypatch.setattr(cron, 'CHECKER_BATCH_SIZE', 20)
+    monkeypatch.setattr(cron, 'lambda_db', lambda *args: {'response': records})
+    monkeypatch.setattr(cron, 'lambda_checker', lambda *args, **kwargs: invoked.append(args))
+    cron.Cron.scan_and_notify_alerts_queue()
+    assert all(args[0] == 'check_and_send_alert_batch' for args in invoked)
+    assert 1 < len(invoked) < 100
+    assert sum(len(args[1]) for args in invoked) == 100
+    domains = [set(record['domain'] for record in args[1]) for args in invoked]
+    assert sum(len(chunk) for chunk in domains) == 7
+
+
+def test_digest_mode(monkeypatch):
+    '''Test alerts are collected from checkers and sent as one digest per recipient.'''
+    records = [{'email': 'user%d@example.com' % (i % 2), 'domain': 'domain%d.com' % i,
+                'days': '30', 'uuid': 'uuid%d' % i} for i in range(6)]
+
+    def check(cmd, chunk, digest):
+        assert digest
+        return {'response': [dict(record, alert=True, message='alert') for record in chunk]}
+
+    mailed = []
+    monkeypatch.setattr(cron, 'DIGEST_ALERTS', True)
+    monkeypatch.setattr(cron, 'CHECKER_BATCH_SIZE', 2)
+    monkeypatch.setattr(cron, 'lambda_db', lambda *args: {'response': records})
+    monkeypatch.setattr(cron, 'lambda_checker_blocking', check)
+    monkeypatch.setattr(cron, 'lambda_mailer', lambda *args, **kwargs: mailed.append(args))
+    cron.Cron.scan_and_notify_alerts_queue()
+    assert len(mailed) == 1
+    cmd, digests = mailed[0]
+    assert cmd == 'send_alert_digests'
+    assert sorted(digests) == ['user0@example.com', 'user1@example.com']
+    assert len(digests['user0@example.com']) == 3
+
+
+def test_due_scheduling_queries_due_users(monkeypatch):
+    '''Test cron queries only due users when due scheduling is enabled.'''
+    queries = []
+    monkeypatch.setattr(cron, 'DUE_SCHEDULING', True)
+    monkeypatch.setattr(cron, 'lambda_db', lambda *args: queries.append(args) or {'response': []})
+    monkeypatch.setattr(cron, 'lambda_checker', lambda *args, **kwargs: None)
+    cron.Cron.scan_and_notify_alerts_queue()
+    assert queries == [('get_due_users_page', None, cron.USERS_PAGE_SIZE)]
+
+
+def test_due_scheduling_shards(monkeypatch):
+    '''Test due day buckets are sharded, stale records swept on the sweep day.'''
+    monkeypatch.setattr(cron, 'DUE_SCHEDULING', True)
+    monkeypatch.setattr(cron, 'CRON_SHARDS', 2)
+    monkeypatch.setattr(cron, 'sweep_day', lambda: False)
+    shards = cron.Cron.shards()
+    assert [shard['query'] for shard in shards] == ['get_due_users_page'] * len(shards)
+    monkeypatch.setattr(cron, 'sweep_day', lambda: True)
+    assert cron.Cron.shards()[len(shards):] == [
+        {'id': 'stale-%d-of-2' % segment, 'query': 'get_stale_users_page',
+         'args': [segment, 2]} for segment in range(2)]
+
+
+def test_pages_are_streamed(monkeypatch):
+    '''Test cron follows the cursor, dispatching each page before fetching the next one.'''
+    pages = {None: ('a', [{'email': 'a@example.com', 'domain': 'a.com', 'days': '30'}]),
+             'a': ('b', []),
+             'b': (None, [{'email': 'b@example.com', 'domain': 'b.com', 'days': '30'}])}
+    events = []
+
+    def fetch(cmd, cursor, page_size):
+        events.append(('fetch', cursor))
+        return {'response': pages[cursor][1], 'cursor': pages[cursor][0]}
+
+    monkeypatch.setattr(cron, 'lambda_db', fetch)
+    monkeypatch.setattr(cron, 'lambda_checker',
+                        lambda cmd, chunk, **kwargs: events.append(('check', chunk[0]['domain'])))
+    output = cron.Cron.scan_and_notify_alerts_queue()
+    assert events == [('fetch', None), ('check', 'a.com'), ('fetch', 'a'), ('fetch', 'b'),
+                      ('check', 'b.com')]
+    assert output['response'].startswith('2 record(s) for 2 domain(s)')
+
+
+
+class FakeContext(object):
+    '''Lambda context running out of time after a number of calls.'''
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def get_remaining_time_in_millis(self):
+        '''Return plenty of time for the first calls, then too little.'''
+        self.calls -= 1
+        return 300000 if self.calls >= 0 else 1000
+
+
+def test_sharded_run_resumes_from_checkpoint(monkeypatch):
+    '''Test shards are processed page by page, continuing in new invocations on timeout.'''
+    stores = {}
+    monkeypatch.setattr(cron, 'checkpoint_store', lambda run_id, name: stores.setdefault(
+        (run_id, name), MemoryCheckpointStore()))
+    monkeypatch.setattr(cron, 'CRON_SHARDS', 2)
+    monkeypatch.setattr(cron, 'DUE_SCHEDULING', False)
+
+    def fetch(cmd, cursor, page_size, segment, total_segments):
+        assert (cmd, total_segments) == ('get_validated_users_page', 2)
+        page = int(cursor or 0)
+        records = [{'email': 'user%d-%d-%d@example.com' % (segment, page, i),
+                    'domain': 'domain%d.com' % i, 'days': '30'} for i in range(3)]
+        return {'response': records, 'cursor': str(page + 1) if page < 4 else None}
+
+    checked = []
+    invocations = []
+    monkeypatch.setattr(cron, 'lambda_db', fetch)
+    monkeypatch.setattr(cron, 'lambda_checker', lambda cmd, chunk, **kwargs: checked.extend(chunk))
+    monkeypatch.setattr(cron, 'lambda_cron', lambda *args: invocations.append(args))
+
+    assert cron.Cron().start_run('run') == {'response': 'run run started with 2 shard(s)'}
+    assert invocations == [('process_shard', 'run', 'segment-0-of-2'),
+                           ('process_shard', 'run', 'segment-1-of-2')]
+    assert cron.Cron().start_run('run')['response']['shards'] == 2  # started once
+    assert len(invocations) == 2
+
+    while invocations:
+        args = invocations.pop(0)
+        cron.Cron(FakeContext(2)).process_shard(*args[1:])
+    emails = [record['email'] for record in checked]
+    assert len(emails) == len(set(emails)) == 2 * 5 * 3
+
+    summary = cron.Cron().shard_summary('run')['response']
+    assert summary['done'] == summary['shards'] == 2
+    assert summary['pending'] == []
+    assert summary['records'] == 30
+    assert summary['invocations'] == 4
+    assert summary['abandoned'] == []
+
+
+class TimeoutContext(object):
+    '''Lambda context with timeout, each call taking some time.'''
+
+    def __init__(self, timeout_ms, call_ms):
+        self.remaining = timeout_ms
+        self.call_ms = call_ms
+
+    def get_remaining_time_in_millis(self):
+        '''Return time left, then consume call_ms.'''
+        self.remaining -= self.call_ms
+        return self.remaining + self.call_ms
+
+
+def sharded_run(monkeypatch, fetch, shards=1):
+    '''Start run with fetch as lambda db, return checkpoint stores and cron invocations.'''
+    stores = {}
+    invocations = []
+    monkeypatch.setattr(cron, 'checkpoint_store', lambda run_id, name: stores.setdefault(
+        (run_id, name), MemoryCheckpointStore()))
+    monkeypatch.setattr(cron, 'CRON_SHARDS', shards)
+    monkeypatch.setattr(cron, 'DUE_SCHEDULING', False)
+    monkeypatch.setattr(cron, 'lambda_db', fetch)
+    monkeypatch.setattr(cron, 'lambda_checker', lambda cmd, chunk, **kwargs: None)
+    monkeypatch.setattr(cron, 'lambda_cron', lambda *args: invocations.append(args))
+    cron.Cron().start_run('run')
+    return stores, invocations
+
+
+def test_short_timeout_makes_progress(monkeypatch):
+    '''Test a lambda timeout shorter than CRON_MIN_REMAINING_MS still processes pages.'''
+    def fetch(cmd, cursor, page_size, *args):
+        page = int(cursor or 0)
+        return {'response': [{'email': 'user%d@example.com' % page, 'domain': 'a.com',
+                              'days': '30'}], 'cursor': str(page + 1) if page < 9 else None}
+
+    _, invocations = sharded_run(monkeypatch, fetch)
+    count = 0
+    while invocations and count < 20:
+        count += 1
+        args = invocations.pop(0)
+        cron.Cron(TimeoutContext(30000, 4000)).process_shard(*args[1:])
+    summary = cron.Cron().shard_summary('run')['response']
+    assert summary['done'] == 1
+    assert summary['pages'] == 10
+    assert summary['invocations'] == count < 10
+
+
+def test_stalled_shard_is_abandoned(monkeypatch):
+    '''Test a shard failing without progress is abandoned after CRON_MAX_STALLED attempts.'''
+    def fetch(*args):
+        return {'errorMessage': 'throttled'}
+
+    _, invocations = sharded_run(monkeypatch, fetch)
+    args = invocations.pop(0)[1:]
+    for _ in range(cron.CRON_MAX_STALLED):  # e.g. Lambda async retries
+        try:
+            cron.Cron().process_shard(*args)
+            assert False, 'fetch error not raised'
+        except RuntimeError:
+            pass
+    assert 'errorMessage' in cron.Cron().process_shard(*args)
+    assert cron.Cron().shard_summary('run')['response']['abandoned'] == ['segment-0-of-1']
+
+
+def test_failed_dispatches_are_retried(monkeypatch):
+    '''Test failed checker invocations are retried, failing the page once out of attempts.'''
+    records = [{'email': 'user%d@example.com' % i, 'domain': 'domain%d.com' % i,
+                'days': '30', 'uuid': 'uuid'} for i in range(4)]
+    failures = {'domain1.com': 1, 'domain2.com': 99}
+    invoked = []
+
+    def invoke(cmd, chunk, idempotency_key=None):
+        domain = chunk[0]['domain']
+        if failures.get(domain):
+            failures[domain] -= 1
+            raise IOError('TooManyRequestsException')
+        invoked.append(domain)
+
+    monkeypatch.setattr(cron, 'CHECKER_BATCH_SIZE', 1)
+    monkeypatch.setattr(cron, 'DISPATCH_RETRY_BASE', 0.01)
+    monkeypatch.setattr(cron, 'lambda_checker', invoke)
+    assert cron.Cron.invoke_checkers([records[i:i + 1] for i in range(2)]) == (2, [])
+    assert invoked == ['domain0.com', 'domain1.com']
+
+    try:
+        cron.Cron.dispatch_page(records)
+        assert False, 'failed dispatch not raised'
+    except RuntimeError as err:
+        assert str(err) == '1 lambda checker invocation(s) failed'
+    assert sorted(invoked[2:]) == ['domain0.com', 'domain1.com', 'domain3.com']
+    assert failures['domain2.com'] == 99 - cron.DISPATCH_MAX_ATTEMPTS
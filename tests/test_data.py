@@ -1,4 +1,5 @@
 '''Py.test'''
+import gzip
 import json
 import sys
 from moto import mock_dynamodb2, mock_s3
@@ -7,21 +8,45 @@ import boto3
 sys.path.append('./lambda')
 import data
 from sslnotifyme import (APPNAME, BACKUP_BUCKET)
+from sslnotifyme import queue as queue_module
+from sslnotifyme.queue import MemoryQueue
+from sslnotifyme.schedule import (DUE_DAY_INDEX, due_day)
+
+
+def create_tables():
+    '''Create mocked DynamoDB tables, return client.'''
+    dyn = boto3.client('dynamodb')
+    throughput = {'ReadCapacityUnits':5, 'WriteCapacityUnits':5}
+    dyn.create_table(
+        TableName='%s_pending' % APPNAME,
+        AttributeDefinitions=[
+            {'AttributeName':'email', 'AttributeType':'S'},
+        ],
+        KeySchema=[{'AttributeName':'email', 'KeyType':'HASH'}],
+        ProvisionedThroughput=throughput,
+    )
+    dyn.create_table(
+        TableName='%s_users' % APPNAME,
+        AttributeDefinitions=[
+            {'AttributeName':'email', 'AttributeType':'S'},
+            {'AttributeName':'due_day', 'AttributeType':'S'},
+        ],
+        KeySchema=[{'AttributeName':'email', 'KeyType':'HASH'}],
+        GlobalSecondaryIndexes=[{
+            'IndexName': DUE_DAY_INDEX,
+            'KeySchema': [{'AttributeName':'due_day', 'KeyType':'HASH'}],
+            'Projection': {'ProjectionType': 'ALL'},
+            'ProvisionedThroughput': throughput,
+        }],
+        ProvisionedThroughput=throughput,
+    )
+    return dyn
 
 
 @mock_dynamodb2
 def test_data_object():
     '''Test data abstraction layer.'''
-    dyn = boto3.client('dynamodb')
-    for table in ('pending', 'users'):
-        dyn.create_table(
-            TableName='%s_%s' % (APPNAME, table),
-            AttributeDefinitions=[
-                {'AttributeName':'email', 'AttributeType':'S'},
-            ],
-            KeySchema=[{'AttributeName':'email', 'KeyType':'S'}],
-            ProvisionedThroughput={'ReadCapacityUnits':5, 'WriteCapacityUnits':5},
-        )
+    create_tables()
     data_obj = data.DataStore()
     assert data_obj.get_validated_users() == {'response': []}
     assert data_obj.get_pending_users() == {'response': []}
@@ -29,6 +54,50 @@ def test_data_object():
     # https://github.com/spulec/moto/issues/873
 
 
+@mock_dynamodb2
+def test_scan_follows_pagination():
+    '''Test all records are returned when scan results span multiple pages.'''
+    dyn = create_tables()
+    for i in range(10):
+        dyn.put_item(
+            TableName='%s_users' % APPNAME,
+            Item={'email': {'S': 'user%d@example.com' % i},
+                  'domain': {'S': 'example.com'},
+                  'uuid': {'S': 'uuid%d' % i},
+                  'days': {'N': '30'}})
+    records = list(data.DataStore()._iter_records('users', page_size=3))
+    assert len(records) == 10
+    assert sorted(r['email'] for r in records) == sorted('user%d@example.com' % i
+                                                         for i in range(10))
+
+
+class FakeSegmentedClient(object):
+    '''Fake DynamoDB client serving two pages for each scan segment.'''
+    def __init__(self):
+        self.calls = []
+
+    def scan(self, **kwargs):
+        self.calls.append(kwargs)
+        segment = kwargs['Segment']
+        page = 1 if 'ExclusiveStartKey' in kwargs else 0
+        response = {'Items': [{'email': {'S': 'user%d-%d@example.com' % (segment, page)},
+                               'days': {'N': '30'}}]}
+        if not page:
+            response['LastEvaluatedKey'] = {'email': {'S': 'next'}}
+        return response
+
+
+def test_parallel_scan_segments():
+    '''Test parallel scan is split in segments, each one paginated.'''
+    data_obj = data.DataStore()
+    data_obj._client = FakeSegmentedClient()
+    records = list(data_obj._iter_records('users', segments=3))
+    assert sorted(r['email'] for r in records) == sorted(
+        'user%d-%d@example.com' % (segment, page) for segment in range(3) for page in range(2))
+    assert all(call['TotalSegments'] == 3 for call in data_obj._client.calls)
+    assert len(data_obj._client.calls) == 6
+
+
 @mock_s3
 def test_backup_object():
     '''Test S3 backup.'''
@@ -45,4 +114,284 @@ def test_backup_object():
         Bucket=BACKUP_BUCKET,
         Key=file_name,
     ).get('Body').read()
-    assert content == json.dumps(mock_data)
+    assert content.decode('utf-8') == json.dumps(mock_data)
+
+
+def read_backup(s3client, key):
+    '''Return list of JSON lines of gzip compressed backup object.'''
+    body = s3client.get_object(Bucket=BACKUP_BUCKET, Key=key)['Body'].read()
+    return [json.loads(line) for line in gzip.decompress(body).decode('utf-8').splitlines()]
+
+
+@mock_s3
+def test_backup_writer_multipart(monkeypatch):
+    '''Test backup writer uploads gzip compressed JSON lines in multiple parts.'''
+    monkeypatch.setattr('moto.s3.models.S3_UPLOAD_PART_MIN_SIZE', 1)
+    monkeypatch.setattr(data, 'UPLOAD_PART_SIZE', 1024)
+    s3client = boto3.client('s3')
+    s3client.create_bucket(Bucket=BACKUP_BUCKET)
+
+    writer = data.Backup('dynamodb-').writer('test.jsonl.gz')
+    records = [{'email': 'user%d@example.com' % i, 'payload': str(i) * 64} for i in range(500)]
+    for record in records:
+        writer.write(record)
+    assert writer.close() > 1024
+    assert writer.lines == 500
+    assert writer._upload._parts[-1]['PartNumber'] > 1
+    assert read_backup(s3client, 'test.jsonl.gz') == records
+
+
+@mock_s3
+@mock_dynamodb2
+def test_backup_tables_incremental(monkeypatch):
+    '''Test full backup followed by incremental one storing only changes.'''
+    create_tables()
+    s3client = boto3.client('s3')
+    s3client.create_bucket(Bucket=BACKUP_BUCKET)
+    store = data.DataStore()
+    for i in range(3):
+        store.put_user_to_users('user%d@example.com' % i, 'example.com', 30, 'uuid%d' % i)
+
+    monkeypatch.setattr(data, 'time', lambda: 1000000)
+    result = store.backup_tables()
+    assert result['type'] == 'full'
+    assert result['counts']['users'] == {'records': 3, 'changed': 3, 'deleted': 0}
+    full_key = result['response'].split('/').pop()
+    assert len(read_backup(s3client, full_key)) == 3
+
+    store.put_user_to_users('user0@example.com', 'example.org', 30, 'uuid0')
+    store.delete_validated_user('user1@example.com', 'uuid1')
+    monkeypatch.setattr(data, 'time', lambda: 1000060)
+    result = store.backup_tables()
+    assert result['type'] == 'incremental'
+    assert result['counts']['users'] == {'records': 2, 'changed': 1, 'deleted': 1}
+    lines = read_backup(s3client, result['response'].split('/').pop())
+    assert {'table': 'users', 'deleted': 'user1@example.com'} in lines
+    assert [line['record']['domain'] for line in lines if 'record' in line] == ['example.org']
+
+    manifest = json.loads(s3client.get_object(
+        Bucket=BACKUP_BUCKET, Key='dynamodb-latest.manifest.json')['Body'].read().decode('utf-8'))
+    assert manifest['base'] == full_key
+    assert manifest['incrementals'] == [result['response'].split('/').pop()]
+
+    assert manifest['base_created'] == 1000000
+
+    # hourly backups are incremental until the base is FULL_BACKUP_INTERVAL old
+    monkeypatch.setattr(data, 'FULL_BACKUP_INTERVAL', 4 * 3600)
+    types = []
+    for hour in range(1, 9):
+        monkeypatch.setattr(data, 'time', lambda hour=hour: 1000000 + hour * 3600)
+        types.append(store.backup_tables()['type'])
+    assert types == ['incremental'] * 3 + ['full'] + ['incremental'] * 3 + ['full']
+    manifest = json.loads(s3client.get_object(
+        Bucket=BACKUP_BUCKET, Key='dynamodb-latest.manifest.json')['Body'].read().decode('utf-8'))
+    assert (manifest['base_created'], manifest['incrementals']) == (1000000 + 8 * 3600, [])
+
+
+@mock_s3
+@mock_dynamodb2
+def test_restore_backup_manifest(monkeypatch):
+    '''Test restore applies full backup and incrementals into empty tables.'''
+    dyn = create_tables()
+    boto3.client('s3').create_bucket(Bucket=BACKUP_BUCKET)
+    store = data.DataStore()
+    for i in range(60):
+        store.put_user_to_users('user%d@example.com' % i, 'example.com', 30, 'uuid%d' % i)
+    store.put_user_to_pending('pending@example.com', 'example.com', 30)
+    monkeypatch.setattr(data, 'time', lambda: 1000000)
+    store.backup_tables()
+    store.put_user_to_users('user0@example.com', 'example.org', 30, 'uuid0')
+    store.delete_validated_user('user1@example.com', 'uuid1')
+    monkeypatch.setattr(data, 'time', lambda: 1000060)
+    store.backup_tables()
+    expected = sorted(store.get_validated_users()['response'], key=lambda r: r['email'])
+
+    for table in ('pending', 'users'):
+        dyn.delete_table(TableName='%s_%s' % (APPNAME, table))
+    create_tables()
+    result = store.restore_backup(workers=4)
+    assert result['response'] == {'users': 61, 'pending': 1, 'deleted': 1}
+    assert sorted(store.get_validated_users()['response'],
+                  key=lambda r: r['email']) == expected
+    assert [r['email'] for r in store.get_pending_users()['response']] == ['pending@example.com']
+
+
+@mock_s3
+@mock_dynamodb2
+def test_restore_legacy_backup():
+    '''Test restore of JSON backups written by Backup.persist.'''
+    create_tables()
+    boto3.client('s3').create_bucket(Bucket=BACKUP_BUCKET)
+    users = [{'email': 'user@example.com', 'domain': 'example.com', 'days': '30', 'uuid': 'a'}]
+    url = data.Backup('dynamodb-').persist({'users': users, 'pending': []})['response']
+
+    store = data.DataStore()
+    result = store.restore_backup(url.split('/').pop())
+    assert result['response'] == {'users': 1, 'pending': 0, 'deleted': 0}
+    assert store.get_validated_users()['response'] == users
+
+
+def test_batch_write_retries_unprocessed_items():
+    '''Test UnprocessedItems are written again until none is left.'''
+    calls = []
+
+    class FakeClient(object):
+        '''BatchWriteItem returning the last item as unprocessed at first call.'''
+        @staticmethod
+        def batch_write_item(RequestItems):
+            calls.append(RequestItems)
+            if len(calls) == 1:
+                return {'UnprocessedItems': dict((table, reqs[-1:])
+                                                 for table, reqs in RequestItems.items())}
+            return {'UnprocessedItems': {}}
+
+    store = data.DataStore()
+    store._client = FakeClient()
+    requests = [('users', {'PutRequest': {'Item': {'email': {'S': str(i)}}}}) for i in range(3)]
+    assert store._batch_write(requests) == 3
+    assert len(calls) == 2
+    assert list(calls[1].values())[0] == [requests[-1][1]]
+
+
+@mock_dynamodb2
+def test_validate_and_delete_user_check_uuid():
+    '''Test validation and deletion happen only with the right uuid, and only once.'''
+    create_tables()
+    store = data.DataStore()
+    uuid = store.put_user_to_pending('user@example.com', 'example.com', 30)['uuid']
+
+    wrong = {'errorMessage': 'user not found or wrong uuid'}
+    assert store.validate_pending_user('user@example.com', 'wrong') == wrong
+    assert store.validate_pending_user('nobody@example.com', uuid) == wrong
+    assert len(store.get_pending_users()['response']) == 1
+
+    assert store.validate_pending_user('user@example.com', uuid) == {
+        'response': 'user validation successful'}
+    assert store.validate_pending_user('user@example.com', uuid) == wrong
+    assert store.get_pending_users()['response'] == []
+    validated = store.get_validated_users()['response']
+    assert len(validated) == 1
+    assert validated[0]['email'] == 'user@example.com'
+    assert validated[0]['domain'] == 'example.com'
+    assert validated[0]['days'] == '30'
+    assert validated[0]['uuid'] == uuid
+    assert validated[0]['due_day'] == due_day(int(validated[0]['next_check_at']))
+
+    assert store.delete_validated_user('user@example.com', 'wrong') == wrong
+    assert store.delete_validated_user('user@example.com', uuid) == {
+        'response': 'user deletion successful'}
+    assert store.delete_validated_user('user@example.com', uuid) == wrong
+    assert store.get_validated_users()['response'] == []
+
+
+def due_users(store, query='get_due_users_page'):
+    '''Return all the records of paged query.'''
+    records = []
+    cursor = None
+    while True:
+        page = getattr(store, query)(cursor)
+        records.extend(page['response'])
+        cursor = page['cursor']
+        if not cursor:
+            return records
+
+
+@mock_dynamodb2
+def test_due_users_schedule(monkeypatch):
+    '''Test only users due today or in the past days are returned, until rescheduled.'''
+    create_tables()
+    store = data.DataStore()
+    for i in range(3):
+        store.put_user_to_users('user%d@example.com' % i, 'example.com', 30, 'uuid%d' % i)
+    assert len(due_users(store)) == 3
+
+    now = int(data.time())
+    store.update_schedules([
+        {'email': 'user0@example.com', 'next_check_at': now + 10 * 86400, 'not_after': now},
+        {'email': 'user1@example.com', 'next_check_at': now - 86400},
+        {'email': 'gone@example.com', 'next_check_at': now},
+    ])
+    due = dict((record['email'], record) for record in due_users(store))
+    assert sorted(due) == ['user1@example.com', 'user2@example.com']
+    assert [r['not_after'] for r in store.get_validated_users()['response']
+            if r['email'] == 'user0@example.com'] == [str(now)]
+    assert 'gone@example.com' not in [r['email'] for r in store.get_validated_users()['response']]
+
+
+@mock_dynamodb2
+def test_backfill_schedule():
+    '''Test records stored before scheduling are made due today.'''
+    dyn = create_tables()
+    dyn.put_item(TableName='%s_users' % APPNAME, Item={
+        'email': {'S': 'old@example.com'}, 'domain': {'S': 'example.com'},
+        'days': {'N': '30'}, 'uuid': {'S': 'uuid'}})
+    store = data.DataStore()
+    assert due_users(store) == []
+    assert store.backfill_schedule() == {'response': '1 record(s) scheduled'}
+    assert [r['email'] for r in due_users(store)] == ['old@example.com']
+
+
+@mock_dynamodb2
+def test_stale_users_are_swept():
+    '''Test records due before the lookback, or never scheduled, are found by the sweep.'''
+    dyn = create_tables()
+    store = data.DataStore()
+    for i in range(3):
+        store.put_user_to_users('user%d@example.com' % i, 'example.com', 30, 'uuid%d' % i)
+    dyn.put_item(TableName='%s_users' % APPNAME, Item={
+        'email': {'S': 'old@example.com'}, 'domain': {'S': 'example.com'},
+        'days': {'N': '30'}, 'uuid': {'S': 'uuid'}})
+    store.update_schedules([{'email': 'user0@example.com',
+                             'next_check_at': data.time() - 30 * 86400}])
+    assert sorted(r['email'] for r in due_users(store)) == [
+        'user1@example.com', 'user2@example.com']
+    assert sorted(r['email'] for r in due_users(store, 'get_stale_users_page')) == [
+        'old@example.com', 'user0@example.com']
+
+
+@mock_dynamodb2
+def test_paged_queries():
+    '''Test paged queries return all records following the cursors.'''
+    create_tables()
+    store = data.DataStore()
+    for i in range(25):
+        store.put_user_to_users('user%d@example.com' % i, 'example.com', 30, 'uuid%d' % i)
+
+    for query in (store.get_validated_users_page, store.get_due_users_page):
+        emails = []
+        cursor = None
+        while True:
+            page = query(cursor, 10)
+            assert len(page['response']) <= 10
+            emails.extend(record['email'] for record in page['response'])
+            cursor = page['cursor']
+            if not cursor:
+                break
+        assert sorted(emails) == sorted('user%d@example.com' % i for i in range(25))
+
+    assert 'errorMessage' in store.get_validated_users_page('not a cursor')
+
+
+@mock_dynamodb2
+def test_bulk_import_to_pending(tmpdir, monkeypatch):
+    '''Test imported rows are batch written to pending table, activation emails queued.'''
+    create_tables()
+    queue = MemoryQueue()
+    monkeypatch.setattr(queue_module, '_QUEUES', {'sqs': queue})
+    path = tmpdir.join('users.csv')
+    path.write('email,domain,days\n' + ''.join(
+        'user%d@example.com,domain%d.com,%d\n' % (i, i, i + 1) for i in range(60)) +
+               'user0@example.com,other.com,10\n')
+    report = data.import_file(str(path))
+    assert report['imported'] == 60
+    assert report['rows'][-1] == {'row': 61, 'email': 'user0@example.com', 'status': 'error',
+                                  'error': 'duplicate email'}
+    pending = dict((record['email'], record)
+                   for record in data.DataStore().get_pending_users()['response'])
+    assert len(pending) == 60
+    assert pending['user59@example.com']['days'] == '60'
+    messages = queue.receive(100)
+    assert len(messages) == 60
+    action = messages[0]['body']['action']
+    assert action[:4] == ['send_activation_link', 'user0@example.com', 'domain0.com', 1]
+    assert action[4] == pending['user0@example.com']['uuid']
@@ -0,0 +1,84 @@
+'''Py.test'''
+import sys
+from moto import mock_dynamodb2
+import boto3
+
+sys.path.append('./lambda')
+import cron
+import sslnotifyme
+from sslnotifyme import idempotency
+from sslnotifyme.idempotency import (DynamoDBIdempotencyStore, MemoryIdempotencyStore)
+
+
+def check_store(store):
+    '''Check claims fail while running or completed, succeed after release or expiry.'''
+    assert store.claim('a', now=1000)
+    assert not store.claim('a', now=1001)  # running
+    store.release('a')
+    assert store.claim('a', now=1002)
+    store.complete('a', now=1003)
+    assert not store.claim('a', now=1050)  # completed
+    assert store.claim('a', now=1003 + 100)  # completion expired
+    assert store.claim('b', now=1000)
+    assert store.claim('b', now=1000 + 10)  # claim of crashed invocation expired
+
+
+def test_memory_store():
+    '''Test memory store claims.'''
+    check_store(MemoryIdempotencyStore(ttl=100, lock_ttl=10))
+
+
+@mock_dynamodb2
+def test_dynamodb_store():
+    '''Test DynamoDB store claims, keys expire via the ttl attribute.'''
+    dyn = boto3.client('dynamodb')
+    dyn.create_table(
+        TableName='idempotency',
+        AttributeDefinitions=[{'AttributeName': 'key', 'AttributeType': 'S'}],
+        KeySchema=[{'AttributeName': 'key', 'KeyType': 'HASH'}],
+        ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5},
+    )
+    check_store(DynamoDBIdempotencyStore('idempotency', dyn, ttl=100, lock_ttl=10))
+    assert dyn.get_item(TableName='idempotency',
+                        Key={'key': {'S': 'a'}})['Item']['ttl'] == {'N': '1113'}
+
+
+class Proxy(object):
+    '''Lambda commands counting their calls.'''
+    calls = []
+
+    def send(self, email):
+        '''Fail for bounce@example.com.'''
+        self.calls.append(email)
+        if email == 'bounce@example.com':
+            return {'errorMessage': 'bounced'}
+        return {'response': 'sent'}
+
+
+def test_wrapper_skips_completed_actions(monkeypatch):
+    '''Test actions are run once per idempotency key, failed ones run again.'''
+    monkeypatch.setattr(idempotency, '_STORE', [MemoryIdempotencyStore()])
+    Proxy.calls = []
+    for _ in range(2):
+        for email in ('a@example.com', 'bounce@example.com'):
+            sslnotifyme.lambda_main_wrapper(
+                {'action': ['send', email], 'idempotency_key': 'send:%s' % email}, Proxy)
+    output = sslnotifyme.lambda_main_wrapper(
+        {'action': ['send', 'a@example.com'], 'idempotency_key': 'send:a@example.com'}, Proxy)
+    assert output == {'response': 'action send:a@example.com already processed'}
+    sslnotifyme.lambda_main_wrapper({'action': ['send', 'a@example.com']}, Proxy)
+    assert Proxy.calls == ['a@example.com', 'bounce@example.com', 'bounce@example.com',
+                           'a@example.com']
+
+
+def test_retried_page_reuses_keys(monkeypatch):
+    '''Test checker invocations of a page dispatched again carry the same keys.'''
+    records = [{'email': 'user%d@example.com' % i, 'domain': 'domain%d.com' % (i % 3),
+                'days': '30', 'uuid': 'uuid'} for i in range(9)]
+    keys = []
+    monkeypatch.setattr(cron, 'CHECKER_BATCH_SIZE', 3)
+    monkeypatch.setattr(cron, 'lambda_checker',
+                        lambda cmd, chunk, idempotency_key=None: keys.append(idempotency_key))
+    cron.Cron.dispatch_page(records, 'cron:2017-06-01:segment-0-of-4:7')
+    cron.Cron.dispatch_page(records, 'cron:2017-06-01:segment-0-of-4:7')
+    assert keys == ['cron:2017-06-01:segment-0-of-4:7:%d' % i for i in range(3)] * 2
@@ -0,0 +1,51 @@
+'''Py.test'''
+import json
+import logging
+import sys
+
+sys.path.append('./lambda')
+import sslnotifyme
+from sslnotifyme import logs
+
+
+def test_sampling_filter_keeps_errors():
+    '''Test INFO records are sampled at rate, warnings and errors are always kept.'''
+    values = iter([0.05, 0.5, 0.09, 0.95])
+    sampler = logs.SamplingFilter(rate=0.1, rand=lambda: next(values))
+
+    def record(level):
+        return logging.LogRecord('sslnotifyme.records', level, __file__, 1, 'msg', (), None)
+
+    assert [sampler.filter(record(logging.INFO)) for _ in range(4)] == [True, False, True,
+                                                                          False]
+    assert sampler.filter(record(logging.WARNING))
+    assert sampler.filter(record(logging.ERROR))
+    assert logs.SamplingFilter(rate=1, rand=lambda: 1).filter(record(logging.INFO))
+
+
+class Proxy(object):
+    '''Lambda commands summarizing their work.'''
+
+    @staticmethod
+    def process(records):
+        '''Count records, failing ones are errors.'''
+        for record in records:
+            logs.summarize(records=1, errors=int(record == 'bad'), retries=0)
+        return {'response': 'ok'}
+
+
+def test_wrapper_prints_one_summary(capsys):
+    '''Test each invocation prints one summary line, counts reset afterwards.'''
+    sslnotifyme.lambda_main_wrapper({'action': ['process', ['a', 'bad', 'b']]}, Proxy)
+    sslnotifyme.lambda_main_wrapper({'action': ['process', []]}, Proxy)
+    lines = [line for line in capsys.readouterr().out.splitlines()
+             if line.startswith(logs.SUMMARY_PREFIX)]
+    assert [json.loads(line) for line in lines] == [
+        {'_summary': {'command': 'process', 'records': 3, 'alerts': 0, 'errors': 1,
+                      'skipped': 0, 'retries': 0}},
+        {'_summary': {'command': 'process', 'records': 0, 'alerts': 0, 'errors': 0,
+                      'skipped': 0}},
+    ]
+    assert logs.parse_summary(lines[0]) == (
+        'process', {'records': 3, 'alerts': 0, 'errors': 1, 'skipped': 0, 'retries': 0})
+    assert logs.parse_summary('[ERROR] {"_summary"') is None
@@ -0,0 +1,115 @@
+'''Py.test'''
+import json
+import sys
+from botocore.exceptions import ClientError
+
+sys.path.append('./lambda')
+import mailer
+from sslnotifyme.queue import MemoryQueue
+
+
+def test_alert_digests_batches(monkeypatch):
+    '''Test one email per recipient is sent, batches throttled to SES max send rate.'''
+    sent = []
+    sleeps = []
+    monkeypatch.setattr(mailer, 'send_ses_email', lambda *args: sent.append(args))
+    monkeypatch.setattr(mailer, 'ses_max_send_rate', lambda: 2)
+    monkeypatch.setattr(mailer, 'sleep', sleeps.append)
+    digests = dict(('user%d@example.com' % i,
+                    [{'domain': 'domain%d.com' % j, 'message': 'expiring domain%d.com' % j,
+                      'uuid': 'uuid%d' % j} for j in range(i + 1)])
+                   for i in range(5))
+    result = mailer.Mailer.send_alert_digests(digests)
+    assert result == {'response': {'sent': 5, 'failed': []}}
+    assert len(sent) == 5
+    assert len(sleeps) == 2
+    send_to, subject, body, tag = sent[-1]
+    assert send_to == 'user4@example.com'
+    assert subject == 'SSL alert for 5 domains'
+    assert tag == 'ExpiryAlert'
+    for j in range(5):
+        assert 'unsubscribe.html?user=user4@example.com&uuid=uuid%d' % j in body
+
+
+class FakeSES(object):
+    '''SES client throttling the first sends.'''
+    def __init__(self, throttled):
+        self.throttled = throttled
+        self.sent = []
+
+    def send_email(self, **kwargs):
+        '''Raise throttling error, then send.'''
+        if self.throttled:
+            self.throttled -= 1
+            raise ClientError({'Error': {'Code': 'Throttling',
+                                                'Message': 'Maximum sending rate exceeded.'}},
+                                     'SendEmail')
+        self.sent.append(kwargs['Destination']['ToAddresses'][0])
+
+    @staticmethod
+    def get_send_quota():
+        '''Return SES quota.'''
+        return {'MaxSendRate': 14.0}
+
+
+def test_throttled_emails_are_retried(monkeypatch):
+    '''Test emails throttled by SES are retried, rate shared by concurrent mailers.'''
+    ses = FakeSES(throttled=2)
+    sleeps = []
+    monkeypatch.setattr(mailer, 'aws_client', lambda service: ses)
+    monkeypatch.setattr(mailer, 'sleep', sleeps.append)
+    monkeypatch.setattr(mailer, 'MAILER_CONCURRENCY', 4)
+    assert mailer.ses_max_send_rate() == 3
+    result = mailer.Mailer.send_alert_digests({'user@example.com': [
+        {'domain': 'example.com', 'message': 'expiring', 'uuid': 'uuid'}]})
+    assert result == {'response': {'sent': 1, 'failed': []}}
+    assert ses.sent == ['user@example.com']
+    assert len(sleeps) == 2
+
+    ses.throttled = mailer.SES_MAX_ATTEMPTS
+    assert 'errorMessage' in mailer.Mailer.send_alert('user@example.com', 'example.com',
+                                                      'expiring', 'uuid')
+
+
+def test_queued_records_report_failures(monkeypatch):
+    '''Test SQS records are run as mailer commands, only the failed ones reported.'''
+    sent = []
+
+    def send(send_to, subject, body, tag='notag'):
+        '''Fail sending to bounce@example.com.'''
+        if send_to == 'bounce@example.com':
+            raise ClientError({'Error': {'Code': 'MessageRejected', 'Message': 'rejected'}},
+                              'SendEmail')
+        sent.append(send_to)
+
+    monkeypatch.setattr(mailer, 'send_ses_email', send)
+    monkeypatch.setattr(mailer, 'ses_max_send_rate', lambda: 10)
+    records = [{'messageId': str(i), 'body': json.dumps(
+        {'action': ['send_activation_link', email, 'example.com', 30, 'uuid']})}
+               for i, email in enumerate(['a@example.com', 'bounce@example.com'])]
+    records.append({'messageId': '2', 'body': json.dumps({'action': ['process_records']})})
+    assert mailer.lambda_main({'Records': records}, None) == \
+        {'batchItemFailures': [{'itemIdentifier': '1'}]}
+    assert sent == ['a@example.com']
+
+
+def test_drain_queue_retries(monkeypatch):
+    '''Test draining the mail queue, failed messages are retried up to max_receives times.'''
+    queue = MemoryQueue(max_receives=3)
+    attempts = []
+
+    def send(send_to, subject, body, tag='notag'):
+        '''Fail the first attempt of each email.'''
+        attempts.append(send_to)
+        if attempts.count(send_to) == 1:
+            raise ClientError({'Error': {'Code': 'ServiceUnavailable', 'Message': 'down'}},
+                              'SendEmail')
+
+    monkeypatch.setattr(mailer, 'mail_queue', lambda: queue)
+    monkeypatch.setattr(mailer, 'send_ses_email', send)
+    monkeypatch.setattr(mailer, 'ses_max_send_rate', lambda: 100)
+    queue.send_batch([{'action': ['send_activation_link', 'user%d@example.com' % i,
+                                  'example.com', 30, 'uuid']} for i in range(15)])
+    assert mailer.Mailer.drain_queue() == {'response': {'processed': 15, 'failed': 15}}
+    assert len(attempts) == 30
+    assert len(queue) == 0 and queue.dead == []
@@ -0,0 +1,87 @@
+'''Py.test'''
+import json
+import sys
+from moto import mock_dynamodb2
+
+sys.path.append('./lambda')
+import sslnotifyme
+from sslnotifyme import metrics
+
+
+class Proxy(object):
+    '''lambda_main_wrapper proxy with a failing and a successful command.'''
+    @staticmethod
+    def hello(name):
+        '''Return greeting.'''
+        return {'response': 'hello %s' % name}
+
+    @staticmethod
+    def fail():
+        '''Return error.'''
+        return {'errorMessage': 'failed'}
+
+
+def test_emf_lines():
+    '''Test metrics are grouped by dimensions in EMF lines of at most 100 values.'''
+    collector = metrics.EMFCollector(namespace='test')
+    for i in range(150):
+        collector.record('Duration', i, 'Milliseconds', {'Command': 'a'})
+    collector.record('Size', 10, 'Bytes', {'Command': 'a'})
+    collector.record('Duration', 5, 'Milliseconds', {'Command': 'b'})
+    lines = [json.loads(line) for line in collector.lines(collector.records, timestamp=1)]
+    assert len(lines) == 3
+    assert lines[0]['_aws'] == {'Timestamp': 1000, 'CloudWatchMetrics': [{
+        'Namespace': 'test', 'Dimensions': [['Command']],
+        'Metrics': [{'Name': 'Duration', 'Unit': 'Milliseconds'},
+                    {'Name': 'Size', 'Unit': 'Bytes'}]}]}
+    assert lines[0]['Duration'] == list(range(100))
+    assert lines[0]['Size'] == 10
+    assert lines[1]['Duration'] == list(range(100, 150))
+    assert 'Size' not in lines[1]
+    assert (lines[2]['Command'], lines[2]['Duration']) == ('b', 5)
+
+
+def test_wrapper_records_and_flushes(monkeypatch):
+    '''Test wrapper times commands, counts errors and prints EMF lines once done.'''
+    printed = []
+    monkeypatch.setattr(metrics, '_COLLECTOR', metrics.EMFCollector(output=printed.append))
+    assert sslnotifyme.lambda_main_wrapper({'action': ['hello', 'world']}, Proxy) == {
+        'response': 'hello world'}
+    sslnotifyme.lambda_main_wrapper({'action': ['fail']}, Proxy)
+    lines = [json.loads(line) for line in printed]
+    assert [(line['Command'], line['CommandErrors']) for line in lines] == [
+        ('hello', 0), ('fail', 1)]
+    assert all(line['CommandDuration'] >= 0 for line in lines)
+    assert metrics.collector().records == []
+
+
+@mock_dynamodb2
+def test_aws_calls_instrumented(monkeypatch):
+    '''Test registry clients record duration, retries and sizes of API calls.'''
+    collector = metrics.MemoryCollector()
+    monkeypatch.setattr(metrics, '_COLLECTOR', collector)
+    sslnotifyme.reset_aws_clients()
+    sslnotifyme.aws_client('dynamodb').list_tables()
+    sslnotifyme.reset_aws_clients()
+    dimensions = {'Service': 'dynamodb', 'Operation': 'ListTables'}
+    assert len(collector.values('AWSCallDuration', **dimensions)) == 1
+    assert collector.values('AWSCallRetries', **dimensions) == [0]
+    assert collector.values('AWSRequestSize', **dimensions)[0] > 0
+    assert collector.values('AWSCallErrors', **dimensions) == []
+
+
+def test_lambda_invocations_instrumented(monkeypatch):
+    '''Test lambda invocations record duration and payload sizes.'''
+    import mailer
+    collector = metrics.MemoryCollector()
+    monkeypatch.setattr(metrics, '_COLLECTOR', collector)
+    monkeypatch.setattr(sslnotifyme, 'LAMBDA_TRANSPORT', 'local')
+    monkeypatch.setattr(mailer, 'send_ses_email', lambda *args, **kwargs: None)
+    sslnotifyme.lambda_mailer_blocking('send_feedback', 'hello')
+    dimensions = {'Function': 'mailer', 'Command': 'send_feedback',
+                  'InvocationType': 'RequestResponse'}
+    assert collector.values('LambdaPayloadSize', **dimensions) == [
+        len(json.dumps({'action': ['send_feedback', 'hello']}))]
+    assert len(collector.values('LambdaResponseSize', **dimensions)) == 1
+    assert len(collector.values('LambdaInvokeDuration', **dimensions)) == 1
+    assert len(collector.values('CommandDuration', Command='send_feedback')) == 1
@@ -0,0 +1,119 @@
+'''Py.test'''
+import socket
+import ssl
+import sys
+import threading
+from datetime import (datetime, timedelta)
+
+import pytest
+
+sys.path.append('./lambda')
+import checker
+from sslnotifyme.probe import (probe_certificates, expiry_result, parse_not_after)
+
+x509 = pytest.importorskip('cryptography.x509')
+from cryptography.hazmat.primitives import (hashes, serialization)
+from cryptography.hazmat.primitives.asymmetric import ec
+
+
+def make_certificate(tmpdir, not_after):
+    '''Write self-signed certificate expiring at not_after, return (cert, key) paths.'''
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, 'localhost')])
+    cert = (x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(not_after - timedelta(days=365))
+            .not_valid_after(not_after)
+            .sign(key, hashes.SHA256()))
+    cert_path = tmpdir.join('cert.pem')
+    key_path = tmpdir.join('key.pem')
+    cert_path.write_binary(cert.public_bytes(serialization.Encoding.PEM))
+    key_path.write_binary(key.private_bytes(serialization.Encoding.PEM,
+                                            serialization.PrivateFormat.PKCS8,
+                                            serialization.NoEncryption()))
+    return str(cert_path), str(key_path)
+
+
+def serve_tls(cert_path, key_path):
+    '''Start TLS server in background thread, return listening port.'''
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+
+    def serve():
+        while True:
+            conn, _ = sock.accept()
+            try:
+                context.wrap_socket(conn, server_side=True).close()
+            except (OSError, ssl.SSLError):
+                conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return sock.getsockname()[1]
+
+
+def epoch(moment):
+    '''Return UNIX epoch of naive UTC datetime, second precision.'''
+    return int((moment - datetime(1970, 1, 1)).total_seconds())
+
+
+@pytest.mark.parametrize('days_left', [-3, 10, 90])
+def test_probe_reads_not_after(tmpdir, days_left):
+    '''Test probe returns notAfter of the certificate served by a local TLS server.'''
+    not_after = datetime.utcnow().replace(microsecond=0) + timedelta(days=days_left, hours=1)
+    port = serve_tls(*make_certificate(tmpdir, not_after))
+    domain = '127.0.0.1:%d' % port
+    assert probe_certificates([domain], timeout=5) == {domain: {'not_after': epoch(not_after)}}
+
+
+def test_probe_many_domains(tmpdir):
+    '''Test many domains are probed concurrently and failures reported per domain.'''
+    not_after = datetime.utcnow().replace(microsecond=0) + timedelta(days=30)
+    port = serve_tls(*make_certificate(tmpdir, not_after))
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    domains = ['127.0.0.1:%d' % port, 'localhost:%d' % port,
+               '127.0.0.1:%d' % closed.getsockname()[1]]
+    results = probe_certificates(domains, timeout=5, concurrency=2)
+    closed.close()
+    assert results[domains[0]] == results[domains[1]] == {'not_after': epoch(not_after)}
+    assert 'error' in results[domains[2]]
+
+
+def test_parse_not_after(tmpdir):
+    '''Test DER parsing matches the standard library certificate decoder.'''
+    not_after = datetime(2051, 6, 1, 12, 30, 15)  # GeneralizedTime after 2049
+    cert_path, _ = make_certificate(tmpdir, not_after)
+    der = ssl.PEM_cert_to_DER_cert(open(cert_path).read())
+    assert parse_not_after(der) == epoch(not_after)
+
+
+def test_expiry_result():
+    '''Test alert state is computed from notAfter and days threshold.'''
+    now = 1000000000
+    probe = {'not_after': now + 20 * 86400 + 60}
+    assert 'alert' in expiry_result('example.com', probe, 30, now)
+    assert 'alert' not in expiry_result('example.com', probe, 10, now)
+    assert 'alert' in expiry_result('example.com', {'not_after': now - 1}, 10, now)
+    assert expiry_result('example.com', {'error': 'timeout'}, 10, now)['err'] == 'timeout'
+
+
+def test_checker_probe_mode(tmpdir, monkeypatch):
+    '''Test checker alerts subscribers by threshold probing the domain once.'''
+    not_after = datetime.utcnow() + timedelta(days=15, hours=1)
+    port = serve_tls(*make_certificate(tmpdir, not_after))
+    domain = '127.0.0.1:%d' % port
+    monkeypatch.setattr(checker, 'CHECKER_MODE', 'probe')
+    sent = []
+    monkeypatch.setattr(checker, 'lambda_mailer', lambda *args, **kwargs: sent.append(args[1]))
+    records = [{'email': 'user%d@example.com' % days, 'domain': domain,
+                'days': str(days), 'uuid': 'uuid'} for days in (10, 30)]
+    checker.Checker.check_domain_and_send_alerts(domain, records)
+    assert sent == ['user30@example.com']
@@ -0,0 +1,120 @@
+'''Py.test'''
+import sys
+
+sys.path.append('./lambda')
+from sslnotifyme import queue as queue_module
+from sslnotifyme.queue import (FileQueue, MemoryQueue, SQSQueue)
+
+
+def check_queue(queue):
+    '''Check messages are received once, deleted when processed, redelivered when released.'''
+    ids = queue.send_batch([{'action': ['cmd', i]} for i in range(3)])
+    assert len(ids) == 3
+    assert queue.send({'action': ['cmd', 3]}) not in ids
+    assert len(queue) == 4
+
+    first = queue.receive(2)
+    second = queue.receive(10)
+    assert len(first) == 2 and len(second) == 2
+    assert sorted(msg['body']['action'][1] for msg in first + second) == [0, 1, 2, 3]
+    assert queue.receive() == []
+
+    for msg in first + second[1:]:
+        queue.delete(msg['receipt'])
+    queue.release(second[0]['receipt'])
+    return second[0]['body']
+
+
+def test_memory_queue():
+    '''Test memory queue delivery, released messages are dead after max_receives.'''
+    queue = MemoryQueue(max_receives=2)
+    released = check_queue(queue)
+    redelivered = queue.receive()
+    assert [msg['body'] for msg in redelivered] == [released]
+    queue.release(redelivered[0]['receipt'])
+    assert queue.receive() == []
+    assert queue.dead == [released]
+
+
+def test_file_queue(tmpdir):
+    '''Test file queue delivery, messages persist across queue instances.'''
+    queue = FileQueue(str(tmpdir), max_receives=2)
+    released = check_queue(queue)
+    redelivered = FileQueue(str(tmpdir), max_receives=2).receive()
+    assert [msg['body'] for msg in redelivered] == [released]
+    queue.release(redelivered[0]['receipt'])
+    assert queue.receive() == []
+    assert len(tmpdir.join('dead').listdir()) == 1
+
+
+class FakeSQS(object):
+    '''SQS client keeping one queue in memory, moto doesn't speak the SQS JSON protocol.'''
+    def __init__(self):
+        self.messages = {}
+        self.inflight = {}
+        self.batches = []
+        self.sent = 0
+
+    @staticmethod
+    def get_queue_url(QueueName):
+        '''Return queue URL.'''
+        return {'QueueUrl': 'https://sqs.us-east-1.amazonaws.com/123456789012/%s' % QueueName}
+
+    # pylint: disable=unused-argument
+    def get_queue_attributes(self, **kwargs):
+        '''Return number of visible messages.'''
+        return {'Attributes': {'ApproximateNumberOfMessages': str(len(self.messages))}}
+
+    def send_message(self, **kwargs):
+        '''Enqueue message.'''
+        result = self.send_message_batch(
+            QueueUrl=kwargs['QueueUrl'],
+            Entries=[{'Id': '0', 'MessageBody': kwargs['MessageBody']}])
+        return {'MessageId': result['Successful'][0]['MessageId']}
+
+    def send_message_batch(self, **kwargs):
+        '''Enqueue at most 10 messages.'''
+        assert len(kwargs['Entries']) <= 10
+        self.batches.append(len(kwargs['Entries']))
+        successful = []
+        for entry in kwargs['Entries']:
+            self.sent += 1
+            msg_id = 'msg%03d' % self.sent
+            self.messages[msg_id] = entry['MessageBody']
+            successful.append({'Id': entry['Id'], 'MessageId': msg_id})
+        return {'Successful': successful, 'Failed': []}
+
+    def receive_message(self, **kwargs):
+        '''Return up to MaxNumberOfMessages messages, hidden until deleted.'''
+        messages = []
+        for msg_id in sorted(self.messages)[:kwargs['MaxNumberOfMessages']]:
+            self.inflight[msg_id] = self.messages.pop(msg_id)
+            messages.append({'MessageId': msg_id, 'ReceiptHandle': 'receipt-%s' % msg_id,
+                             'Body': self.inflight[msg_id]})
+        return {'Messages': messages} if messages else {}
+
+    def delete_message(self, **kwargs):
+        '''Delete received message.'''
+        del self.inflight[kwargs['ReceiptHandle'][len('receipt-'):]]
+
+
+def test_sqs_queue(monkeypatch):
+    '''Test SQS queue delivery, batches split into SendMessageBatch sized chunks.'''
+    sqs = FakeSQS()
+    monkeypatch.setattr(queue_module, 'aws_client', lambda service: sqs)
+    queue = SQSQueue('mail')
+    assert queue.url.endswith('/mail')
+    check_queue(queue)
+    assert len(queue.send_batch([{'action': ['cmd', i]} for i in range(25)])) == 25
+    assert sqs.batches[-3:] == [10, 10, 5]
+    received = []
+    while True:
+        batch = queue.receive()
+        if not batch:
+            break
+        received.extend(batch)
+        for msg in batch:
+            queue.delete(msg['receipt'])
+    # the released message is redelivered only after its visibility timeout expires
+    assert len(received) == 25
+    assert len(sqs.inflight) == 1
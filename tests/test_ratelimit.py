@@ -0,0 +1,91 @@
+'''Py.test'''
+import sys
+import threading
+import time
+
+sys.path.append('./lambda')
+from sslnotifyme.ratelimit import (AIMDLimiter, RetryQueue, TokenBucket, backoff_delay)
+
+
+class FakeClock(object):
+    '''Manually advanced clock, sleeping advances it.'''
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        '''Advance clock.'''
+        self.now += seconds
+
+
+def test_token_bucket_rate():
+    '''Test bucket allows burst tokens at once, then rate tokens per second.'''
+    clock = FakeClock()
+    bucket = TokenBucket(10, burst=5, clock=clock, sleeper=clock.sleep)
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.now == 0
+    for _ in range(20):
+        bucket.acquire()
+    assert abs(clock.now - 2.0) < 1e-6
+    assert TokenBucket(0).try_acquire(1000) == 0
+
+
+def test_aimd_limiter_adapts():
+    '''Test limit grows on success, halves once per cooldown on errors and slow calls.'''
+    clock = FakeClock()
+    limiter = AIMDLimiter(4, minimum=1, maximum=8, latency_target=1.0, cooldown=5,
+                          clock=clock)
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release()
+    assert 6 < limiter.limit <= 8
+    grown = limiter.limit
+    for _ in range(3):  # a burst of failures is one signal
+        limiter.acquire()
+        limiter.release(failed=True)
+    assert limiter.limit == grown / 2
+    clock.sleep(5)
+    limiter.acquire()
+    limiter.release(latency=2.0)
+    assert limiter.limit == grown / 4
+
+
+def test_aimd_limiter_bounds_concurrency():
+    '''Test no more than limit calls run at the same time.'''
+    limiter = AIMDLimiter(2, maximum=2)
+    peak = []
+    lock = threading.Lock()
+
+    def work():
+        with limiter.slot():
+            with lock:
+                peak.append(limiter.inflight)
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) == 2
+    assert limiter.inflight == 0
+
+
+def test_retry_queue_backoff():
+    '''Test items are retried after jittered exponential backoff, up to max attempts.'''
+    clock = FakeClock()
+    retries = RetryQueue(max_attempts=3, base_delay=1, max_delay=10, clock=clock,
+                         rand=lambda: 1.0)
+    assert retries.push('a')
+    assert retries.ready() == []
+    assert retries.next_delay() == 1
+    clock.sleep(1)
+    assert retries.ready() == [('a', 'a')]
+    assert retries.push('a')
+    assert retries.next_delay() == 2
+    assert not retries.push('a')  # third failure
+    assert retries.attempts('a') == 3
+    assert backoff_delay(10, base=1, maximum=10, rand=lambda: 0.5) == 5
@@ -0,0 +1,150 @@
+'''Py.test'''
+import sys
+from datetime import (datetime, timedelta)
+
+sys.path.append('./lambda')
+import reporter
+from sslnotifyme import (logs, metrics)
+from sslnotifyme.checkpoint import MemoryCheckpointStore
+
+
+NEW = datetime.utcnow().replace(microsecond=0) - timedelta(seconds=1)
+NEW_MS = reporter.epoch_ms(NEW)
+
+
+class FakePaginator(object):
+    '''Fake boto3 paginator returning the given pages.'''
+    def __init__(self, pages):
+        self._pages = pages
+
+    def paginate(self, **kwargs):
+        return iter(self._pages)
+
+
+class FakeLogs(object):
+    '''Fake CloudWatch Logs client, three pages of events for each group.'''
+    def __init__(self, groups):
+        self.groups = groups
+        self.calls = []
+
+    def get_paginator(self, name):
+        assert name == 'describe_log_groups'
+        return FakePaginator([{'logGroups': [{'logGroupName': group}]}
+                              for group in self.groups])
+
+    def filter_log_events(self, **kwargs):
+        self.calls.append(kwargs)
+        page = int(kwargs.get('nextToken', 0))
+        response = {'events': [event for event in [
+            {'timestamp': NEW_MS + page,
+             'message': '[ERROR] %s page %d\n' % (kwargs['logGroupName'], page)},
+            {'timestamp': NEW_MS + page, 'message': 'START RequestId: %d\n' % page},
+        ] if kwargs['startTime'] <= event['timestamp'] <= kwargs['endTime']]}
+        if page < 2:
+            response['nextToken'] = str(page + 1)
+        return response
+
+
+class FakeS3(object):
+    '''Fake S3 client, one old and one new object for each page.'''
+    def get_paginator(self, name):
+        assert name == 'list_objects_v2'
+        return FakePaginator([{'Contents': [
+            {'Key': 'old%d' % page, 'LastModified': datetime(2000, 1, 1)},
+            {'Key': 'new%d' % page, 'LastModified': NEW},
+        ]} for page in range(2)])
+
+
+def test_report_follows_all_pages(monkeypatch):
+    '''Test report includes events from every page of every group, in order.'''
+    logs = FakeLogs(['/aws/lambda/app_%s' % name for name in ('checker', 'cron', 'db')])
+    clients = {'logs': logs, 's3': FakeS3()}
+    monkeypatch.setattr(reporter, 'aws_client', clients.get)
+    report = reporter.Reporter.get_report(r'^START ', filter_pattern='?ERROR')
+    lines = report.splitlines()
+    assert lines[:9] == ['/aws/lambda/app_%s %d [ERROR] /aws/lambda/app_%s page %d' % (
+        group, NEW_MS + page, group, page) for group in ('checker', 'cron', 'db') for page in range(3)]
+    assert lines[9:] == ['Found new email bounce in %s bucket: new%d' % (
+        reporter.BOUNCES_BUCKET, page) for page in range(2)]
+    assert len(logs.calls) == 9
+    assert all(call['filterPattern'] == '?ERROR' for call in logs.calls)
+
+
+def test_report_resumes_from_checkpoint(monkeypatch):
+    '''Test a report run saves a checkpoint, the next run reports only newer data.'''
+    logs = FakeLogs(['/aws/lambda/app_checker'])
+    clients = {'logs': logs, 's3': FakeS3()}
+    store = MemoryCheckpointStore()
+    sent = []
+    monkeypatch.setattr(reporter, 'aws_client', clients.get)
+    monkeypatch.setattr(reporter, 'checkpoint_store', lambda: store)
+    monkeypatch.setattr(reporter, 'lambda_mailer', lambda *args: sent.append(args))
+
+    reporter.Reporter.send_report()
+    checkpoint = store.load()
+    assert checkpoint['logs']['/aws/lambda/app_checker'] > NEW_MS
+    assert checkpoint['bounces']['since'] == checkpoint['logs']['/aws/lambda/app_checker'] // 1000
+    assert len(sent) == 1
+
+    # events fetched again in the overlap with the previous window are not reported
+    assert reporter.Reporter.send_report() == {'response': 'empty report'}
+    assert logs.calls[-1]['startTime'] == \
+        checkpoint['logs']['/aws/lambda/app_checker'] - reporter.REPORT_OVERLAP_MS
+    assert len(sent) == 1
+
+
+def test_late_events_are_reported(monkeypatch):
+    '''Test events ingested after a report, timestamped before its end, are reported next.'''
+    events = [{'eventId': '1', 'timestamp': NEW_MS, 'message': '[ERROR] early\n'}]
+
+    class LateLogs(FakeLogs):
+        '''Logs client returning the events of the window.'''
+        def filter_log_events(self, **kwargs):
+            return {'events': [event for event in events
+                               if kwargs['startTime'] <= event['timestamp']]}
+
+    clients = {'logs': LateLogs(['/aws/lambda/app_checker']), 's3': FakeS3()}
+    monkeypatch.setattr(reporter, 'aws_client', clients.get)
+    report, checkpoint = reporter.Reporter.get_incremental_report(r'^START ')
+    assert report.count('[ERROR]') == 1
+    events.append({'eventId': '2', 'timestamp': NEW_MS + 1, 'message': '[ERROR] late\n'})
+    report, _ = reporter.Reporter.get_incremental_report(r'^START ', checkpoint=checkpoint)
+    assert report.splitlines()[0].endswith('[ERROR] late')
+    assert 'early' not in report
+
+
+def test_metrics_lines_are_excluded(monkeypatch):
+    '''Test EMF metrics lines printed by the lambdas are not reported.'''
+    collector = metrics.EMFCollector(namespace='test')
+    collector.record('AWSCallErrors', 1, 'Count', {'Service': 'ses', 'Operation': 'SendEmail'})
+    collector.record('CommandDuration', 1.5, 'Milliseconds', {'Command': 'send_alert'})
+    events = [{'timestamp': NEW_MS, 'message': line + '\n'}
+              for line in collector.lines(collector.records)]
+    events.append({'timestamp': NEW_MS, 'message': '[ERROR] failure\n'})
+    monkeypatch.setattr(reporter, 'generate_logs',
+                        lambda *args: (('/aws/lambda/app_mailer', event) for event in events))
+    assert [event['message'] for _, event in reporter.generate_valid_logs(
+        reporter.REPORT_EXCLUDE_REGEXP)] == ['[ERROR] failure\n']
+
+
+def test_summaries_are_aggregated(monkeypatch):
+    '''Test invocation summary lines are aggregated per group and command, not reported.'''
+    events = [{'eventId': str(i), 'timestamp': NEW_MS,
+               'message': logs.summary_line('check_and_send_alert_batch',
+                                            {'records': 100, 'alerts': i, 'errors': 1}) + '\n'}
+              for i in range(3)]
+    events.append({'eventId': '3', 'timestamp': NEW_MS, 'message': '[ERROR] failure\n'})
+    events.append({'eventId': '4', 'timestamp': NEW_MS,
+                   'message': logs.summary_line('send_report', {}) + '\n'})
+    monkeypatch.setattr(reporter, 'get_log_group_names', lambda: ['/aws/lambda/app_checker'])
+    monkeypatch.setattr(reporter, 'generate_logs',
+                        lambda *args: (('/aws/lambda/app_checker', event) for event in events))
+    monkeypatch.setattr(reporter, 'generate_bucket_objects', lambda since: [])
+    report, _ = reporter.Reporter.get_incremental_report(reporter.REPORT_EXCLUDE_REGEXP)
+    assert report.splitlines() == [
+        '/aws/lambda/app_checker check_and_send_alert_batch: 3 invocation(s), '
+        'alerts 3, errors 3, records 300, skipped 0',
+        '/aws/lambda/app_checker send_report: 1 invocation(s), '
+        'alerts 0, errors 0, records 0, skipped 0',
+        '/aws/lambda/app_checker %d [ERROR] failure' % NEW_MS,
+    ]
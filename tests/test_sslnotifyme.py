@@ -0,0 +1,68 @@
+'''Py.test'''
+import json
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append('./lambda')
+import sslnotifyme
+
+
+def test_aws_client_registry():
+    '''Test clients are created once and shared across threads.'''
+    sslnotifyme.reset_aws_clients()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        clients = list(pool.map(sslnotifyme.aws_client, ['dynamodb'] * 32))
+    assert all(client is clients[0] for client in clients)
+    assert sslnotifyme.aws_client('s3') is not clients[0]
+    config = clients[0].meta.config
+    assert config.max_pool_connections == sslnotifyme.AWS_MAX_POOL_CONNECTIONS
+    assert config.connect_timeout == sslnotifyme.AWS_CONNECT_TIMEOUT
+    sslnotifyme.reset_aws_clients()
+    assert sslnotifyme.aws_client('dynamodb') is not clients[0]
+
+
+def test_lambdas_defer_heavy_imports():
+    '''Test lambda modules import boto3 and asyncio only when needed.'''
+    sys.path.append('./benchmarks')
+    import coldstart
+    results = coldstart.run(runs=1)
+    for module in ('checker', 'cron', 'mailer', 'reporter'):
+        assert 'boto3' not in results[module]['loaded']
+        assert 'botocore' not in results[module]['loaded']
+    assert 'asyncio' not in results['checker']['loaded']
+
+
+def test_local_transport(monkeypatch):
+    '''Test local transport dispatches to lambda modules with JSON payloads.'''
+    import mailer
+    sent = []
+    monkeypatch.setattr(sslnotifyme, 'LAMBDA_TRANSPORT', 'local')
+    monkeypatch.setattr(mailer, 'send_ses_email', lambda *args, **kwargs: sent.append(args))
+    assert sslnotifyme.lambda_mailer_blocking('send_feedback', 'hello') == {
+        'response': 'thank you for your submission'}
+    assert sslnotifyme.lambda_mailer_blocking('not_a_command') == {
+        'errorMessage': 'command not_a_command not valid'}
+    assert sslnotifyme.lambda_mailer('send_feedback', 'bye')['response']
+    assert [args[2] for args in sent] == ['hello', 'bye']
+
+
+CHALICE_PROBE = '''
+import json
+import chalicelib
+import mailer
+chalicelib.LAMBDA_TRANSPORT = 'local'
+mailer.send_ses_email = lambda *args, **kwargs: None
+print(json.dumps(chalicelib.lambda_mailer_blocking('send_feedback', 'hello')))
+'''
+
+
+def test_chalice_bundle_local_transport(tmpdir):
+    '''Test lambdas vendored by make api resolve in the Chalice bundle layout.'''
+    bundle = tmpdir.mkdir('bundle')
+    subprocess.check_call(['make', '-s', 'api-vendor', 'VENDORDIR=%s' % bundle])
+    shutil.copytree('lambda/sslnotifyme', str(bundle.join('chalicelib')))
+    output = subprocess.check_output([sys.executable, '-c', CHALICE_PROBE], cwd=str(bundle))
+    assert json.loads(output.decode('utf-8').splitlines()[-1]) == {
+        'response': 'thank you for your submission'}
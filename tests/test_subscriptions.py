@@ -0,0 +1,60 @@
+'''Py.test'''
+import sys
+
+sys.path.append('./lambda')
+from sslnotifyme.queue import MemoryQueue
+from sslnotifyme.subscriptions import (import_subscriptions, parse_rows, validate_row)
+
+
+def test_parse_csv_and_json_lines():
+    '''Test input format is detected from the first line, blank lines are skipped.'''
+    csv_rows = list(parse_rows(['', 'email,domain,days', 'a@example.com,a.com,10', '',
+                                'b@example.com,b.com,']))
+    assert csv_rows == [(1, {'email': 'a@example.com', 'domain': 'a.com', 'days': '10'}, None),
+                        (2, {'email': 'b@example.com', 'domain': 'b.com', 'days': ''}, None)]
+    jsonl_rows = list(parse_rows(['{"email": "a@example.com", "domain": "a.com"}', '{oops',
+                                  '[1]']))
+    assert jsonl_rows == [(1, {'email': 'a@example.com', 'domain': 'a.com'}, None),
+                          (2, None, 'invalid JSON'),
+                          (3, None, 'row must be a JSON object')]
+    assert list(parse_rows([])) == []
+
+
+def test_validate_row():
+    '''Test rows are validated and normalized, days defaults to 30.'''
+    assert validate_row({'email': ' a@example.com', 'domain': 'WWW.Example.com'}) == (
+        {'email': 'a@example.com', 'domain': 'www.example.com', 'days': 30}, None)
+    assert validate_row({'email': 'a@example.com', 'domain': 'a.com:8443', 'days': '7'}) == (
+        {'email': 'a@example.com', 'domain': 'a.com:8443', 'days': 7}, None)
+    assert validate_row({'email': 'nobody', 'domain': 'a.com'}) == (None, 'invalid email')
+    assert validate_row({'email': 'a@example.com', 'domain': 'http://a.com'}) == \
+        (None, 'invalid domain')
+    assert validate_row({'email': 'a@example.com', 'domain': 'a.com', 'days': '0'}) == \
+        (None, 'days value must be a positive number')
+
+
+def test_import_report():
+    '''Test rows are stored in batches, each row reported with its outcome.'''
+    batches = []
+
+    def put_pending(records):
+        '''Fail the second batch.'''
+        batches.append(len(records))
+        if len(batches) == 2:
+            raise RuntimeError('throttled')
+        return [dict(record, uuid='uuid-%s' % record['email']) for record in records]
+
+    queue = MemoryQueue()
+    lines = ['{"email": "user%d@example.com", "domain": "domain%d.com"}' % (i, i)
+             for i in range(5)]
+    lines.insert(2, '{"email": "bad", "domain": "domain.com"}')
+    report = import_subscriptions(lines, put_pending, queue, batch_size=2)
+    assert batches == [2, 2, 1]
+    assert report['imported'] == 3 and report['failed'] == 3
+    assert [(entry['row'], entry['status']) for entry in report['rows']] == [
+        (1, 'pending'), (2, 'pending'), (3, 'error'), (4, 'error'), (5, 'error'),
+        (6, 'pending')]
+    assert report['rows'][2]['error'] == 'invalid email'
+    assert report['rows'][3]['error'] == 'internal error storing subscription'
+    assert [msg['body']['action'][1] for msg in queue.receive()] == [
+        'user0@example.com', 'user1@example.com', 'user4@example.com']
@@ -0,0 +1,85 @@
+'''Py.test'''
+import json
+import sys
+
+sys.path.append('./lambda')
+import sslnotifyme
+from sslnotifyme import wire
+
+RECORDS = [{'email': 'user%d@example.com' % i, 'domain': 'domain%d.com' % (i % 50),
+            'days': '30', 'uuid': '%032x' % i} for i in range(1000)]
+
+
+def test_columnar_round_trip():
+    '''Test nested lists of records are stored as columns, missing keys preserved.'''
+    obj = {'response': [{'email': 'a', 'not_after': 1},
+                        {'email': 'b', 'tags': [{'k': 1}, {'k': 2, 'v': None}]}],
+           'cursor': None, 'action': ['cmd', [], [{'a': 1}], ['x', 'y']]}
+    columns = wire.to_columns(obj)
+    assert columns['response']['_columns'] == ['email', 'not_after', 'tags']
+    assert columns['response']['_absent'] == [[0, 2], [1, 1]]
+    assert columns['action'] == ['cmd', [], [{'a': 1}], ['x', 'y']]
+    assert wire.from_columns(columns) == obj
+
+
+def test_envelope_is_smaller():
+    '''Test enveloped records take a fraction of their plain JSON size.'''
+    obj = {'response': RECORDS, 'cursor': 'abc'}
+    envelope = wire.encode(obj)
+    assert wire.is_envelope(envelope)
+    assert len(json.dumps(envelope)) * 4 < len(json.dumps(obj))
+    assert wire.decode(envelope) == obj
+    assert wire.encode({'response': 'ok'}) == {'response': 'ok'}  # below WIRE_MIN_BYTES
+    assert wire.decode({'response': 'ok'}) == {'response': 'ok'}
+
+
+class Echo(object):
+    '''Lambda commands returning their arguments.'''
+
+    @staticmethod
+    def echo(records):
+        '''Return records.'''
+        return {'response': records}
+
+
+# pylint: disable=unused-argument
+def lambda_main(event, context):
+    '''Entry point of the echo lambda.'''
+    return sslnotifyme.lambda_main_wrapper(event, Echo)
+
+
+def test_wrapper_negotiates_envelopes():
+    '''Test responses are enveloped only for callers accepting envelopes.'''
+    plain = sslnotifyme.lambda_main_wrapper({'action': ['echo', RECORDS]}, Echo)
+    assert plain == {'response': RECORDS}
+    enveloped = sslnotifyme.lambda_main_wrapper(
+        dict(wire.encode({'action': ['echo', RECORDS]}), _accept=wire.ENVELOPE_FORMAT), Echo)
+    assert wire.is_envelope(enveloped)
+    assert wire.decode(enveloped) == {'response': RECORDS}
+    # plain JSON response to enveloped request of a caller not accepting envelopes
+    assert sslnotifyme.lambda_main_wrapper(wire.encode({'action': ['echo', RECORDS]}),
+                                           Echo) == {'response': RECORDS}
+
+
+def test_invocations_use_envelopes(monkeypatch):
+    '''Test lambda invocations send and receive envelopes when enabled.'''
+    payloads = []
+
+    class Transport(sslnotifyme.LocalTransport):
+        '''Local transport recording payloads.'''
+        @staticmethod
+        def invoke(lambda_name, payload, blocking):
+            payloads.append(payload)
+            return sslnotifyme.LocalTransport.invoke(lambda_name, payload, blocking)
+
+    monkeypatch.setattr(sslnotifyme, 'LAMBDA_MODULES', {'echo': __name__})
+    monkeypatch.setattr(sslnotifyme, '_transport', lambda: Transport)
+    monkeypatch.setattr(wire, 'WIRE_ENVELOPE', True)
+    assert sslnotifyme._invoke_lambda_blocking('echo', 'echo', RECORDS) == \
+        {'response': RECORDS}
+    assert wire.is_envelope(json.loads(payloads[0]))
+
+    monkeypatch.setattr(wire, 'WIRE_ENVELOPE', False)
+    assert sslnotifyme._invoke_lambda_blocking('echo', 'echo', RECORDS) == \
+        {'response': RECORDS}
+    assert json.loads(payloads[1]) == {'action': ['echo', RECORDS]}